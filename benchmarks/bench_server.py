@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for the Stata MCP server hot paths
+
+Runs against the fake Stata backend, so no Stata installation or license is needed.
+Reports latency (mean/p50/p95), throughput and peak Python memory per benchmark.
+
+Usage:
+    python benchmarks/bench_server.py
+    python benchmarks/bench_server.py --iterations 50 --only log_cleaning --json results.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import tempfile
+import subprocess
+import tracemalloc
+import importlib.util
+
+# Make the server module importable from the repository checkout
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import stata_mcp_server as server  # noqa: E402
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of a list of numbers (nearest-rank)"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def measure(name, func, iterations, setup=None):
+    """Time func() over the given iterations and measure peak memory of one extra call"""
+    if setup:
+        setup()
+    func()  # warm-up
+
+    timings = []
+    total_start = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    total = time.perf_counter() - total_start
+
+    # Peak memory is measured separately so tracemalloc does not skew the timings
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "name": name,
+        "iterations": iterations,
+        "mean_ms": sum(timings) / len(timings) * 1000,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p95_ms": percentile(timings, 95) * 1000,
+        "throughput_per_s": iterations / total if total > 0 else 0.0,
+        "peak_memory_kb": peak / 1024,
+    }
+
+
+def make_log(lines):
+    """Produce a realistic do-file log with the fake backend"""
+    backend = server.FakeStataBackend(output_lines=1)
+    workdir = tempfile.mkdtemp(prefix="stata_mcp_bench_")
+    do_path = os.path.join(workdir, "bench.do")
+    log_path = os.path.join(workdir, "bench.log")
+    with open(do_path, 'w') as f:
+        f.write(f'log using "{log_path}", replace text\n')
+        for i in range(lines):
+            f.write(f"summarize var{i}\n")
+        f.write("capture log close\n")
+    backend.run(f'do "{do_path}"')
+    with open(log_path, 'r') as f:
+        return f.read()
+
+
+def bench_run_stata_command(iterations, output_lines):
+    server.init_fake_backend(f"output_lines={output_lines}")
+    return measure(f"run_stata_command[output_lines={output_lines}]",
+                   lambda: server.run_stata_command("summarize price", clear_history=True),
+                   iterations)
+
+
+def bench_run_stata_file(iterations, output_lines):
+    server.init_fake_backend(f"output_lines={output_lines}")
+    workdir = tempfile.mkdtemp(prefix="stata_mcp_bench_")
+    do_path = os.path.join(workdir, "bench.do")
+    with open(do_path, 'w') as f:
+        f.write("sysuse auto\n")
+        for i in range(20):
+            f.write(f"regress price mpg weight if rep78 == {i % 5 + 1}\n")
+    server.log_file_location = 'workspace'
+    return measure(f"run_stata_file[output_lines={output_lines}]",
+                   lambda: server.run_stata_file(do_path, timeout=60),
+                   iterations)
+
+
+def bench_log_cleaning(iterations, lines):
+    log_content = make_log(lines)
+    results = [
+        measure(f"clean_command_log[lines={lines}]", lambda: server.clean_command_log(log_content), iterations),
+        measure(f"clean_do_file_log[lines={lines}]", lambda: server.clean_do_file_log(log_content), iterations),
+    ]
+    return results
+
+
+def bench_history_rendering(iterations, result_lines):
+    result = "\n".join(f"line {i} of output" for i in range(result_lines))
+
+    def setup():
+        server.command_history = [{"command": f"[2024-01-01 00:00:00] cmd {i}", "result": result} for i in range(50)]
+
+    return measure(f"render_command_history[50 entries x {result_lines} lines]",
+                   server.render_command_history, iterations, setup=setup)
+
+
+def bench_parquet_loading(iterations, rows):
+    """Parquet straight into the dataset vs. the CSV route (export to CSV, then parse it back)"""
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+    import pandas as pd
+    server.init_fake_backend("")
+    workdir = tempfile.mkdtemp(prefix="stata_mcp_bench_")
+    parquet_path = os.path.join(workdir, "bench.parquet")
+    csv_path = os.path.join(workdir, "bench.csv")
+    table = pa.table({
+        "id": pa.array(range(rows), pa.int64()),
+        "year": pa.array([2000 + i % 20 for i in range(rows)], pa.int16()),
+        "value": pa.array([i * 0.25 for i in range(rows)]),
+        "group": pa.array([f"group_{i % 50}" for i in range(rows)]),
+    })
+    pq.write_table(table, parquet_path, row_group_size=max(1, rows // 8))
+
+    def csv_route():
+        # The fake backend's import delimited is a no-op, so pandas stands in for Stata's CSV parser
+        pacsv.write_csv(pq.read_table(parquet_path), csv_path)
+        frame = pd.read_csv(csv_path)
+        variables = [{"name": name, "type": "strL" if frame[name].dtype == object else "double", "format": None}
+                     for name in frame.columns]
+        server.stata_backend.begin_dataset(variables)
+        server.stata_backend.append_observations(variables, [frame[name].tolist() for name in frame.columns])
+
+    return [
+        measure(f"load_parquet[rows={rows}]", lambda: server.load_parquet_file(parquet_path, clear=True), iterations),
+        measure(f"load_parquet[rows={rows}, 2 columns]",
+                lambda: server.load_parquet_file(parquet_path, columns=["id", "value"], clear=True), iterations),
+        measure(f"csv_route[rows={rows}]", csv_route, iterations),
+    ]
+
+
+# A multi-threaded CPU-bound job standing in for a Stata/MP command: BLAS matrix products on as many
+# threads as it is given. It starts its BLAS threads, reports ready and waits for a line on stdin, so
+# the CPU allocator can pin all of its threads the way it pins a Stata process before a job.
+CPU_JOB = """
+import sys
+import numpy as np
+a = np.random.default_rng(0).random((700, 700))
+a @ a
+print("ready", flush=True)
+sys.stdin.readline()
+for _ in range(12):
+    a = a @ a
+    a /= np.abs(a).max()
+"""
+
+
+def bench_cpu_partitioning(iterations, jobs):
+    """Aggregate throughput of concurrent multi-threaded jobs: all sharing every CPU vs. shares of the allocator"""
+    allocator = server.CpuAllocator()
+    shares = allocator.partition(jobs)
+
+    def batch(partitioned):
+        processes = []
+        for share in (shares if partitioned else [allocator.cpus] * jobs):
+            threads = str(len(share))
+            env = dict(os.environ, OMP_NUM_THREADS=threads, OPENBLAS_NUM_THREADS=threads, MKL_NUM_THREADS=threads)
+            processes.append(subprocess.Popen([sys.executable, "-c", CPU_JOB], env=env, text=True,
+                                              stdin=subprocess.PIPE, stdout=subprocess.PIPE))
+        try:
+            for process in processes:
+                if process.stdout.readline().strip() != "ready":
+                    raise RuntimeError(f"CPU job {process.pid} failed to start (exit code {process.wait()})")
+            if partitioned:
+                # The server's own acquire/release path: each job's process gets its share and is pinned
+                for i, process in enumerate(processes):
+                    allocator.acquire(f"job{i}", process.pid)
+                for i, process in enumerate(processes):
+                    expected = allocator.snapshot()["shares"][f"job{i}"]["cpus"]
+                    if sorted(os.sched_getaffinity(process.pid)) != expected:
+                        raise RuntimeError(f"CPU job {process.pid} was not pinned to {expected}")
+            for process in processes:
+                process.stdin.write("go\n")
+                process.stdin.close()
+            for process in processes:
+                if process.wait() != 0:
+                    raise RuntimeError(f"CPU job {process.pid} exited with code {process.returncode}")
+        finally:
+            for i, process in enumerate(processes):
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                if partitioned:
+                    allocator.release(f"job{i}")
+
+    label = f"{jobs} jobs on {len(allocator.cpus)} CPUs"
+    # ops/s is batches per second; each batch runs `jobs` jobs concurrently
+    return [
+        measure(f"cpu_shared[{label}]", lambda: batch(False), iterations),
+        measure(f"cpu_partitioned[{label}]", lambda: batch(True), iterations),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stata MCP server micro-benchmarks (fake backend)')
+    parser.add_argument('--iterations', type=int, default=20, help='Iterations per benchmark')
+    parser.add_argument('--only', type=str, default='',
+                        help='Run only benchmarks whose group matches (run_stata_command, run_stata_file, log_cleaning, '
+                             'history_rendering, parquet_loading, cpu_partitioning)')
+    parser.add_argument('--json', type=str, default='', help='Write results to this JSON file')
+    args = parser.parse_args()
+
+    # Keep server logging out of the measurements
+    logging.getLogger().handlers.clear()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    groups = {
+        "run_stata_command": lambda: [bench_run_stata_command(args.iterations, n) for n in (3, 200)],
+        "run_stata_file": lambda: [bench_run_stata_file(max(1, args.iterations // 4), n) for n in (3, 200)],
+        "log_cleaning": lambda: [r for n in (100, 10000) for r in bench_log_cleaning(args.iterations, n)],
+        "history_rendering": lambda: [bench_history_rendering(args.iterations, n) for n in (10, 1000)],
+    }
+    if server.has_pyarrow:
+        groups["parquet_loading"] = lambda: [r for n in (10000, 200000)
+                                             for r in bench_parquet_loading(max(1, args.iterations // 4), n)]
+
+    if not hasattr(os, "sched_setaffinity"):
+        print("Skipping cpu_partitioning: CPU affinity is not supported on this platform")
+    elif importlib.util.find_spec("numpy") is None:
+        print("Skipping cpu_partitioning: numpy is not installed")
+    else:
+        groups["cpu_partitioning"] = lambda: [r for n in (2, 4)
+                                              for r in bench_cpu_partitioning(max(1, args.iterations // 10), n)]
+
+    results = []
+    for group, run in groups.items():
+        if args.only and args.only != group:
+            continue
+        results.extend(run())
+
+    print(f"{'benchmark':<52} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10} {'ops/s':>10} {'peak KB':>10}")
+    for r in results:
+        print(f"{r['name']:<52} {r['mean_ms']:>10.3f} {r['p50_ms']:>10.3f} {r['p95_ms']:>10.3f} "
+              f"{r['throughput_per_s']:>10.1f} {r['peak_memory_kb']:>10.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"timestamp": time.time(), "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+End-to-end load generator for the Stata MCP server
+
+Drives concurrent mixed workloads (short selections, long do-files, health probes)
+through both the REST endpoint (/v1/tools) and the MCP SSE transport (/mcp), then
+reports p50/p95/p99 latency, throughput, error rates and server RSS over time.
+
+Only the standard library is used. Point it at a server started with the fake backend,
+or let it start one:
+
+    python benchmarks/loadgen.py --spawn --clients 20 --duration 60
+    python benchmarks/loadgen.py --url http://localhost:4000 --mix rest_selection=5,mcp_file=1,health=2
+    python benchmarks/loadgen.py --spawn --json run2.json --compare run1.json
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+import urllib.request
+
+DEFAULT_MIX = "rest_selection=4,rest_file=1,mcp_selection=2,mcp_file=1,health=2"
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'stata_mcp_server.py')
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of a list of numbers (nearest-rank)"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def parse_mix(text):
+    """Parse "op=weight,op=weight" into a list of (op, weight)"""
+    mix = []
+    for item in text.split(","):
+        if "=" in item:
+            op, weight = item.split("=", 1)
+            mix.append((op.strip(), float(weight)))
+    return mix
+
+
+class McpSession:
+    """Minimal MCP client over the SSE transport (one event stream per session)"""
+
+    def __init__(self, base_url, timeout):
+        parsed = urllib.parse.urlparse(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.timeout = timeout
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.next_id = 1
+        self.endpoint = None
+        self.endpoint_ready = threading.Event()
+        self.closed = False
+
+        self.stream = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        self.stream.request("GET", "/mcp", headers={"Accept": "text/event-stream"})
+        self.response = self.stream.getresponse()
+        if self.response.status != 200:
+            raise RuntimeError(f"SSE connect failed with status {self.response.status}")
+        self.reader = threading.Thread(target=self._read_events, daemon=True)
+        self.reader.start()
+        if not self.endpoint_ready.wait(timeout):
+            raise RuntimeError("No endpoint event received from /mcp")
+
+        self.request("initialize", {
+            "protocolVersion": "2024-11-05",
+            "capabilities": {},
+            "clientInfo": {"name": "stata-mcp-loadgen", "version": "1.0"},
+        })
+        self._post({"jsonrpc": "2.0", "method": "notifications/initialized"})
+
+    def _read_events(self):
+        event, data = None, []
+        try:
+            while not self.closed:
+                raw = self.response.fp.readline()
+                if not raw:
+                    break
+                line = raw.decode('utf-8').rstrip("\r\n")
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:"):
+                    data.append(line[5:].strip())
+                elif line == "":
+                    if data:
+                        self._dispatch(event, "\n".join(data))
+                    event, data = None, []
+        except Exception:
+            pass
+        finally:
+            # Fail any waiters if the stream drops
+            with self.pending_lock:
+                for slot in self.pending.values():
+                    slot.put({"error": {"message": "SSE stream closed"}})
+                self.pending.clear()
+
+    def _dispatch(self, event, data):
+        if event == "endpoint":
+            self.endpoint = data
+            self.endpoint_ready.set()
+            return
+        try:
+            message = json.loads(data)
+        except ValueError:
+            return
+        with self.pending_lock:
+            slot = self.pending.pop(message.get("id"), None)
+        if slot is not None:
+            slot.put(message)
+
+    def _post(self, payload):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request("POST", self.endpoint, body=json.dumps(payload), headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 400:
+                raise RuntimeError(f"MCP POST failed with status {response.status}")
+        finally:
+            conn.close()
+
+    def request(self, method, params):
+        slot = queue.Queue(maxsize=1)
+        with self.pending_lock:
+            request_id = self.next_id
+            self.next_id += 1
+            self.pending[request_id] = slot
+        self._post({"jsonrpc": "2.0", "id": request_id, "method": method, "params": params})
+        try:
+            message = slot.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError(f"MCP {method} timed out")
+        if "error" in message:
+            raise RuntimeError(message["error"].get("message", "MCP error"))
+        return message.get("result", {})
+
+    def call_tool(self, name, arguments):
+        result = self.request("tools/call", {"name": name, "arguments": arguments})
+        if result.get("isError"):
+            text = "".join(c.get("text", "") for c in result.get("content", []))
+            raise RuntimeError(f"Tool error: {text[:200]}")
+        return result
+
+    def close(self):
+        self.closed = True
+        try:
+            self.stream.close()
+        except Exception:
+            pass
+
+
+class LoadGenerator:
+    """Runs virtual clients against a server and collects per-operation samples"""
+
+    def __init__(self, args, short_file, long_file):
+        self.args = args
+        self.base_url = args.url.rstrip("/")
+        self.mix = parse_mix(args.mix)
+        self.short_file = short_file
+        self.long_file = long_file
+        self.samples = []  # (op, start offset, latency, ok, error)
+        self.samples_lock = threading.Lock()
+        self.rss_samples = []  # (offset, bytes)
+        self.stop = threading.Event()
+        self.start_time = None
+
+    def _http_json(self, method, path, payload=None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.args.request_timeout) as response:
+            return response.status, response.read()
+
+    def _run_op(self, op, session_holder):
+        if op == "health":
+            status, _ = self._http_json("GET", "/health")
+            return status == 200
+        if op in ("rest_selection", "rest_file"):
+            if op == "rest_selection":
+                payload = {"tool": "run_selection", "parameters": {"selection": random.choice(["display 1", "describe", "summarize price"])}}
+            else:
+                payload = {"tool": "run_file", "parameters": {"file_path": self.long_file, "timeout": 600}}
+            status, body = self._http_json("POST", "/v1/tools", payload)
+            return status == 200 and json.loads(body).get("status") == "success"
+        if op in ("mcp_selection", "mcp_file"):
+            if session_holder.get("session") is None:
+                session_holder["session"] = McpSession(self.base_url, self.args.request_timeout)
+            session = session_holder["session"]
+            if op == "mcp_selection":
+                session.call_tool("stata_run_selection", {"selection": "display 2"})
+            else:
+                session.call_tool("stata_run_file", {"file_path": self.short_file, "timeout": 600})
+            return True
+        raise ValueError(f"Unknown operation: {op}")
+
+    def _client(self, client_id):
+        rng = random.Random(client_id)
+        ops = [op for op, _ in self.mix]
+        weights = [w for _, w in self.mix]
+        session_holder = {}
+        while not self.stop.is_set():
+            op = rng.choices(ops, weights)[0]
+            started = time.perf_counter()
+            ok, error = False, None
+            try:
+                ok = self._run_op(op, session_holder)
+            except Exception as e:
+                error = str(e)[:200]
+                # Drop a broken MCP session so the next call reconnects
+                if session_holder.get("session") is not None and op.startswith("mcp_"):
+                    session_holder["session"].close()
+                    session_holder["session"] = None
+            latency = time.perf_counter() - started
+            with self.samples_lock:
+                self.samples.append((op, started - self.start_time, latency, ok, error))
+            if self.args.think_time:
+                self.stop.wait(rng.uniform(0, self.args.think_time))
+        if session_holder.get("session") is not None:
+            session_holder["session"].close()
+
+    def _sample_rss(self):
+        while not self.stop.is_set():
+            rss = read_server_rss(self.base_url, self.args.server_pid)
+            if rss is not None:
+                self.rss_samples.append((time.perf_counter() - self.start_time, rss))
+            self.stop.wait(self.args.rss_interval)
+
+    def run(self):
+        self.start_time = time.perf_counter()
+        threads = [threading.Thread(target=self._client, args=(i,), daemon=True) for i in range(self.args.clients)]
+        threads.append(threading.Thread(target=self._sample_rss, daemon=True))
+        for t in threads:
+            t.start()
+        try:
+            self.stop.wait(self.args.duration)
+        except KeyboardInterrupt:
+            pass
+        self.stop.set()
+        for t in threads:
+            t.join(timeout=self.args.request_timeout)
+        return self.summarize(time.perf_counter() - self.start_time)
+
+    def summarize(self, elapsed):
+        by_op = {}
+        for op, _, latency, ok, error in self.samples:
+            stats = by_op.setdefault(op, {"latencies": [], "errors": 0, "error_samples": []})
+            stats["latencies"].append(latency)
+            if not ok:
+                stats["errors"] += 1
+                if error and len(stats["error_samples"]) < 3:
+                    stats["error_samples"].append(error)
+        operations = {}
+        for op, stats in sorted(by_op.items()):
+            latencies = stats["latencies"]
+            operations[op] = {
+                "count": len(latencies),
+                "throughput_per_s": len(latencies) / elapsed if elapsed else 0.0,
+                "error_rate": stats["errors"] / len(latencies) if latencies else 0.0,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "max_ms": max(latencies) * 1000 if latencies else 0.0,
+                "error_samples": stats["error_samples"],
+            }
+        rss_values = [rss for _, rss in self.rss_samples]
+        return {
+            "timestamp": time.time(),
+            "config": {"clients": self.args.clients, "duration": self.args.duration, "mix": self.args.mix,
+                       "fake_backend_options": self.args.fake_backend_options},
+            "elapsed_s": elapsed,
+            "total_requests": len(self.samples),
+            "throughput_per_s": len(self.samples) / elapsed if elapsed else 0.0,
+            "operations": operations,
+            "rss": {
+                "samples": [[round(t, 2), rss] for t, rss in self.rss_samples],
+                "start_mb": rss_values[0] / 1048576 if rss_values else None,
+                "peak_mb": max(rss_values) / 1048576 if rss_values else None,
+                "end_mb": rss_values[-1] / 1048576 if rss_values else None,
+            },
+        }
+
+
+def read_server_rss(base_url, pid=None):
+    """Read server RSS from /proc when the pid is known, otherwise from /metrics"""
+    if pid:
+        try:
+            with open(f"/proc/{pid}/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    try:
+        with urllib.request.urlopen(base_url + "/metrics", timeout=5) as response:
+            for line in response.read().decode('utf-8').splitlines():
+                if line.startswith("process_resident_memory_bytes"):
+                    return int(float(line.split()[-1]))
+    except Exception:
+        pass
+    return None
+
+
+def write_workload_files(long_file_seconds):
+    """Create the do-files used by the file workloads (the fake backend honors sleep)"""
+    workdir = tempfile.mkdtemp(prefix="stata_mcp_loadgen_")
+    short_file = os.path.join(workdir, "short.do")
+    long_file = os.path.join(workdir, "long.do")
+    with open(short_file, 'w') as f:
+        f.write("sysuse auto, clear\nsummarize price mpg\nregress price mpg weight\n")
+    with open(long_file, 'w') as f:
+        f.write("sysuse auto, clear\n")
+        steps = max(1, int(long_file_seconds))
+        for i in range(steps):
+            f.write(f"sleep 1000\nregress price mpg weight if _n > {i}\n")
+    return short_file, long_file
+
+
+def spawn_server(args):
+    """Start a server with the fake backend and wait until /health answers"""
+    if not args.port:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(("localhost", 0))
+            args.port = s.getsockname()[1]
+    args.url = f"http://localhost:{args.port}"
+    log_dir = tempfile.mkdtemp(prefix="stata_mcp_loadgen_logs_")
+    command = [sys.executable, SERVER_SCRIPT, "--port", str(args.port), "--backend", "fake",
+               "--fake-backend-options", args.fake_backend_options,
+               "--log-file", os.path.join(log_dir, "server.log"), "--log-file-location", "workspace"]
+    command.extend(args.server_arg)
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}; see {log_dir}/server.log")
+        try:
+            with urllib.request.urlopen(args.url + "/health", timeout=1):
+                args.server_pid = process.pid
+                return process
+        except Exception:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Server did not become healthy within 30 seconds")
+
+
+def print_report(report, baseline=None):
+    print(f"\nTotal: {report['total_requests']} requests in {report['elapsed_s']:.1f}s "
+          f"({report['throughput_per_s']:.2f} req/s)")
+    print(f"{'operation':<16} {'count':>7} {'req/s':>8} {'err%':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for op, stats in report["operations"].items():
+        line = (f"{op:<16} {stats['count']:>7} {stats['throughput_per_s']:>8.2f} {stats['error_rate'] * 100:>6.1f}% "
+                f"{stats['p50_ms']:>10.1f} {stats['p95_ms']:>10.1f} {stats['p99_ms']:>10.1f}")
+        if baseline and op in baseline.get("operations", {}):
+            base = baseline["operations"][op]
+            if base["p95_ms"]:
+                line += f"   p95 {((stats['p95_ms'] / base['p95_ms']) - 1) * 100:+.1f}% vs baseline"
+        print(line)
+        for sample in stats["error_samples"]:
+            print(f"    error: {sample}")
+    rss = report["rss"]
+    if rss["peak_mb"] is not None:
+        print(f"Server RSS: start {rss['start_mb']:.1f} MB, peak {rss['peak_mb']:.1f} MB, end {rss['end_mb']:.1f} MB")
+        # Coarse RSS timeline (up to 10 points)
+        samples = rss["samples"]
+        step = max(1, len(samples) // 10)
+        print("RSS over time: " + ", ".join(f"{t:.0f}s={v / 1048576:.1f}MB" for t, v in samples[::step]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the Stata MCP server (REST and MCP SSE)')
+    parser.add_argument('--url', type=str, default='http://localhost:4000', help='Base URL of a running server')
+    parser.add_argument('--spawn', action='store_true', help='Start a server with the fake backend for this run')
+    parser.add_argument('--port', type=int, default=0, help='Port for --spawn (default: a free port)')
+    parser.add_argument('--server-arg', action='append', default=[], help='Extra argument passed to the spawned server (repeatable)')
+    parser.add_argument('--server-pid', type=int, default=0, help='Server PID for RSS sampling via /proc (default: scrape /metrics)')
+    parser.add_argument('--fake-backend-options', type=str, default='latency=0.02,output_lines=10',
+                        help='Fake backend options for --spawn')
+    parser.add_argument('--clients', type=int, default=20, help='Concurrent virtual clients')
+    parser.add_argument('--duration', type=float, default=30, help='Test duration in seconds')
+    parser.add_argument('--mix', type=str, default=DEFAULT_MIX, help=f'Workload mix as op=weight pairs (default: {DEFAULT_MIX})')
+    parser.add_argument('--long-file-seconds', type=float, default=5, help='Approximate runtime of the long do-file')
+    parser.add_argument('--think-time', type=float, default=0.0, help='Max random pause between a client\'s requests')
+    parser.add_argument('--request-timeout', type=float, default=300, help='Per-request timeout in seconds')
+    parser.add_argument('--rss-interval', type=float, default=1.0, help='Seconds between server RSS samples')
+    parser.add_argument('--json', type=str, default='', help='Write the report to this JSON file')
+    parser.add_argument('--compare', type=str, default='', help='Baseline JSON report to compare p95 latencies against')
+    args = parser.parse_args()
+
+    process = spawn_server(args) if args.spawn else None
+    try:
+        short_file, long_file = write_workload_files(args.long_file_seconds)
+        print(f"Driving {args.clients} clients against {args.url} for {args.duration:.0f}s (mix: {args.mix})")
+        report = LoadGenerator(args, short_file, long_file).run()
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
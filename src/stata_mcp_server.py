@@ -18,7 +18,11 @@ import importlib.util
 import subprocess
 import traceback
 import socket
-from typing import Dict, Any, Optional
+import threading
+import asyncio
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional
 import warnings
 import re
 
@@ -38,6 +42,7 @@ if platform.system() == 'Windows':
 
 try:
     from fastapi import FastAPI, Request, Response
+    from fastapi.responses import JSONResponse
     from fastapi_mcp import FastApiMCP
     from pydantic import BaseModel, Field
 except ImportError as e:
@@ -92,6 +97,8 @@ stata_edition = 'mp'  # Default to MP edition
 log_file_location = 'extension'  # Default to extension directory
 custom_log_directory = ''  # Custom log directory
 extension_path = None  # Path to the extension directory
+# Run do-files block by block with preemption points unless a request says otherwise
+default_preemptible = False
 
 # Try to import pandas
 try:
@@ -103,6 +110,2417 @@ except ImportError:
     logging.warning("pandas not available, data transfer functionality will be limited")
     warnings.warn("pandas not available, data transfer functionality will be limited")
 
+# pyarrow is optional and only imported by the load_parquet tool
+has_pyarrow = importlib.util.find_spec("pyarrow") is not None
+
+# In-process metrics registry rendered in Prometheus text format by the /metrics endpoint
+# Updates are plain dict operations under a single lock so the hot path stays cheap
+metrics_lock = threading.Lock()
+metrics_counters = {}    # (name, labels) -> float
+metrics_gauges = {}      # (name, labels) -> float
+metrics_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0, 1800.0)
+METRICS_HELP = {
+    "stata_mcp_tool_requests_total": ("counter", "Tool requests handled, by tool and status"),
+    "stata_mcp_tool_request_duration_seconds": ("histogram", "End-to-end tool request latency"),
+    "stata_mcp_requests_in_flight": ("gauge", "Tool requests accepted and not yet answered"),
+    "stata_mcp_queue_depth": ("gauge", "Jobs waiting in the scheduler, by lane"),
+    "stata_mcp_queue_wait_seconds": ("histogram", "Time jobs spent queued before running, by lane"),
+    "stata_mcp_jobs_total": ("counter", "Jobs finished by the scheduler, by lane and status"),
+    "stata_mcp_preemptions_total": ("counter", "Higher-priority jobs run at a do-file preemption point"),
+    "stata_mcp_rejections_total": ("counter", "Jobs rejected by admission control, by lane and reason"),
+    "stata_mcp_coalesced_total": ("counter", "Requests attached to an identical in-flight job instead of running again"),
+    "stata_mcp_job_store_errors_total": ("counter", "Failed writes to the persistent job store"),
+    "stata_mcp_dataset_cache_requests_total": ("counter", "Dataset loads through the frame cache, by hit or miss"),
+    "stata_mcp_dataset_cache_evictions_total": ("counter", "Cached dataset frames dropped to stay within the memory budget"),
+    "stata_mcp_dataset_cache_bytes": ("gauge", "Estimated bytes of datasets held in cache frames"),
+    "stata_mcp_sweep_runs_total": ("counter", "Parameter sweep runs by final status"),
+    "stata_mcp_cluster_workers": ("gauge", "Worker servers registered with this coordinator, by state"),
+    "stata_mcp_cluster_routed_total": ("counter", "Tool requests forwarded to worker servers, by worker and kind"),
+    "stata_mcp_cluster_worker_losses_total": ("counter", "Workers dropped after missed heartbeats or failed requests"),
+    "stata_mcp_tenant_jobs_total": ("counter", "Jobs finished per tenant, by status"),
+    "stata_mcp_tenant_cpu_seconds_total": ("counter", "CPU-seconds charged to each tenant"),
+    "stata_mcp_tenant_rejections_total": ("counter", "Jobs rejected by a tenant's own limits, by tenant and reason"),
+    "stata_mcp_graph_exports_total": ("counter", "Graphs captured after do-file runs, by rendered, cached or failed"),
+    "stata_mcp_preflight_checks_total": ("counter", "Do-files checked before queueing, by passed or rejected"),
+    "stata_mcp_preflight_cache_hits_total": ("counter", "Pre-flight checks answered from the content-hash cache"),
+    "stata_mcp_stata_rss_bytes": ("gauge", "Resident memory of the process running Stata at the last job sample"),
+    "stata_mcp_stata_cpu_percent": ("gauge", "CPU use of the process running Stata at the last job sample"),
+    "stata_mcp_resource_limit_cancels_total": ("counter", "Jobs cancelled for exceeding the memory or CPU-time ceiling, by limit"),
+    "stata_mcp_cpu_partitions": ("gauge", "Stata processes currently sharing the CPUs"),
+    "stata_mcp_cpu_rebalances_total": ("counter", "Times the CPU shares were recomputed as jobs started or finished"),
+    "stata_mcp_bootstrap_runs_total": ("counter", "Bootstrap profile requests, by ran, reused (already applied) or failed"),
+    "stata_mcp_bootstrap_duration_seconds": ("histogram", "Time to run a bootstrap profile on a Stata instance"),
+    "stata_mcp_runtime_regressions_total": ("counter", "Do-file runs that took much longer than their earlier runs"),
+    "stata_mcp_server_profiles_total": ("counter", "Sampling profiles of the server's threads taken via /debug/profile"),
+    "stata_mcp_delta_responses_total": ("counter", "Delta output requests, by first, unchanged, delta or full response"),
+    "stata_mcp_delta_bytes_saved_total": ("counter", "Response bytes saved by returning a delta instead of the full output"),
+    "stata_mcp_scratch_bytes": ("gauge", "Bytes of temporary files in this process's scratch directory"),
+    "stata_mcp_scratch_files": ("gauge", "Temporary files in this process's scratch directory"),
+    "stata_mcp_scratch_reaped_files_total": ("counter", "Orphaned scratch files removed from dead server processes"),
+    "stata_mcp_queued_work_seconds": ("gauge", "Estimated seconds of work queued or still running"),
+    "stata_mcp_stata_run_duration_seconds": ("histogram", "Time spent inside stata.run"),
+    "stata_mcp_overhead_duration_seconds": ("histogram", "Time spent in the server outside stata.run"),
+    "stata_mcp_stata_init_total": ("counter", "Stata initialization attempts, by result"),
+    "stata_mcp_stata_init_duration_seconds": ("histogram", "Stata initialization duration"),
+    "stata_mcp_stata_reinit_total": ("counter", "Stata re-initializations after a failed command"),
+    "stata_mcp_log_bytes_read_total": ("counter", "Bytes read from Stata log files"),
+    "stata_mcp_timeouts_total": ("counter", "Do-file executions that hit their timeout"),
+    "stata_mcp_kills_total": ("counter", "Termination attempts after a timeout, by method"),
+    "stata_mcp_command_history_entries": ("gauge", "Entries in the in-memory command history"),
+    "stata_mcp_stata_available": ("gauge", "Whether Stata is initialized (1) or not (0)"),
+    "process_resident_memory_bytes": ("gauge", "Resident memory size of the server process"),
+    "process_cpu_seconds_total": ("counter", "User and system CPU time of the server process"),
+}
+
+def _metric_key(name, labels):
+    """Build the registry key for a metric name and optional label dict"""
+    if not labels:
+        return (name, ())
+    return (name, tuple(sorted(labels.items())))
+
+def metrics_inc(name, value=1.0, labels=None):
+    """Increment a counter"""
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        metrics_counters[key] = metrics_counters.get(key, 0.0) + value
+
+def metrics_set(name, value, labels=None):
+    """Set a gauge to the given value"""
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        metrics_gauges[key] = float(value)
+
+def metrics_add(name, value, labels=None):
+    """Add (or subtract) a value from a gauge"""
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        metrics_gauges[key] = metrics_gauges.get(key, 0.0) + value
+
+def metrics_observe(name, value, labels=None):
+    """Record an observation in a histogram"""
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        series = metrics_histograms.get(key)
+        if series is None:
+            series = [0] * len(METRICS_BUCKETS) + [0.0, 0]
+            metrics_histograms[key] = series
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+def _format_labels(labels, extra=None):
+    """Format a label tuple as a Prometheus label set"""
+    items = list(labels) + (list(extra) if extra else [])
+    if not items:
+        return ""
+    escaped = [f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in items]
+    return "{" + ",".join(escaped) + "}"
+
+def _collect_process_metrics():
+    """Refresh gauges that are only computed when /metrics is scraped"""
+    metrics_set("stata_mcp_command_history_entries", len(command_history))
+    metrics_set("stata_mcp_stata_available", 1 if stata_available else 0)
+    times = os.times()
+    with metrics_lock:
+        metrics_counters[("process_cpu_seconds_total", ())] = times.user + times.system
+    try:
+        # /proc is only available on Linux; other platforms simply skip the RSS gauge
+        with open("/proc/self/statm", "r") as f:
+            rss_pages = int(f.read().split()[1])
+        metrics_set("process_resident_memory_bytes", rss_pages * os.sysconf("SC_PAGE_SIZE"))
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+
+def render_metrics():
+    """Render all registered metrics in Prometheus text exposition format"""
+    _collect_process_metrics()
+    with metrics_lock:
+        counters = dict(metrics_counters)
+        gauges = dict(metrics_gauges)
+        histograms = {key: list(series) for key, series in metrics_histograms.items()}
+
+    # Group series by metric name so each name gets a single HELP/TYPE header
+    by_name = {}
+    for (name, labels), value in counters.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for (name, labels), value in gauges.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for (name, labels), series in histograms.items():
+        by_name.setdefault(name, []).append((labels, series))
+
+    lines = []
+    for name in sorted(by_name):
+        metric_type, help_text = METRICS_HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+            if metric_type == "histogram":
+                cumulative = 0
+                for i, bound in enumerate(METRICS_BUCKETS):
+                    cumulative += value[i]
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', repr(bound))])} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {value[-1]}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+@contextmanager
+def track_tool_request(tool):
+    """Track latency, outcome and in-flight count of a single tool request
+
+    Yields a dict whose "status" the caller may set to "error".
+    """
+    outcome = {"status": "success"}
+    request_start = time.perf_counter()
+    metrics_add("stata_mcp_requests_in_flight", 1)
+    try:
+        yield outcome
+    except Exception:
+        outcome["status"] = "error"
+        raise
+    finally:
+        metrics_add("stata_mcp_requests_in_flight", -1)
+        metrics_observe("stata_mcp_tool_request_duration_seconds", time.perf_counter() - request_start, {"tool": tool})
+        metrics_inc("stata_mcp_tool_requests_total", labels={"tool": tool, "status": outcome["status"]})
+
+# Per-phase timing spans for tool calls
+# Spans are collected per call on a trace that the scheduler activates on the thread running
+# the job, and optionally appended to a JSONL file of Chrome trace events (set with --trace-file)
+trace_file_path = None
+trace_file_lock = threading.Lock()
+_trace_local = threading.local()
+
+class PhaseTrace:
+    """Timing spans recorded for a single tool call"""
+
+    def __init__(self, name):
+        self.name = name
+        self.start_wall = time.time()
+        self.start_perf = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+
+    def add_span(self, name, perf_start, perf_end=None):
+        """Record a span that started at perf_start (a time.perf_counter value)"""
+        if perf_end is None:
+            perf_end = time.perf_counter()
+        self.spans.append({
+            "name": name,
+            "start_ms": round((perf_start - self.start_perf) * 1000, 3),
+            "duration_ms": round((perf_end - perf_start) * 1000, 3),
+            "tid": threading.get_ident(),
+        })
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start_perf
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            # Elapsed time so far when the call has not finished yet (e.g. when a job is stored)
+            "total_ms": round((self.duration if self.duration is not None
+                               else time.perf_counter() - self.start_perf) * 1000, 3),
+            "spans": [{k: v for k, v in span.items() if k != "tid"} for span in self.spans],
+        }
+
+    def server_timing_header(self):
+        """Format the spans as a Server-Timing header value"""
+        entries = [f"{span['name']};dur={span['duration_ms']}" for span in self.spans]
+        entries.append(f"total;dur={round((self.duration or 0.0) * 1000, 3)}")
+        return ", ".join(entries)
+
+    def trace_events(self):
+        """Convert the call and its spans to Chrome trace events (timestamps in microseconds)"""
+        base_us = self.start_wall * 1_000_000
+        events = [{
+            "name": self.name, "cat": "tool", "ph": "X", "pid": self.pid, "tid": self.tid,
+            "ts": round(base_us), "dur": round((self.duration or 0.0) * 1_000_000),
+        }]
+        for span in self.spans:
+            events.append({
+                "name": span["name"], "cat": self.name, "ph": "X", "pid": self.pid, "tid": span["tid"],
+                "ts": round(base_us + span["start_ms"] * 1000), "dur": round(span["duration_ms"] * 1000),
+            })
+        return events
+
+def current_trace():
+    """Return the trace active on this thread, if any"""
+    return getattr(_trace_local, "trace", None)
+
+def record_span(name, perf_start, trace=None):
+    """Record a span ending now on the given trace (or the thread's active trace)"""
+    trace = trace or current_trace()
+    if trace is not None:
+        trace.add_span(name, perf_start)
+
+def write_trace(trace):
+    """Append a finished trace to the JSONL trace file if one is configured"""
+    if not trace_file_path:
+        return
+    try:
+        lines = "".join(json.dumps(event) + "\n" for event in trace.trace_events())
+        with trace_file_lock:
+            with open(trace_file_path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+    except Exception as e:
+        logging.warning(f"Could not write trace file {trace_file_path}: {str(e)}")
+
+@contextmanager
+def request_trace(name):
+    """Create a PhaseTrace for a tool call and write it out when the call finishes"""
+    trace = PhaseTrace(name)
+    try:
+        yield trace
+    finally:
+        trace.finish()
+        write_trace(trace)
+
+@contextmanager
+def activate_trace(trace):
+    """Make a trace the active trace on this thread while a job runs"""
+    previous = current_trace()
+    _trace_local.trace = trace
+    try:
+        yield trace
+    finally:
+        _trace_local.trace = previous
+
+# Function to run a Stata command through the module-level stata object and time it
+def timed_stata_run(command, kind, trace=None):
+    """Run a command with stata.run and record the time spent inside Stata
+
+    Returns the number of seconds spent in stata.run.
+    """
+    run_start = time.perf_counter()
+    try:
+        stata_backend.run(command, echo=False)
+    finally:
+        run_seconds = time.perf_counter() - run_start
+        metrics_observe("stata_mcp_stata_run_duration_seconds", run_seconds, {"kind": kind})
+        record_span("stata_run", run_start, trace)
+    return run_seconds
+
+# Scratch area - temporary .do/.log files live in a per-process directory (tmpfs when available).
+# Files are tracked by the session (one per command or do-file run) that created them and removed
+# when it ends, directories left by dead server processes are reaped, and total size is capped.
+DEFAULT_SCRATCH_MAX_BYTES = 256 * 1024 * 1024
+
+class ScratchSpaceError(RuntimeError):
+    """Raised when the scratch area is over its size cap"""
+
+class ScratchArea:
+    """Bounded scratch directory for temporary files, tracked per session"""
+
+    def __init__(self, root=None, max_bytes=DEFAULT_SCRATCH_MAX_BYTES):
+        self.root = root or self.default_root()
+        self.max_bytes = max_bytes
+        self.directory = os.path.join(self.root, str(os.getpid()))
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.undeleted = set()  # files whose deletion failed (e.g. still open on Windows); retried later
+
+    @staticmethod
+    def default_root():
+        """Use tmpfs (/dev/shm) on Linux when writable, otherwise the system temp directory"""
+        if platform.system() == "Linux" and os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+            return os.path.join("/dev/shm", "stata_mcp_scratch")
+        return os.path.join(tempfile.gettempdir(), "stata_mcp_scratch")
+
+    def _sessions(self):
+        if not hasattr(self.local, "sessions"):
+            self.local.sessions = []
+        return self.local.sessions
+
+    @contextmanager
+    def session(self, label="job"):
+        """Track files created on this thread until the block exits, then delete them"""
+        files = {"label": label, "paths": []}
+        self._sessions().append(files)
+        try:
+            yield files
+        finally:
+            self._sessions().remove(files)
+            self._delete(files["paths"])
+
+    def new_file(self, suffix, prefix=None):
+        """Create an empty scratch file owned by the current session and return its path"""
+        sessions = self._sessions()
+        label = prefix or (sessions[-1]["label"] if sessions else "scratch")
+        os.makedirs(self.directory, exist_ok=True)
+        used_bytes, _ = self.usage()
+        if self.max_bytes and used_bytes >= self.max_bytes:
+            self._delete(list(self.undeleted))
+            used_bytes, _ = self.usage()
+            if used_bytes >= self.max_bytes:
+                raise ScratchSpaceError(f"Scratch area {self.directory} is full "
+                                        f"({used_bytes} bytes in use, limit {self.max_bytes})")
+        fd, path = tempfile.mkstemp(suffix=suffix, prefix=f"{label}_", dir=self.directory)
+        os.close(fd)
+        self.track(path)
+        return path
+
+    def track(self, path):
+        """Make the current session responsible for deleting path (e.g. a log Stata will write)"""
+        sessions = self._sessions()
+        if sessions:
+            sessions[-1]["paths"].append(path)
+        else:
+            # Without a session nobody would delete the file; remember it for the next cleanup
+            with self.lock:
+                self.undeleted.add(path)
+
+    def cleanup(self):
+        """Delete the current session's files now"""
+        sessions = self._sessions()
+        if sessions:
+            self._delete(sessions[-1]["paths"])
+            sessions[-1]["paths"] = []
+
+    def _delete(self, paths):
+        with self.lock:
+            pending = set(paths) | self.undeleted
+            self.undeleted = set()
+        failed = set()
+        for path in pending:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.debug(f"Could not delete scratch file {path}: {str(e)}")
+                failed.add(path)
+        with self.lock:
+            self.undeleted |= failed
+        self.usage()
+
+    def usage(self):
+        """Return (bytes, files) currently in this process's scratch directory and update the gauges"""
+        total_bytes = 0
+        total_files = 0
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    try:
+                        total_bytes += entry.stat().st_size
+                        total_files += 1
+                    except OSError:
+                        pass
+        except FileNotFoundError:
+            pass
+        metrics_set("stata_mcp_scratch_bytes", total_bytes)
+        metrics_set("stata_mcp_scratch_files", total_files)
+        return total_bytes, total_files
+
+    def reap_orphans(self, max_age=86400):
+        """Remove directories left by server processes that are no longer running"""
+        import shutil
+        reaped = 0
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            if not entry.is_dir() or entry.path == self.directory:
+                continue
+            if entry.name.isdigit() and platform.system() != "Windows":
+                try:
+                    os.kill(int(entry.name), 0)
+                    continue  # the owning process is still alive
+                except ProcessLookupError:
+                    pass
+                except PermissionError:
+                    continue
+            elif time.time() - entry.stat().st_mtime < max_age:
+                continue
+            reaped += sum(len(files) for _, _, files in os.walk(entry.path))
+            shutil.rmtree(entry.path, ignore_errors=True)
+        if reaped:
+            metrics_inc("stata_mcp_scratch_reaped_files_total", reaped)
+            logging.info(f"Reaped {reaped} orphaned scratch files from {self.root}")
+        return reaped
+
+scratch_area = ScratchArea()
+
+# Stata backends - everything that talks to Stata goes through the module-level stata_backend
+stata_backend = None
+
+class StataBackend:
+    """Interface between the server and a Stata runtime"""
+    name = "base"
+    bootstrap = None  # {"name", "fingerprint", "seconds", "applied_at"} of the last bootstrap profile run
+
+    def run(self, command, echo=False):
+        """Run a Stata command (usually `do "file"`), raising an exception if Stata reports an error"""
+        raise NotImplementedError
+
+    def capture_output(self, command):
+        """Run a command and return what Stata printed"""
+        import io
+        import contextlib
+        buffer = io.StringIO()
+        with contextlib.redirect_stdout(buffer):
+            self.run(command, echo=True)
+        return buffer.getvalue()
+
+    def cancel(self, force=False):
+        """Interrupt the running command; force=True kills the Stata process as a last resort"""
+        raise NotImplementedError
+
+    def process_id(self):
+        """Return the pid of the process running Stata, for resource sampling"""
+        return os.getpid()
+
+    def get_dataframe(self):
+        """Return the dataset in memory as a pandas DataFrame"""
+        raise NotImplementedError
+
+    def begin_dataset(self, variables):
+        """Clear the data and create empty variables ({"name", "type", "format"} dicts, Stata storage types)"""
+        raise NotImplementedError
+
+    def append_observations(self, variables, columns):
+        """Append observations; columns holds one list of values per variable (None is missing)"""
+        raise NotImplementedError
+
+    def widen_string(self, name, width):
+        """Make a string variable wide enough for width bytes (strL beyond str2045)"""
+        self.run(f"quietly recast {'strL' if width > 2045 else f'str{width}'} {name}", echo=False)
+
+    def list_graphs(self):
+        """Return (scheme, {name: {"stamp", "source", "command"}}) for the graphs in memory"""
+        manifest = scratch_area.new_file('.txt', prefix="graphs")
+        do_file = scratch_area.new_file('.do', prefix="graphs")
+        with open(do_file, 'w', encoding='utf-8') as f:
+            f.write(GRAPH_LIST_TEMPLATE.format(manifest=manifest))
+        self.run(f'run "{do_file}"', echo=False)
+        return parse_graph_manifest(manifest)
+
+    def graph_fingerprints(self, names):
+        """Return {name: hash} of graphs in memory as saved to .gph; graphs that cannot be saved are left out
+
+        A live .gph file holds the plotted data (its sersets) and every style setting, so graphs with
+        equal hashes look the same, whatever data is in memory after the run.
+        """
+        import hashlib
+        paths = {name: scratch_area.new_file('.gph', prefix="graphs") for name in names}
+        do_file = scratch_area.new_file('.do', prefix="graphs")
+        with open(do_file, 'w', encoding='utf-8') as f:
+            for name, path in paths.items():
+                f.write(f'capture quietly graph save {name} "{path}", replace\n')
+        self.run(f'run "{do_file}"', echo=False)
+        fingerprints = {}
+        for name, path in paths.items():
+            with open(path, 'rb') as f:
+                content = f.read()
+            if content:
+                fingerprints[name] = hashlib.sha256(GRAPH_VOLATILE_RE.sub(b"", content)).hexdigest()
+        return fingerprints
+
+    def export_graphs(self, exports):
+        """Export graphs in one Stata call; exports holds (name, path, format) tuples"""
+        do_file = scratch_area.new_file('.do', prefix="graphs")
+        with open(do_file, 'w', encoding='utf-8') as f:
+            for name, path, fmt in exports:
+                width = f" width({graph_export_width})" if fmt == "png" else ""
+                f.write(f'capture quietly graph export "{path}", name({name}) as({fmt}) replace{width}\n')
+        self.run(f'run "{do_file}"', echo=False)
+
+class PyStataBackend(StataBackend):
+    """Backend for an in-process Stata initialized through pystata (or sfi)"""
+    name = "pystata"
+
+    def __init__(self, module):
+        self.module = module
+
+    def run(self, command, echo=False):
+        self.module.run(command, echo=echo)
+
+    def cancel(self, force=False):
+        if not force:
+            self.module.run("break", echo=False)
+            return
+        # Find any Stata processes
+        if platform.system() == "Windows":
+            # Windows approach
+            subprocess.run(["taskkill", "/F", "/IM", "stata*.exe"], 
+                          stdout=subprocess.DEVNULL, 
+                          stderr=subprocess.DEVNULL)
+        else:
+            # macOS/Linux approach
+            subprocess.run(["pkill", "-f", "stata"], 
+                          stdout=subprocess.DEVNULL, 
+                          stderr=subprocess.DEVNULL)
+
+    def get_dataframe(self):
+        if not has_pandas:
+            raise RuntimeError("pandas is required for data access")
+        return self.module.pdataframe_from_data()
+
+    def begin_dataset(self, variables):
+        from sfi import Data
+        self.module.run("clear", echo=False)
+        add = {"byte": Data.addVarByte, "int": Data.addVarInt, "long": Data.addVarLong,
+               "float": Data.addVarFloat, "double": Data.addVarDouble, "strL": Data.addVarStrL}
+        for var in variables:
+            if var["type"] in add:
+                add[var["type"]](var["name"])
+            else:
+                Data.addVarStr(var["name"], int(var["type"][3:]))
+            if var.get("format"):
+                Data.setVarFormat(var["name"], var["format"])
+
+    def append_observations(self, variables, columns):
+        from sfi import Data, Missing
+        count = len(columns[0]) if columns else 0
+        start = Data.getObsTotal()
+        Data.addObs(count)
+        observations = range(start, start + count)
+        for var, values in zip(variables, columns):
+            if var["type"].startswith("str"):
+                values = ["" if value is None else value for value in values]
+            else:
+                values = [Missing.getValue() if value is None else value for value in values]
+            Data.store(var["name"], observations, values)
+
+class FakeStataBackend(StataBackend):
+    """Stand-in for Stata that interprets do-files just enough to write realistic logs
+
+    Options (all optional):
+        latency: seconds to wait per executed command
+        output_lines: synthetic output lines for commands the fake does not interpret
+        failure_rate: probability (0-1) that a run() call fails
+        failure_mode: exception | stata_error | no_log | hang
+        dataset_rows: observations loaded by use/sysuse
+    """
+    name = "fake"
+
+    def __init__(self, latency=0.0, output_lines=3, failure_rate=0.0, failure_mode="exception", dataset_rows=74, seed=None):
+        import random
+        self.latency = float(latency)
+        self.output_lines = int(output_lines)
+        self.failure_rate = float(failure_rate)
+        self.failure_mode = failure_mode
+        self.dataset_rows = int(dataset_rows)
+        self.random = random.Random(seed)
+        self.cancel_event = threading.Event()
+        self.log_handle = None
+        self.suppress_log = False
+        self.fail_pending = False
+        self.data = pd.DataFrame() if has_pandas else None
+        self.run_count = 0
+        self.silent_depth = 0  # > 0 while inside `run`, which executes without output
+        self.graphs = {}  # name -> {"stamp", "source", "command"} for graph commands seen
+        self.globals = {}
+        self.timers = {}  # timer number -> [seconds, calls, started (perf_counter) or None]
+
+    @classmethod
+    def from_options(cls, options):
+        """Build a fake backend from a "key=value,key=value" option string"""
+        kwargs = {}
+        for item in (options or "").split(","):
+            if "=" in item:
+                key, value = item.split("=", 1)
+                kwargs[key.strip()] = value.strip()
+        return cls(**kwargs)
+
+    def run(self, command, echo=False):
+        self.run_count += 1
+        self.cancel_event.clear()
+        mode = None
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            mode = self.failure_mode
+            if mode == "exception":
+                raise SystemError("Fake backend failure")
+            if mode == "hang":
+                self.cancel_event.wait()
+                raise SystemError("--Break--")
+        self.suppress_log = (mode == "no_log")
+        self.fail_pending = (mode == "stata_error")
+        self._execute_lines([command])
+
+    def cancel(self, force=False):
+        self.cancel_event.set()
+
+    def get_dataframe(self):
+        if self.data is None:
+            raise RuntimeError("pandas is required for data access")
+        return self.data.copy()
+
+    def begin_dataset(self, variables):
+        self.data = pd.DataFrame({var["name"]: [] for var in variables})
+
+    def append_observations(self, variables, columns):
+        batch = pd.DataFrame({var["name"]: values for var, values in zip(variables, columns)})
+        self.data = batch if self.data.empty else pd.concat([self.data, batch], ignore_index=True)
+
+    def widen_string(self, name, width):
+        pass
+
+    def _data_signature(self):
+        if self.data is None:
+            return ""
+        return f"{len(self.data)}:{','.join(map(str, self.data.columns))}"
+
+    def list_graphs(self):
+        return "s2color", {name: {k: graph[k] for k in ("stamp", "source", "command")}
+                                        for name, graph in self.graphs.items()}
+
+    def graph_fingerprints(self, names):
+        import hashlib
+        return {name: hashlib.sha256(f"{self.graphs[name]['command']}\n{self.graphs[name]['data']}".encode('utf-8'))
+                .hexdigest() for name in names if name in self.graphs}
+
+    def export_graphs(self, exports):
+        for name, path, fmt in exports:
+            graph = self.graphs.get(name)
+            if graph is None:
+                continue
+            self._wait(self.latency)
+            if fmt == "svg":
+                content = (f'<svg xmlns="http://www.w3.org/2000/svg" width="400" height="300">'
+                           f'<text x="10" y="20">{graph["command"]}</text></svg>').encode('utf-8')
+            elif fmt == "png":
+                content = FAKE_PNG
+            else:
+                content = graph["command"].encode('utf-8')
+            with open(path, 'wb') as f:
+                f.write(content)
+
+    def _update_graphs(self, line):
+        line = re.sub(r'^(?:(?:quietly|qui|capture|cap)\s+)+', '', line, flags=re.IGNORECASE)
+        match = re.match(r'^graph\s+drop\s+(.*)$', line, re.IGNORECASE)
+        if match:
+            names = match.group(1).split()
+            if "_all" in names:
+                self.graphs.clear()
+            for name in names:
+                self.graphs.pop(name, None)
+            return
+        if FAKE_GRAPH_COMMAND_RE.match(line):
+            match = re.search(r'\bname\((\w+)', line)
+            self.graphs[match.group(1) if match else "Graph"] = {
+                "stamp": str(time.time_ns()), "source": "", "command": line, "data": self._data_signature()}
+
+    def _write(self, text):
+        if self.log_handle is not None and not self.silent_depth:
+            self.log_handle.write(text + "\n")
+            self.log_handle.flush()
+
+    def _wait(self, seconds):
+        if seconds > 0 and self.cancel_event.wait(seconds):
+            self._write("--Break--\nr(1);")
+            raise SystemError("--Break--")
+
+    def _execute_file(self, path):
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            content = f.read()
+        # Join /// continuation lines the way Stata does
+        content = re.sub(r'\s*///[^\n]*\n', ' ', content)
+        self._execute_lines(content.splitlines())
+        self._write("\nend of do-file")
+
+    def _execute_lines(self, lines):
+        for raw_line in lines:
+            line = raw_line.strip()
+            self._write(f". {line}" if line else ".")
+            if not line or line.startswith('*') or line.startswith('//'):
+                continue
+            lowered = line.lower()
+            match = re.match(r'^(?:capture\s+)?log\s+using\s+(?:"([^"]+)"|(\S+?))(?:\s*,\s*(.*))?$', line, re.IGNORECASE)
+            if match:
+                if not self.suppress_log:
+                    self._open_log(match.group(1) or match.group(2), (match.group(3) or "").lower())
+                continue
+            if re.match(r'^(?:capture\s+)?log\s+close', lowered):
+                self._close_log()
+                continue
+            match = re.match(r'^(do|run)\s+(?:"([^"]+)"|(\S+))', line, re.IGNORECASE)
+            if match:
+                silent = match.group(1).lower() == "run"
+                self.silent_depth += silent
+                try:
+                    self._execute_file(match.group(2) or match.group(3))
+                finally:
+                    self.silent_depth -= silent
+                continue
+            if self._update_state(line):
+                continue
+            self._wait(self.latency)
+            if self.fail_pending:
+                self.fail_pending = False
+                self._write("unrecognized command\nr(198);")
+                raise SystemError("r(198);")
+            match = re.match(r'^(?:error|exit)\s+(\d+)', lowered)
+            if match and match.group(1) != "0":
+                self._write(f"r({match.group(1)});")
+                raise SystemError(f"r({match.group(1)});")
+            match = re.match(r'^sleep\s+(\d+)', lowered)
+            if match:
+                self._wait(int(match.group(1)) / 1000.0)
+                continue
+            match = re.match(r'^(?:di|dis|disp|displ|displa|display)\s+(.*)$', line, re.IGNORECASE)
+            if match:
+                self._write(self._display(match.group(1)))
+                continue
+            self._update_graphs(line)
+            self._update_data(line)
+            for i in range(self.output_lines):
+                self._write(f"    {i + 1:>6}  {'fake output for: ' + line[:40]:<60}")
+
+    def _update_state(self, line):
+        """Emulate globals, adopath, timers and the profiler's _mcp_prof_off; True if the line was handled"""
+        line = re.sub(r'^(?:(?:quietly|qui|capture|cap)\s+)+', '', line, flags=re.IGNORECASE)
+        match = re.match(r'^global\s+(\w+)\s+"([^"]*)"\s*$', line)
+        if match:
+            self.globals[match.group(1)] = match.group(2)
+            return True
+        match = re.match(r'^macro\s+drop\s+(.*)$', line)
+        if match:
+            for name in match.group(1).split():
+                self.globals.pop(name, None)
+            return True
+        if re.match(r'^adopath\s', line):
+            return True
+        words = line.split("//")[0].split()
+        if len(words) == 3 and words[0] == "timer" and words[1] in ("on", "off", "clear") and words[2].isdigit():
+            timer = self.timers.setdefault(int(words[2]), [0.0, 0, None])
+            if words[1] == "on":
+                timer[2] = time.perf_counter()
+            elif words[1] == "off" and timer[2] is not None:
+                timer[0] += time.perf_counter() - timer[2]
+                timer[1] += 1
+                timer[2] = None
+            elif words[1] == "clear":
+                self.timers.pop(int(words[2]), None)
+            return True
+        if words and words[0] == "_mcp_prof_off":
+            self._update_state(f"timer off {words[1]}")
+            with open(self.globals["MCP_PROFILE_FILE"], 'a') as f:
+                for timer, line_number in [(words[1], words[2])] + [pair.split(":") for pair in words[3:]]:
+                    seconds, calls, _ = self.timers.pop(int(timer), [0.0, 0, None])
+                    f.write(f"{line_number}\t{seconds:.6f}\t{calls}\n")
+            return True
+        return False
+
+    def _display(self, expression):
+        expression = expression.strip()
+        if len(expression) >= 2 and expression[0] == '"' and expression[-1] == '"':
+            return expression[1:-1]
+        if re.match(r'^[\d\s\.\+\-\*/\(\)]+$', expression):
+            try:
+                return str(eval(expression, {"__builtins__": {}}, {}))
+            except Exception:
+                pass
+        return expression
+
+    def _update_data(self, line):
+        if not has_pandas:
+            return
+        line = re.sub(r'^(?:(?:quietly|qui|capture|cap)\s+)+', '', line, flags=re.IGNORECASE)
+        lowered = line.lower()
+        # save/use of a .dta path keep the fake dataset on disk (pickled), e.g. for checkpoints
+        match = re.match(r'^file\s+open\s+\S+\s+using\s+"([^"]+)"\s*,\s*write', line, re.IGNORECASE)
+        if match:
+            open(match.group(1), 'w').close()
+            return
+        match = re.match(r'^(save|use)\s+"([^"]+)"', line, re.IGNORECASE)
+        if match and match.group(1).lower() == "save":
+            self.data.to_pickle(match.group(2))
+            return
+        if match and os.path.exists(match.group(2)):
+            try:
+                self.data = pd.read_pickle(match.group(2))
+                return
+            except Exception:
+                pass  # not written by the fake (e.g. a real .dta); load the synthetic dataset below
+        if re.match(r'^(?:sysuse|use|webuse)\b', lowered):
+            rows = self.dataset_rows
+            self.data = pd.DataFrame({"id": range(rows), "x": [i * 0.5 for i in range(rows)]})
+        elif re.match(r'^clear\b', lowered):
+            self.data = pd.DataFrame()
+        else:
+            match = re.match(r'^set\s+obs\s+(\d+)', lowered)
+            if match:
+                self.data = self.data.reindex(range(int(match.group(1))))
+                return
+            match = re.match(r'^(?:gen|generate)\s+(?:\w+\s+)?(\w+)\s*=', lowered)
+            if match:
+                self.data[match.group(1)] = 0.0
+
+    def _open_log(self, path, options):
+        self._close_log()
+        self.log_handle = open(path, 'a' if 'append' in options else 'w', encoding='utf-8')
+        self._write("-" * 79)
+        self._write("      name:  <unnamed>")
+        self._write(f"       log:  {path}")
+        self._write("  log type:  text")
+        self._write(f" opened on:  {time.strftime('%d %b %Y, %H:%M:%S')}")
+
+    def _close_log(self):
+        if self.log_handle is not None:
+            self._write("-" * 79)
+            self._write("      name:  <unnamed>")
+            self._write(f" closed on:  {time.strftime('%d %b %Y, %H:%M:%S')}")
+            self._write("-" * 79)
+            self.log_handle.close()
+            self.log_handle = None
+
+# Commands the fake backend treats as drawing a graph
+FAKE_GRAPH_COMMAND_RE = re.compile(r'^(?:graph\s+(?:twoway|tw|bar|hbar|box|hbox|pie|dot|matrix|combine)|twoway|tw|'
+                                   r'scatter|sc|line|histogram|hist|kdensity|lowess|binscatter|coefplot|marginsplot)\b',
+                                   re.IGNORECASE)
+# 1x1 transparent PNG written by the fake backend's graph export
+FAKE_PNG = bytes.fromhex("89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+                         "1f15c4890000000d49444154789c63000100000500010d0a2db40000000049454e44ae426082")
+
+# Function to use the fake backend instead of a real Stata installation
+def init_fake_backend(options=""):
+    """Install a FakeStataBackend as the module-level backend"""
+    global stata_backend, stata, has_stata, stata_available
+    stata_backend = FakeStataBackend.from_options(options)
+    stata = stata_backend
+    has_stata = True
+    stata_available = True
+    logging.info(f"Using fake Stata backend ({options or 'default options'})")
+    return stata_backend
+
+# Stata host process - Stata runs in a long-lived process and the API server talks to it over a
+# local socket, so restarting the API server (extension reload, --force-port) keeps Stata initialized
+# and its data in memory. Requests are JSON lines carrying a token read from a file only the user can read.
+DEFAULT_STATA_HOST_ADDRESS = "127.0.0.1:4001"
+STATA_HOST_CONNECT_TIMEOUT = 5.0
+STATA_HOST_CONNECT_ATTEMPTS = 3  # failed connections before a new host is started
+stata_host_args = []  # backend arguments for host processes started by this server (set in main)
+stata_host_log_dir = None  # where host processes write their logs and token files
+stata_host_launch = None  # connect_stata_host arguments of the remote backend's host (set by init_remote_backend)
+
+# Function to split a host:port address
+def parse_host_address(address):
+    host, _, port = address.rpartition(':')
+    return (host or "127.0.0.1", int(port))
+
+class RemoteStataBackend(StataBackend):
+    """Backend that forwards calls to a Stata host process (see serve_stata_host)"""
+    name = "remote"
+
+    def __init__(self, address, token):
+        self.address = parse_host_address(address)
+        self.token = token
+
+    def _call(self, op, **params):
+        """Send one request on a fresh connection and return the response payload"""
+        request = dict(params, op=op, token=self.token)
+        with socket.create_connection(self.address, timeout=STATA_HOST_CONNECT_TIMEOUT) as conn:
+            conn.settimeout(None)  # Stata commands can run for as long as the caller allows
+            conn.sendall((json.dumps(request) + "\n").encode('utf-8'))
+            line = conn.makefile('r', encoding='utf-8').readline()
+        if not line:
+            raise ConnectionError("Stata host closed the connection")
+        response = json.loads(line)
+        if not response.get("ok"):
+            # Stata errors keep their type so callers can tell them from host failures
+            if response.get("error_type") == "SystemError":
+                raise SystemError(response.get("error"))
+            raise RuntimeError(f"Stata host error ({response.get('error_type')}): {response.get('error')}")
+        return response.get("result")
+
+    def run(self, command, echo=False):
+        self._call("run", command=command, echo=echo)
+
+    def capture_output(self, command):
+        return self._call("capture_output", command=command)
+
+    def cancel(self, force=False):
+        self._call("cancel", force=force)
+
+    def process_id(self):
+        # Only a host on this machine can be sampled through /proc
+        if self.address[0] not in ("127.0.0.1", "localhost", "::1"):
+            return None
+        # A restarted host has a new pid, so the cached one is only kept while that process exists
+        pid = getattr(self, "host_pid", None)
+        if pid is None or not os.path.exists(f"/proc/{pid}"):
+            pid = self.host_pid = self.info()["pid"]
+        return pid
+
+    def get_dataframe(self):
+        import io
+        if not has_pandas:
+            raise RuntimeError("pandas is required for data access")
+        return pd.read_json(io.StringIO(self._call("get_dataframe")), orient="split")
+
+    def begin_dataset(self, variables):
+        self._call("begin_dataset", variables=variables)
+
+    def append_observations(self, variables, columns):
+        self._call("append_observations", variables=variables, columns=columns)
+
+    def widen_string(self, name, width):
+        self._call("widen_string", name=name, width=width)
+
+    def info(self):
+        return self._call("info")
+
+# Function to read the host token, creating it if needed
+def load_host_token(token_file, create=False):
+    """Return the shared token for the Stata host, or None if it does not exist yet"""
+    import secrets
+    if os.path.exists(token_file):
+        with open(token_file, 'r') as f:
+            return f.read().strip()
+    if not create:
+        return None
+    token = secrets.token_hex(16)
+    fd = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+# Function to run this process as the Stata host
+def serve_stata_host(address, token_file):
+    """Serve the module-level stata_backend on address until the process is stopped"""
+    import hmac
+    import socketserver
+    token = load_host_token(token_file, create=True)
+    run_lock = threading.Lock()  # Stata is not thread-safe; only cancel bypasses the lock
+    started_at = time.time()
+    stats = {"requests": 0}
+
+    def handle(request):
+        op = request.get("op")
+        if op == "ping":
+            return "pong"
+        if op == "info":
+            return {"backend": stata_backend.name, "pid": os.getpid(), "started_at": started_at,
+                    "requests": stats["requests"], "stata_available": stata_available}
+        if op == "cancel":
+            stata_backend.cancel(force=bool(request.get("force")))
+            return None
+        with run_lock:
+            if op == "run":
+                stata_backend.run(request["command"], echo=bool(request.get("echo")))
+                return None
+            if op == "capture_output":
+                return stata_backend.capture_output(request["command"])
+            if op == "get_dataframe":
+                return stata_backend.get_dataframe().to_json(orient="split")
+            if op == "begin_dataset":
+                return stata_backend.begin_dataset(request["variables"])
+            if op == "append_observations":
+                return stata_backend.append_observations(request["variables"], request["columns"])
+            if op == "widen_string":
+                return stata_backend.widen_string(request["name"], int(request["width"]))
+        raise ValueError(f"Unknown operation: {op}")
+
+    class HostHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(line)
+                if not hmac.compare_digest(str(request.get("token", "")), token):
+                    raise PermissionError("Invalid Stata host token")
+                stats["requests"] += 1
+                response = {"ok": True, "result": handle(request)}
+            except Exception as e:
+                response = {"ok": False, "error_type": type(e).__name__, "error": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+
+    class HostServer(socketserver.ThreadingTCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    with HostServer(parse_host_address(address), HostHandler) as server:
+        logging.info(f"Stata host ({stata_backend.name}) listening on {address}, pid {os.getpid()}")
+        server.serve_forever()
+
+# Function to start a detached Stata host process
+def spawn_stata_host(address, host_args, log_file, token_file):
+    """Launch the host in its own session so it outlives this API server"""
+    command = [sys.executable, os.path.abspath(__file__), '--stata-host', '--stata-host-address', address,
+               '--log-file', log_file, '--stata-host-token-file', token_file] + host_args
+    kwargs = {}
+    if platform.system() == "Windows":
+        kwargs["creationflags"] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+    logging.info(f"Starting Stata host: {' '.join(command)}")
+    return subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            **kwargs)
+
+# Function to check whether something accepts connections on a host address
+def host_address_in_use(address):
+    try:
+        with socket.create_connection(parse_host_address(address), timeout=STATA_HOST_CONNECT_TIMEOUT):
+            return True
+    except OSError:
+        return False
+
+# Function to connect to a Stata host, starting it if needed
+def connect_stata_host(address, token_file, host_args, host_log_file, startup_timeout=120):
+    """Return (backend, info, spawned) for the host on address, or None if it could not be started
+
+    A host is only started when nothing listens on address. If the port belongs to a process that
+    rejects the token (another host, or another program), this fails at once instead of waiting.
+    """
+    process = None
+    failures = 0
+    deadline = time.time() + startup_timeout
+    while True:
+        token = load_host_token(token_file)
+        if token:
+            backend = RemoteStataBackend(address, token)
+            try:
+                info = backend.info()
+                break
+            except (RuntimeError, ValueError) as e:
+                # Something answered, but not as a host holding this token
+                logging.error(f"{address} is in use by a process that is not the Stata host for {token_file} "
+                              f"({str(e)}); stop it or choose another --stata-host-address")
+                return None
+            except OSError as e:
+                failures += 1
+                logging.debug(f"Stata host not ready at {address}: {str(e)}")
+        if process is None and (not token or failures >= STATA_HOST_CONNECT_ATTEMPTS):
+            if host_address_in_use(address):
+                logging.error(f"{address} is in use by a process that is not a Stata host reachable with "
+                              f"{token_file}; stop it or choose another --stata-host-address")
+                return None
+            # A stale token from a dead host would be rejected by the new one
+            if os.path.exists(token_file):
+                os.remove(token_file)
+            process = spawn_stata_host(address, host_args, host_log_file, token_file)
+        elif process is not None and process.poll() is not None:
+            logging.error(f"Stata host exited with code {process.returncode} while starting; see {host_log_file}")
+            return None
+        if time.time() > deadline:
+            logging.error(f"Stata host did not start on {address} within {startup_timeout} seconds")
+            return None
+        time.sleep(0.2)
+    return backend, info, process is not None
+
+# Function to attach to (or start) the Stata host
+def init_remote_backend(address, token_file, host_args, host_log_file, startup_timeout=120):
+    """Install a RemoteStataBackend, spawning the host if none is listening on address"""
+    global stata_backend, stata, has_stata, stata_available, stata_host_launch
+    stata_host_launch = (address, token_file, host_args, host_log_file, startup_timeout)
+    connected = connect_stata_host(address, token_file, host_args, host_log_file, startup_timeout)
+    if connected is None:
+        return None
+    backend, info, spawned = connected
+    stata_backend = backend
+    stata = backend
+    has_stata = True
+    stata_available = bool(info.get("stata_available"))
+    logging.info(f"{'Started' if spawned else 'Attached to'} Stata host on {address} "
+                 f"(backend {info.get('backend')}, pid {info.get('pid')}, up {time.time() - info.get('started_at', time.time()):.0f}s)")
+    return backend
+
+# Function to start the Stata host again after it was killed
+def restart_stata_host():
+    """Reconnect the remote backend to a freshly started host; Stata is marked unavailable if it does not start"""
+    global stata_available
+    if stata_host_launch is None or not isinstance(stata_backend, RemoteStataBackend):
+        return False
+    logging.warning(f"Restarting the Stata host on {stata_host_launch[0]}")
+    connected = connect_stata_host(*stata_host_launch)
+    if connected is None:
+        stata_available = False
+        logging.error("The Stata host could not be restarted; Stata is unavailable until the server restarts")
+        return False
+    fresh, info, _ = connected
+    stata_backend.token = fresh.token
+    stata_backend.bootstrap = None  # a restarted host has lost the previous setup
+    stata_available = bool(info.get("stata_available"))
+    bootstrap_new_backend(stata_backend)
+    return stata_available
+
+# Multi-tenant mode - with --tenants-file, every request must carry a tenant's local token. Jobs
+# carry their tenant: admission applies per-tenant limits, each lane serves tenants by weighted fair
+# share of their recent usage, and each tenant gets its own Stata frame and command history.
+tenants = {}  # token -> Tenant; empty in single-user mode
+_tenant_context = contextvars.ContextVar("stata_mcp_tenant", default=None)
+TENANT_USAGE_HALF_LIFE = 600.0  # seconds after which past usage counts half for fair share
+TENANT_CPU_WINDOW = 3600.0  # window of the cpu_seconds_per_hour limit
+TENANT_OPEN_PATHS = ("/health", "/metrics", "/docs", "/openapi.json",
+                     "/cluster/register", "/cluster/heartbeat", "/cluster/deregister")  # cluster token instead
+
+class Tenant:
+    """A client of a shared server with its limits and usage (guarded by the scheduler's condition)"""
+
+    def __init__(self, name, token, weight=1.0, max_jobs=0, max_queued_work=0.0, cpu_seconds_per_hour=0.0,
+                 admin=False):
+        import collections
+        self.name = name
+        self.token = token
+        self.weight = max(0.01, float(weight))
+        # Limits (0 disables a limit)
+        self.max_jobs = int(max_jobs)
+        self.max_queued_work = float(max_queued_work)
+        self.cpu_seconds_per_hour = float(cpu_seconds_per_hour)
+        self.admin = bool(admin)
+        self.frame = "mcp_tenant_" + re.sub(r'\W', '_', name)[:20]
+        self.usage = 0.0  # decayed CPU-seconds, for fair share
+        self.usage_updated = time.time()
+        self.cost_log = collections.deque()  # (finished_at, cpu_seconds) within TENANT_CPU_WINDOW
+        self.cpu_seconds_total = 0.0
+        self.jobs_finished = 0
+        self.jobs_failed = 0
+        self.jobs_rejected = 0
+        self.command_history = []
+
+    def decayed_usage(self, now=None):
+        now = time.time() if now is None else now
+        return self.usage * 0.5 ** (max(0.0, now - self.usage_updated) / TENANT_USAGE_HALF_LIFE)
+
+    def share(self):
+        """Recent usage per unit of weight; the scheduler serves the lowest first"""
+        return self.decayed_usage() / self.weight
+
+    def charge(self, cpu_seconds, failed=False):
+        now = time.time()
+        self.usage = self.decayed_usage(now) + cpu_seconds
+        self.usage_updated = now
+        self.cost_log.append((now, cpu_seconds))
+        self.cpu_seconds_total += cpu_seconds
+        self.jobs_finished += 1
+        self.jobs_failed += failed
+        metrics_inc("stata_mcp_tenant_cpu_seconds_total", cpu_seconds, {"tenant": self.name})
+        metrics_inc("stata_mcp_tenant_jobs_total", labels={"tenant": self.name, "status": "failed" if failed else "done"})
+
+    def window_cpu_seconds(self, now=None):
+        """CPU-seconds charged within the last TENANT_CPU_WINDOW"""
+        now = time.time() if now is None else now
+        while self.cost_log and self.cost_log[0][0] < now - TENANT_CPU_WINDOW:
+            self.cost_log.popleft()
+        return sum(cost for _, cost in self.cost_log)
+
+    def cpu_retry_after(self, now=None):
+        """Seconds until enough usage leaves the window to get back under cpu_seconds_per_hour"""
+        now = time.time() if now is None else now
+        excess = self.window_cpu_seconds(now) - self.cpu_seconds_per_hour
+        for finished_at, cost in self.cost_log:
+            excess -= cost
+            if excess < 0:
+                return max(1.0, finished_at + TENANT_CPU_WINDOW - now)
+        return 1.0
+
+    def to_dict(self):
+        return {
+            "tenant": self.name,
+            "weight": self.weight,
+            "limits": {"max_jobs": self.max_jobs, "max_queued_work": self.max_queued_work,
+                       "cpu_seconds_per_hour": self.cpu_seconds_per_hour},
+            "cpu_seconds_last_hour": round(self.window_cpu_seconds(), 3),
+            "cpu_seconds_total": round(self.cpu_seconds_total, 3),
+            "fair_share_usage": round(self.decayed_usage(), 3),
+            "jobs_finished": self.jobs_finished,
+            "jobs_failed": self.jobs_failed,
+            "jobs_rejected": self.jobs_rejected,
+        }
+
+# Function to load tenants from a JSON file
+def load_tenants(path):
+    """Read {"tenants": [{"name", "token", "weight", "max_jobs", "max_queued_work", "cpu_seconds_per_hour", "admin"}]}
+
+    Tenants without a token get a generated one, written back to the file (readable by its owner only).
+    Returns a dict of token -> Tenant; raises ValueError for an invalid file.
+    """
+    import secrets
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    entries = config.get("tenants", []) if isinstance(config, dict) else config
+    loaded, names, generated = {}, set(), False
+    for entry in entries:
+        name = str(entry.get("name") or "").strip()
+        if not name or name in names:
+            raise ValueError(f"Tenant names must be unique and non-empty: {name!r}")
+        names.add(name)
+        if not entry.get("token"):
+            entry["token"] = secrets.token_urlsafe(24)
+            generated = True
+        loaded[entry["token"]] = Tenant(name, entry["token"], weight=entry.get("weight", 1.0),
+                                        max_jobs=entry.get("max_jobs", 0),
+                                        max_queued_work=entry.get("max_queued_work", 0.0),
+                                        cpu_seconds_per_hour=entry.get("cpu_seconds_per_hour", 0.0),
+                                        admin=entry.get("admin", False))
+    if not loaded:
+        raise ValueError(f"No tenants defined in {path}")
+    if generated:
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=2)
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, path)
+        logging.info(f"Generated tokens for new tenants in {path}")
+    return loaded
+
+# Function to find the tenant a token belongs to
+def tenant_for_token(token):
+    import hmac
+    for known, tenant in tenants.items():
+        if hmac.compare_digest(known, token):
+            return tenant
+    return None
+
+def current_tenant():
+    """Return the tenant of the request being handled, or None in single-user mode"""
+    return _tenant_context.get()
+
+# Function to run a job with its tenant's command history and Stata frame
+@contextmanager
+def tenant_session(tenant, outer=None):
+    """Swap in the tenant's history and data frame; outer is the tenant of a job this one preempted"""
+    global command_history
+    if tenant is None:
+        yield
+        return
+    previous_history = command_history
+    command_history = tenant.command_history
+    try:
+        if stata_available and stata_backend is not None:
+            try:
+                # `clear all` drops frames, so create the frame whenever it is missing
+                stata_backend.run(f"capture frame create {tenant.frame}", echo=False)
+                stata_backend.run(f"frame change {tenant.frame}", echo=False)
+            except Exception as e:
+                logging.warning(f"Could not switch to the frame of tenant {tenant.name} (frames need Stata 16+): {str(e)}")
+        yield
+    finally:
+        tenant.command_history = command_history
+        command_history = previous_history
+        if outer is not None and outer is not tenant and stata_available and stata_backend is not None:
+            try:
+                stata_backend.run(f"frame change {outer.frame}", echo=False)
+            except Exception as e:
+                logging.warning(f"Could not switch back to the frame of tenant {outer.name}: {str(e)}")
+
+# Job scheduling
+# All Stata work runs on one scheduler worker thread, fed from priority lanes. Lanes are served
+# by weighted round robin so interactive selections jump ahead without starving batch work.
+SCHEDULER_LANES = ("interactive", "normal", "batch")
+DEFAULT_LANE_WEIGHTS = {"interactive": 8, "normal": 2, "batch": 1}
+_job_local = threading.local()
+# Work estimates used by admission control (seconds)
+SELECTION_WORK_ESTIMATE = 1.0
+file_work_estimate = 60.0
+
+class QueueFullError(Exception):
+    """Raised when admission control rejects a job; retry_after is a hint in seconds"""
+
+    def __init__(self, message, reason, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+# Runtime history - finished do-file runs in the job store predict the next run of the same file:
+# the median of recent clean runs of the same content, or of the same path when the content is new.
+# Predictions replace the flat file estimate in admission control, order the queue with
+# --shortest-job-first, give ETAs and timeout suggestions, and flag runs much slower than usual.
+RUNTIME_HISTORY_RUNS = 10  # clean runs a prediction is based on
+RUNTIME_REGRESSION_FACTOR = 2.0
+RUNTIME_REGRESSION_MIN_SECONDS = 10.0  # ignore slowdowns smaller than this
+RUNTIME_REGRESSION_MIN_RUNS = 3
+TIMEOUT_SUGGESTION_FACTOR = 3.0  # suggested timeout: this many times the slowest recent clean run
+shortest_job_first = False
+
+# Function to predict a do-file's run time from its earlier runs
+def predict_runtime(file_path, content_hash):
+    """Return {"seconds", "max_seconds", "output_bytes", "runs", "failures", "basis", "suggested_timeout"} or None
+
+    seconds is the median of the recent clean runs (return code 0), basis is "content" when they
+    ran the same content and "path" when only the same file path. failures counts recent runs of
+    that basis that failed or stopped with a Stata error.
+    """
+    import statistics
+    if job_store is None or not file_path:
+        return None
+    history = job_store.runtime_history(file_path, content_hash, RUNTIME_HISTORY_RUNS * 3)
+    for basis, runs in (("content", [run for run in history if content_hash and run["content_hash"] == content_hash]),
+                        ("path", [run for run in history if run["file_path"] == file_path])):
+        runs = runs[:RUNTIME_HISTORY_RUNS * 2]
+        clean = [run for run in runs if run["status"] == "done" and run["return_code"] == 0][:RUNTIME_HISTORY_RUNS]
+        if not clean:
+            continue
+        seconds = [run["run_seconds"] for run in clean]
+        output_bytes = [run["output_bytes"] for run in clean if run["output_bytes"] is not None]
+        return {"seconds": round(statistics.median(seconds), 3), "max_seconds": round(max(seconds), 3),
+                "output_bytes": int(statistics.median(output_bytes)) if output_bytes else None,
+                "runs": len(clean), "failures": len(runs) - len(clean), "basis": basis,
+                "suggested_timeout": suggest_timeout(max(seconds))}
+    return None
+
+# Function to suggest a timeout for a do-file whose slowest recent run took max_seconds
+def suggest_timeout(max_seconds):
+    """TIMEOUT_SUGGESTION_FACTOR times the slowest run, rounded up to whole minutes (at least one)"""
+    import math
+    return int(60 * max(1, math.ceil(max_seconds * TIMEOUT_SUGGESTION_FACTOR / 60)))
+
+# Function to describe a running job's expected remaining time
+def runtime_eta_line(job):
+    prediction = job.prediction
+    remaining = prediction["seconds"] - job.run_seconds
+    if remaining >= 0:
+        return f"ETA: about {remaining:.0f}s left (typical run {prediction['seconds']:.0f}s over {prediction['runs']} earlier runs)"
+    return (f"ETA: {-remaining:.0f}s past the typical {prediction['seconds']:.0f}s of {prediction['runs']} earlier runs "
+            f"(slowest {prediction['max_seconds']:.0f}s)")
+
+# Function to check a finished do-file run against its prediction
+def runtime_regression(job):
+    """Return an alert when the run took much longer than the runs it was predicted from, else None"""
+    prediction = job.prediction
+    if prediction is None or prediction["runs"] < RUNTIME_REGRESSION_MIN_RUNS:
+        return None
+    seconds, typical = job.run_seconds, prediction["seconds"]
+    if seconds < typical * RUNTIME_REGRESSION_FACTOR or seconds - typical < RUNTIME_REGRESSION_MIN_SECONDS:
+        return None
+    metrics_inc("stata_mcp_runtime_regressions_total")
+    logging.warning(f"Runtime regression: {job.description} took {seconds:.1f}s, typically {typical:.1f}s "
+                    f"over {prediction['runs']} runs of the same {prediction['basis']}")
+    return (f"SLOWER THAN USUAL: this run took {seconds:.0f}s, {seconds / max(typical, 0.001):.1f}x the typical "
+            f"{typical:.0f}s of {prediction['runs']} earlier runs")
+
+# Function to estimate how long a job will occupy Stata
+def estimate_job_seconds(kind):
+    """Return the estimated run time of a job for admission control when it has no run history"""
+    if kind == "selection":
+        return SELECTION_WORK_ESTIMATE
+    return file_work_estimate
+
+class StataJob:
+    """A unit of Stata work queued on the scheduler"""
+
+    def __init__(self, kind, func, args, kwargs, lane, description="", trace=None, estimated_seconds=0.0):
+        import uuid
+        import concurrent.futures
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.estimated_seconds = estimated_seconds
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.lane = lane
+        self.description = description
+        self.trace = trace
+        self.future = concurrent.futures.Future()
+        self.status = "queued"
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.dedupe_key = None
+        self.attached = 0  # identical requests sharing this job's result
+        self.tenant = None
+        self.cpu_seconds = 0.0  # charged to the tenant once the job finishes
+        self.resource_monitor = None  # samples the Stata process while the job runs
+        self.resources = None  # resource summary once the job finishes
+        self.profile = None  # ranked command timings of a profiled do-file run
+        self.bootstrap = None  # bootstrap profile the job needs
+        self.prediction = None  # runtime prediction from earlier runs of the same do-file (predict_runtime)
+        self.preempted_seconds = 0.0  # time spent running other jobs at this job's preemption points
+
+    @property
+    def queue_wait_seconds(self):
+        end = self.started_at if self.started_at is not None else time.time()
+        return end - self.submitted_at
+
+    @property
+    def run_seconds(self):
+        """Time the job itself ran, without the jobs that ran at its preemption points"""
+        if self.started_at is None:
+            return 0.0
+        end = self.finished_at if self.finished_at is not None else time.time()
+        return max(0.0, end - self.started_at - self.preempted_seconds)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "lane": self.lane,
+            "status": self.status,
+            "description": self.description,
+            "submitted_at": self.submitted_at,
+            "queue_wait_seconds": round(self.queue_wait_seconds, 3),
+            "run_seconds": round(self.run_seconds, 3),
+            "preempted_seconds": round(self.preempted_seconds, 3),
+            "estimated_seconds": round(self.estimated_seconds, 3),
+            "attached_requests": self.attached,
+            "tenant": self.tenant.name if self.tenant is not None else None,
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "resources": self.resource_summary(),
+            "prediction": self.prediction,
+            "eta_seconds": (round(max(0.0, self.prediction["seconds"] - self.run_seconds), 1)
+                            if self.prediction is not None and self.status in ("queued", "running") else None),
+        }
+
+    def resource_summary(self):
+        """Resource usage without the sample series: final once finished, live while running"""
+        summary = self.resources
+        if summary is None and self.resource_monitor is not None:
+            summary = self.resource_monitor.summary()
+        if summary is None:
+            return None
+        return {key: value for key, value in summary.items() if key != "samples"}
+
+class StataScheduler:
+    """Serializes Stata jobs on a worker thread with priority lanes"""
+
+    def __init__(self, lane_weights=None, max_queue_length=0, max_queued_work=0.0):
+        import collections
+        self.lane_weights = dict(lane_weights or DEFAULT_LANE_WEIGHTS)
+        # Admission limits (0 disables a limit)
+        self.max_queue_length = max_queue_length
+        self.max_queued_work = max_queued_work
+        self.lanes = {lane: collections.deque() for lane in SCHEDULER_LANES}
+        self.credits = dict(self.lane_weights)
+        self.condition = threading.Condition()
+        self.running = []  # jobs currently executing (more than one while a job is preempted)
+        self.inflight = {}  # dedupe key -> queued or running job
+        self.external = []  # placeholders for tenants' work running elsewhere (cluster workers, sweep workers)
+        self.worker = None
+        self.cpu_charged = 0.0  # total charged to jobs, so a preempted job is not charged for the jobs it let run
+
+    def start(self):
+        with self.condition:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._worker_loop, name="stata-scheduler", daemon=True)
+                self.worker.start()
+
+    def submit(self, kind, func, *args, lane="normal", description="", trace=None, estimated_seconds=None,
+               dedupe_key=None, bootstrap=None, prediction=None, **kwargs):
+        """Queue func(*args, **kwargs) and return the StataJob (wait on job.future)
+
+        If dedupe_key matches a queued or running job, that job is returned instead and the
+        caller shares its result. Raises QueueFullError when admission limits would be exceeded.
+        bootstrap names a bootstrap profile that is run first if Stata does not have it yet.
+        prediction (from predict_runtime) sets the estimate when estimated_seconds is not given.
+        """
+        if lane not in self.lanes:
+            raise ValueError(f"Unknown scheduler lane: {lane}")
+        if estimated_seconds is None:
+            estimated_seconds = prediction["seconds"] if prediction is not None else estimate_job_seconds(kind)
+        job = StataJob(kind, func, args, kwargs, lane, description, trace, estimated_seconds)
+        job.tenant = current_tenant()
+        job.bootstrap = bootstrap
+        job.prediction = prediction
+        if job.tenant is not None and dedupe_key is not None:
+            # Tenants do not share each other's jobs
+            dedupe_key = dedupe_key + (job.tenant.name,)
+        job.dedupe_key = dedupe_key
+        self.start()
+        with self.condition:
+            existing = self.inflight.get(dedupe_key) if dedupe_key is not None else None
+            if existing is not None:
+                existing.attached += 1
+                metrics_inc("stata_mcp_coalesced_total", labels={"kind": kind})
+                logging.info(f"Attached identical {kind} request to in-flight job {existing.id} ({existing.status})")
+                return existing
+            self._admit(job)
+            if dedupe_key is not None:
+                self.inflight[dedupe_key] = job
+            self.lanes[lane].append(job)
+            metrics_set("stata_mcp_queue_depth", len(self.lanes[lane]), {"lane": lane})
+            metrics_set("stata_mcp_queued_work_seconds", self._queued_work())
+            self.condition.notify()
+        if job_store is not None:
+            job_store.record_submitted(job)
+        logging.debug(f"Queued job {job.id} ({kind}) in lane {lane}")
+        return job
+
+    def _queued_work(self):
+        """Estimated seconds of queued work plus the remainder of running jobs (caller holds the condition)"""
+        queued = sum(job.estimated_seconds for lane in SCHEDULER_LANES for job in self.lanes[lane])
+        running = sum(max(0.0, job.estimated_seconds - job.run_seconds) for job in self.running)
+        return queued + running
+
+    def tenant_jobs(self, tenant):
+        """Queued, running and external jobs of a tenant (caller holds the condition)"""
+        return [job for lane in SCHEDULER_LANES for job in self.lanes[lane] if job.tenant is tenant] + \
+               [job for job in self.running + self.external if job.tenant is tenant]
+
+    def admit_external(self, kind, lane, description="", estimated_seconds=None):
+        """Apply the tenant's limits to work that runs outside this scheduler (a request a coordinator
+        forwards to a worker, a sweep on the sweep workers)
+
+        Returns a placeholder job that counts as running for the tenant until finish_external, or None
+        in single-user mode. Raises QueueFullError like submit.
+        """
+        tenant = current_tenant()
+        if tenant is None:
+            return None
+        if estimated_seconds is None:
+            estimated_seconds = estimate_job_seconds(kind)
+        job = StataJob(kind, None, (), {}, lane, description, None, estimated_seconds)
+        job.tenant = tenant
+        with self.condition:
+            self._admit(job, tenant_only=True)
+            job.status = "running"
+            job.started_at = time.time()
+            self.external.append(job)
+        return job
+
+    def finish_external(self, job, failed=False, ran=True, seconds=None):
+        """Release a placeholder and charge its tenant seconds (default: the wall time; other processes' CPU
+        is not visible here)"""
+        if job is None:
+            return
+        job.finished_at = time.time()
+        with self.condition:
+            self.external.remove(job)
+            if ran:
+                job.tenant.charge(job.run_seconds if seconds is None else seconds, failed=failed)
+
+    def _admit(self, job, tenant_only=False):
+        """Apply admission limits to a new job (caller holds the condition)
+
+        With tenant_only, only the tenant's limits apply (the job does not join this server's queue).
+        """
+        import math
+        queue_length = sum(len(self.lanes[lane]) for lane in SCHEDULER_LANES)
+        queued_work = self._queued_work()
+        running_remaining = sum(max(0.0, j.estimated_seconds - j.run_seconds) for j in self.running)
+        tenant = job.tenant
+        tenant_jobs = self.tenant_jobs(tenant) if tenant is not None else []
+        tenant_work = sum(max(0.0, j.estimated_seconds - j.run_seconds) for j in tenant_jobs)
+        if self.max_queue_length and not tenant_only and queue_length >= self.max_queue_length:
+            reason = "queue_length"
+            message = f"Stata queue is full ({queue_length} jobs waiting, limit {self.max_queue_length})"
+            retry_after = max(1, math.ceil(running_remaining or SELECTION_WORK_ESTIMATE))
+        elif self.max_queued_work and not tenant_only and queued_work + job.estimated_seconds > self.max_queued_work:
+            reason = "queued_work"
+            message = (f"Stata queue is saturated ({queued_work:.0f}s of estimated work queued, "
+                       f"limit {self.max_queued_work:.0f}s)")
+            retry_after = max(1, math.ceil(queued_work + job.estimated_seconds - self.max_queued_work))
+        elif tenant is not None and tenant.max_jobs and len(tenant_jobs) >= tenant.max_jobs:
+            reason = "tenant_jobs"
+            message = f"Tenant {tenant.name} has {len(tenant_jobs)} jobs queued or running (limit {tenant.max_jobs})"
+            retry_after = max(1, math.ceil(min(max(0.0, j.estimated_seconds - j.run_seconds) for j in tenant_jobs)
+                                           or SELECTION_WORK_ESTIMATE))
+        elif tenant is not None and tenant.max_queued_work and tenant_work + job.estimated_seconds > tenant.max_queued_work:
+            reason = "tenant_queued_work"
+            message = (f"Tenant {tenant.name} has {tenant_work:.0f}s of estimated work queued "
+                       f"(limit {tenant.max_queued_work:.0f}s)")
+            retry_after = max(1, math.ceil(tenant_work + job.estimated_seconds - tenant.max_queued_work))
+        elif tenant is not None and tenant.cpu_seconds_per_hour and \
+                tenant.window_cpu_seconds() >= tenant.cpu_seconds_per_hour:
+            reason = "tenant_cpu"
+            message = (f"Tenant {tenant.name} used {tenant.window_cpu_seconds():.0f} CPU-seconds in the last hour "
+                       f"(limit {tenant.cpu_seconds_per_hour:.0f})")
+            retry_after = math.ceil(tenant.cpu_retry_after())
+        else:
+            return
+        if reason.startswith("tenant_"):
+            tenant.jobs_rejected += 1
+            metrics_inc("stata_mcp_tenant_rejections_total", labels={"tenant": tenant.name, "reason": reason})
+        metrics_inc("stata_mcp_rejections_total", labels={"lane": job.lane, "reason": reason})
+        logging.warning(f"Rejected {job.kind} job: {message}")
+        raise QueueFullError(message, reason, retry_after)
+
+    def queued_jobs(self):
+        with self.condition:
+            return [job for lane in SCHEDULER_LANES for job in self.lanes[lane]]
+
+    def snapshot(self, tenant=None):
+        """Describe running and queued jobs for the /jobs/queue endpoint (only tenant's jobs if given)"""
+        def visible(job):
+            return tenant is None or job.tenant is tenant
+        with self.condition:
+            # Start estimates assume lanes are served in priority order; weights and shortest-job-first reorder them
+            ahead = sum(max(0.0, job.estimated_seconds - job.run_seconds) for job in self.running)
+            queued = {}
+            for lane in SCHEDULER_LANES:
+                queued[lane] = []
+                for job in self.lanes[lane]:
+                    if visible(job):
+                        queued[lane].append(dict(job.to_dict(), estimated_start_seconds=round(ahead, 1)))
+                    ahead += job.estimated_seconds
+            return {
+                "running": [job.to_dict() for job in self.running if visible(job)],
+                "queued": queued,
+                "lane_weights": dict(self.lane_weights),
+                "queued_work_seconds": round(self._queued_work(), 3),
+                "limits": {"max_queue_length": self.max_queue_length, "max_queued_work": self.max_queued_work},
+            }
+
+    def _pop_next(self, min_priority=None):
+        """Pick the next job by weighted round robin (caller holds the condition)
+
+        With min_priority set, only lanes strictly ahead of that lane are considered.
+        """
+        lanes = SCHEDULER_LANES if min_priority is None else SCHEDULER_LANES[:SCHEDULER_LANES.index(min_priority)]
+        waiting = [lane for lane in lanes if self.lanes[lane]]
+        if not waiting:
+            return None
+        # Refill credits once every waiting lane has used its share
+        if all(self.credits[lane] <= 0 for lane in waiting):
+            for lane in SCHEDULER_LANES:
+                self.credits[lane] = self.lane_weights.get(lane, 1)
+        lane = next((lane for lane in waiting if self.credits[lane] > 0), waiting[0])
+        self.credits[lane] -= 1
+        queue = self.lanes[lane]
+        if tenants or shortest_job_first:
+            job = min(queue, key=self._queue_order)
+            queue.remove(job)
+        else:
+            job = queue.popleft()
+        metrics_set("stata_mcp_queue_depth", len(self.lanes[lane]), {"lane": lane})
+        metrics_set("stata_mcp_queued_work_seconds", self._queued_work())
+        return job
+
+    @staticmethod
+    def _queue_order(job):
+        """Sort key within a lane: weighted fair share of the tenant (the least recent usage per unit of
+        weight goes first), then with shortest-job-first the highest response ratio (wait + estimate) /
+        estimate, so short jobs go first and long jobs still move up as they wait"""
+        share = job.tenant.share() if tenants and job.tenant is not None else 0.0
+        if not shortest_job_first:
+            return (share, 0.0)
+        estimate = max(job.estimated_seconds, 1.0)
+        return (share, -(job.queue_wait_seconds + estimate) / estimate)
+
+    def _worker_loop(self):
+        while True:
+            with self.condition:
+                job = self._pop_next()
+                while job is None:
+                    self.condition.wait()
+                    job = self._pop_next()
+            self._run_job(job)
+
+    def _run_job(self, job):
+        if not job.future.set_running_or_notify_cancel():
+            return
+        job.started_at = time.time()
+        job.status = "running"
+        metrics_observe("stata_mcp_queue_wait_seconds", job.queue_wait_seconds, {"lane": job.lane})
+        if job.trace is not None:
+            job.trace.add_span("queue_wait", job.trace.start_perf + (job.submitted_at - job.trace.start_wall),
+                               job.trace.start_perf + (job.started_at - job.trace.start_wall))
+        with self.condition:
+            self.running.append(job)
+        if job_store is not None:
+            job_store.record_started(job)
+        previous_job = current_job()
+        _job_local.job = job
+        # An in-process Stata is charged CPU time; the remote host's CPU (and the fake's simulated work) is
+        # not visible here, so those backends are charged wall time
+        clock = time.process_time if isinstance(stata_backend, PyStataBackend) else time.perf_counter
+        cost_start = clock()
+        charged_before = self.cpu_charged
+        job.resource_monitor = start_resource_monitor(job)
+        cpu_share = acquire_cpu_share("main", stata_backend) if stata_backend is not None else False
+        result = error = None
+        try:
+            try:
+                with activate_trace(job.trace), tenant_session(job.tenant, previous_job.tenant if previous_job else None):
+                    result = None
+                    if job.bootstrap:
+                        try:
+                            ensure_bootstrap(stata_backend, job.bootstrap)
+                        except BootstrapError as e:
+                            result = f"Error: {str(e)}"
+                    if result is None:
+                        result = job.func(*job.args, **job.kwargs)
+            finally:
+                if job.resource_monitor is not None:
+                    job.resources = job.resource_monitor.stop()
+                    if job.resource_monitor.killed:
+                        # Start the host again before the next job needs it
+                        restart_stata_host()
+            if job.resources and job.resources["limit_exceeded"] and job.kind in ("file", "selection"):
+                result += f"\n*** RESOURCE LIMIT: {job.resources['limit_exceeded']}; the job was cancelled ***\n"
+            if job.kind == "file" and job.prediction is not None:
+                alert = runtime_regression(job)
+                if alert:
+                    result += f"\n*** {alert} ***\n"
+            job.status = "done"
+        except BaseException as e:
+            job.status = "failed"
+            error = e
+            logging.error(f"Job {job.id} ({job.kind}) failed: {str(e)}")
+        finally:
+            if cpu_share:
+                cpu_allocator.release("main")
+            job.finished_at = time.time()
+            _job_local.job = previous_job
+            job.cpu_seconds = max(0.0, clock() - cost_start - (self.cpu_charged - charged_before))
+            self.cpu_charged += job.cpu_seconds
+            with self.condition:
+                if job.tenant is not None:
+                    job.tenant.charge(job.cpu_seconds, failed=job.status != "done")
+                self.running.remove(job)
+                if job.dedupe_key is not None and self.inflight.get(job.dedupe_key) is job:
+                    del self.inflight[job.dedupe_key]
+            metrics_inc("stata_mcp_jobs_total", labels={"lane": job.lane, "status": job.status})
+            # The finished record is written before the future resolves, so a caller that gets the
+            # result can also read the job from the store
+            if job_store is not None:
+                if job.status == "done":
+                    job_store.record_finished(job, output=result)
+                else:
+                    job_store.record_finished(job, error=str(error))
+            if job.status == "done":
+                job.future.set_result(result)
+            else:
+                job.future.set_exception(error)
+
+    def preemption_point(self, job):
+        """Run queued jobs from lanes ahead of job's lane before it continues
+
+        Called between do-file blocks. Returns the seconds spent on other jobs.
+        """
+        if job is None:
+            return 0.0
+        paused_at = time.perf_counter()
+        ran = 0
+        # Usage while other jobs run is theirs, not this job's
+        if job.resource_monitor is not None:
+            job.resource_monitor.paused = True
+        # Preemption points are reached on the do-file's own thread, where job is not yet the current job;
+        # making it current lets each preempting job switch back to job's tenant frame when it finishes
+        previous_job = current_job()
+        _job_local.job = job
+        try:
+            while True:
+                with self.condition:
+                    next_job = self._pop_next(min_priority=job.lane)
+                if next_job is None:
+                    break
+                logging.info(f"Job {job.id} paused at a preemption point for job {next_job.id} ({next_job.lane})")
+                metrics_inc("stata_mcp_preemptions_total")
+                self._run_job(next_job)
+                ran += 1
+        finally:
+            _job_local.job = previous_job
+        if job.resource_monitor is not None:
+            job.resource_monitor.sample()
+            job.resource_monitor.paused = False
+        if not ran:
+            return 0.0
+        paused = time.perf_counter() - paused_at
+        job.preempted_seconds += paused
+        return paused
+
+def current_job():
+    """Return the scheduler job running on this thread, if any"""
+    return getattr(_job_local, "job", None)
+
+# Resource telemetry - while a job runs, RSS, CPU and I/O of the process running Stata are sampled
+# from /proc (Linux only). Peaks go into the job record; jobs over the memory or CPU-time ceiling
+# are cancelled with a Stata break (and, for a separate host process, killed if the break is ignored).
+resource_sample_interval = 1.0  # seconds; 0 disables sampling
+max_job_rss_bytes = 0  # 0 means no memory ceiling
+max_job_cpu_seconds = 0.0  # 0 means no CPU-time ceiling
+RESOURCE_MAX_SAMPLES = 120  # per job; older samples are thinned to half resolution when full
+RESOURCE_KILL_GRACE = 10.0  # seconds a break may take before a host process is killed
+has_proc = os.path.isdir("/proc/self")
+
+# Function to format a byte count for progress updates
+def format_bytes(value):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(value) < 1024 or unit == "GB":
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024.0
+
+# Function to read the counters of a process from /proc
+def read_process_counters(pid):
+    """Return (rss bytes, cpu seconds, read bytes, write bytes) for pid; I/O is None if /proc/<pid>/io is unreadable"""
+    with open(f"/proc/{pid}/stat", "r") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    with open(f"/proc/{pid}/statm", "r") as f:
+        rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    read_bytes = write_bytes = None
+    try:
+        with open(f"/proc/{pid}/io", "r") as f:
+            io = dict(line.split(":", 1) for line in f.read().splitlines() if ":" in line)
+        read_bytes, write_bytes = int(io["read_bytes"]), int(io["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        pass
+    return rss, cpu_seconds, read_bytes, write_bytes
+
+class ResourceMonitor:
+    """Samples the Stata process while one job runs and enforces the memory and CPU-time ceilings"""
+
+    def __init__(self, job, pid, interval, max_rss_bytes=0, max_cpu_seconds=0.0):
+        self.job = job
+        self.pid = pid
+        self.interval = interval
+        self.max_rss_bytes = max_rss_bytes
+        self.max_cpu_seconds = max_cpu_seconds
+        self.started_at = time.time()
+        self.samples = []  # [seconds since start, rss, cpu %, read bytes, write bytes]
+        self.start_rss = None  # the memory ceiling applies to growth from here, not to data from earlier jobs
+        self.peak_rss = 0
+        self.cpu_seconds = 0.0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.violation = None
+        self.violated_at = None
+        self.killed = False  # the host process was killed and has to be started again
+        self.paused = False  # set while other jobs run at a preemption point
+        self.baseline = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.sample()
+        self.thread = threading.Thread(target=self._loop, name=f"resources-{self.job.id}", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.interval + 1)
+        self.sample()
+        return self.summary()
+
+    def _loop(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.sample()
+                self.enforce()
+            except Exception as e:
+                logging.debug(f"Resource sampling of pid {self.pid} failed: {str(e)}")
+
+    def sample(self):
+        """Read the process counters and record one sample; deltas are not counted while paused"""
+        try:
+            rss, cpu, read_bytes, write_bytes = read_process_counters(self.pid)
+        except (OSError, ValueError, IndexError):
+            return None
+        now = time.time()
+        cpu_percent = 0.0
+        if self.baseline is not None and not self.paused:
+            last_at, last_cpu, last_read, last_write = self.baseline
+            self.cpu_seconds += max(0.0, cpu - last_cpu)
+            if read_bytes is not None and last_read is not None:
+                self.read_bytes += max(0, read_bytes - last_read)
+                self.write_bytes += max(0, write_bytes - last_write)
+            if now > last_at:
+                cpu_percent = max(0.0, cpu - last_cpu) / (now - last_at) * 100
+        self.baseline = (now, cpu, read_bytes, write_bytes)
+        if self.paused:
+            return None
+        if self.start_rss is None:
+            self.start_rss = rss
+        self.peak_rss = max(self.peak_rss, rss)
+        if len(self.samples) >= RESOURCE_MAX_SAMPLES:
+            self.samples = self.samples[::2]
+        self.samples.append([round(now - self.started_at, 2), rss, round(cpu_percent, 1), self.read_bytes,
+                             self.write_bytes])
+        metrics_set("stata_mcp_stata_rss_bytes", rss)
+        metrics_set("stata_mcp_stata_cpu_percent", cpu_percent)
+        return self.samples[-1]
+
+    def enforce(self):
+        """Cancel the job once it exceeds a ceiling; escalate to killing a host process that ignores the break"""
+        if self.paused or not self.samples:
+            return
+        if self.violation is None:
+            rss = self.samples[-1][1]
+            if self.max_rss_bytes and rss - self.start_rss > self.max_rss_bytes:
+                self.violation = (f"memory: RSS grew by {format_bytes(rss - self.start_rss)} to {format_bytes(rss)}, "
+                                  f"over the {format_bytes(self.max_rss_bytes)} limit")
+                limit = "memory"
+            elif self.max_cpu_seconds and self.cpu_seconds > self.max_cpu_seconds:
+                self.violation = (f"CPU time: {self.cpu_seconds:.0f} CPU-seconds exceeded the "
+                                  f"{self.max_cpu_seconds:.0f} second limit")
+                limit = "cpu"
+            else:
+                return
+            self.violated_at = time.time()
+            logging.warning(f"Job {self.job.id} over its resource limit ({self.violation}); cancelling it")
+            metrics_inc("stata_mcp_resource_limit_cancels_total", labels={"limit": limit})
+            stata_backend.cancel()
+        elif (self.violated_at is not None and time.time() - self.violated_at > RESOURCE_KILL_GRACE
+              and self.pid != os.getpid()):
+            logging.warning(f"Job {self.job.id} ignored the break; killing the Stata host process {self.pid}")
+            self.violated_at = None
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+                self.killed = True
+            except OSError as e:
+                logging.error(f"Could not kill the Stata host process {self.pid}: {str(e)}")
+
+    def progress_line(self):
+        """One line describing current usage, for progress updates"""
+        if not self.samples:
+            return ""
+        _, rss, cpu_percent, read_bytes, write_bytes = self.samples[-1]
+        line = f"Resources: RSS {format_bytes(rss)} (peak {format_bytes(self.peak_rss)}), CPU {cpu_percent:.0f}%"
+        if has_proc and os.path.exists(f"/proc/{self.pid}/io"):
+            line += f", read {format_bytes(read_bytes)}, written {format_bytes(write_bytes)}"
+        return line
+
+    def summary(self):
+        elapsed = max(1e-9, time.time() - self.started_at)
+        return {
+            "pid": self.pid,
+            "peak_rss_bytes": self.peak_rss,
+            "process_cpu_seconds": round(self.cpu_seconds, 3),
+            "mean_cpu_percent": round(self.cpu_seconds / elapsed * 100, 1),
+            "read_bytes": self.read_bytes,
+            "write_bytes": self.write_bytes,
+            "limit_exceeded": self.violation,
+            "samples": list(self.samples),
+        }
+
+# Function to start resource sampling for a job
+def start_resource_monitor(job):
+    """Return a running ResourceMonitor for job, or None when sampling is off or the process is not visible"""
+    if not has_proc or resource_sample_interval <= 0:
+        return None
+    try:
+        pid = stata_backend.process_id() if stata_backend is not None else os.getpid()
+    except Exception as e:
+        logging.debug(f"Stata process id not available: {str(e)}")
+        return None
+    if not pid or not os.path.exists(f"/proc/{pid}/stat"):
+        return None
+    return ResourceMonitor(job, pid, resource_sample_interval, max_job_rss_bytes, max_job_cpu_seconds).start()
+
+# CPU partitioning - the CPUs this server may use are split among the Stata processes with active
+# jobs (the scheduler's Stata and busy sweep workers), so concurrent Stata/MP jobs do not oversubscribe
+# the machine. Shares are whole physical cores where possible (hyperthread siblings stay together),
+# every thread of a process is pinned to its share, and a job starts with a matching `set processors`.
+# Shares are recomputed whenever a process starts its first job or finishes its last one.
+cpu_allocator = None  # CpuAllocator, set in main (Linux only)
+
+# Function to group CPUs into physical cores
+def cpu_topology(cpus):
+    """Return lists of CPU ids sharing a physical core, ordered by package and core"""
+    cores = {}
+    for cpu in sorted(cpus):
+        topology = f"/sys/devices/system/cpu/cpu{cpu}/topology"
+        try:
+            with open(f"{topology}/physical_package_id", "r") as f:
+                package = int(f.read())
+            with open(f"{topology}/core_id", "r") as f:
+                key = (package, int(f.read()))
+        except (OSError, ValueError):
+            key = (-1, cpu)  # topology not visible (containers, non-Linux): treat each CPU as a core
+        cores.setdefault(key, []).append(cpu)
+    return [cores[key] for key in sorted(cores)]
+
+# Function to pin every thread of a process to a set of CPUs
+def pin_process(pid, cpus):
+    """Set the CPU affinity of all threads of pid; returns the number of threads pinned"""
+    pinned = 0
+    try:
+        threads = [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+    except OSError:
+        threads = [pid]
+    for tid in threads:
+        try:
+            os.sched_setaffinity(tid, cpus)
+            pinned += 1
+        except OSError:
+            pass  # the thread exited in the meantime
+    return pinned
+
+class CpuAllocator:
+    """Splits the server's CPUs among the Stata processes that are running jobs"""
+
+    def __init__(self, cpus=None):
+        self.cpus = sorted(cpus if cpus is not None else os.sched_getaffinity(0))
+        self.cores = cpu_topology(self.cpus)
+        self.active = {}  # holder -> {"pid", "jobs", "cpus"}; insertion order is share order
+        self.processors_set = {}  # pid -> processors last passed to `set processors`
+        self.lock = threading.Lock()
+
+    def partition(self, count):
+        """Split the CPUs into count contiguous shares of whole cores (of single CPUs when cores run out)"""
+        units = self.cores if count <= len(self.cores) else [[cpu] for core in self.cores for cpu in core]
+        if count > len(units):
+            return [units[i % len(units)] for i in range(count)]
+        shares, start = [], 0
+        for i in range(count):
+            size = len(units) // count + (1 if i < len(units) % count else 0)
+            shares.append(sorted(cpu for unit in units[start:start + size] for cpu in unit))
+            start += size
+        return shares
+
+    def _rebalance(self):
+        shares = self.partition(len(self.active)) if self.active else []
+        for entry, share in zip(self.active.values(), shares):
+            if share != entry["cpus"]:
+                entry["cpus"] = share
+                pin_process(entry["pid"], share)
+        metrics_set("stata_mcp_cpu_partitions", len(self.active))
+        metrics_inc("stata_mcp_cpu_rebalances_total")
+        logging.debug("CPU shares: " + ", ".join(f"{holder}={entry['cpus']}" for holder, entry in self.active.items()))
+
+    def acquire(self, holder, pid):
+        """Register a job of holder's Stata process (pid); return a `set processors` command to run, or None"""
+        with self.lock:
+            entry = self.active.setdefault(holder, {"pid": pid, "jobs": 0, "cpus": None})
+            entry["jobs"] += 1
+            if entry["pid"] != pid or entry["jobs"] == 1:
+                entry["pid"], entry["cpus"] = pid, None
+                self._rebalance()
+            count = len(entry["cpus"])
+            # Stata uses all the cores it may by default, so a full share needs no command until one was sent
+            last = self.processors_set.get(pid)
+            if last == count or (last is None and count == len(self.cpus)):
+                return None
+            self.processors_set[pid] = count
+        return f"capture set processors `=min({count}, c(processors_max))'"
+
+    def release(self, holder):
+        """A job of holder finished; the CPUs are redistributed once its process has no jobs left"""
+        with self.lock:
+            entry = self.active.get(holder)
+            if entry is None:
+                return
+            entry["jobs"] -= 1
+            if entry["jobs"] <= 0:
+                del self.active[holder]
+                self._rebalance()
+
+    def snapshot(self):
+        with self.lock:
+            return {"cpus": self.cpus, "cores": len(self.cores),
+                    "shares": {holder: {"pid": entry["pid"], "cpus": entry["cpus"], "jobs": entry["jobs"]}
+                               for holder, entry in self.active.items()}}
+
+# Function to give a Stata process its CPU share before a job
+def acquire_cpu_share(holder, backend):
+    """Return True if holder was registered with the CPU allocator (release it after the job)"""
+    if cpu_allocator is None:
+        return False
+    try:
+        pid = backend.process_id()
+    except Exception as e:
+        logging.debug(f"No process id for CPU partitioning of {holder}: {str(e)}")
+        return False
+    if not pid:
+        return False
+    command = cpu_allocator.acquire(holder, pid)
+    if command:
+        try:
+            backend.run(command, echo=False)
+        except Exception as e:
+            logging.debug(f"set processors failed for {holder}: {str(e)}")
+    return True
+
+# Bootstrap profiles - setup most do-files repeat (adopath, set maxvar, loading installed packages,
+# globals) lives in named do-files in --bootstrap-dir and runs once per Stata instance instead of in
+# every job. Each backend remembers the fingerprint (content hash) of the profile it ran last; a job
+# naming a profile gets it run first only when its Stata does not have that version yet.
+bootstrap_dir = None
+default_bootstrap = None  # profile run on every Stata instance when it starts (--bootstrap)
+BOOTSTRAP_NAME_RE = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.-]*$')
+
+class BootstrapError(ValueError):
+    """Raised for an unknown bootstrap profile or one that fails in Stata"""
+
+# Function to find a bootstrap profile and its fingerprint
+def load_bootstrap(name):
+    """Return (path, fingerprint) of the profile <bootstrap_dir>/<name>.do"""
+    import hashlib
+    if not bootstrap_dir:
+        raise BootstrapError("No bootstrap profiles are configured (start the server with --bootstrap-dir)")
+    if not BOOTSTRAP_NAME_RE.match(name or ""):
+        raise BootstrapError(f"Invalid bootstrap profile name: {name}")
+    path = os.path.join(bootstrap_dir, f"{name}.do")
+    try:
+        with open(path, 'rb') as f:
+            fingerprint = hashlib.sha256(f.read()).hexdigest()[:16]
+    except OSError:
+        raise BootstrapError(f"Unknown bootstrap profile: {name} (no {path})")
+    return path, fingerprint
+
+# Function to list the configured bootstrap profiles
+def list_bootstraps():
+    profiles = []
+    if bootstrap_dir and os.path.isdir(bootstrap_dir):
+        for entry in sorted(os.listdir(bootstrap_dir)):
+            name, ext = os.path.splitext(entry)
+            if ext.lower() == ".do" and BOOTSTRAP_NAME_RE.match(name):
+                try:
+                    profiles.append({"name": name, "fingerprint": load_bootstrap(name)[1],
+                                     "default": name == default_bootstrap})
+                except BootstrapError:
+                    continue
+    return profiles
+
+# Function to run a bootstrap profile on a Stata instance unless it already ran there
+def ensure_bootstrap(backend, name):
+    """Return True if the profile was run, False if backend already had this version of it"""
+    path, fingerprint = load_bootstrap(name)
+    current = backend.bootstrap
+    if current is not None and current["name"] == name and current["fingerprint"] == fingerprint:
+        metrics_inc("stata_mcp_bootstrap_runs_total", labels={"result": "reused"})
+        return False
+    start = time.perf_counter()
+    try:
+        backend.run(f'run "{path}"', echo=False)
+    except Exception as e:
+        backend.bootstrap = None  # partly applied; run it again next time
+        metrics_inc("stata_mcp_bootstrap_runs_total", labels={"result": "failed"})
+        raise BootstrapError(f"Bootstrap profile {name} failed: {str(e)}")
+    seconds = time.perf_counter() - start
+    backend.bootstrap = {"name": name, "fingerprint": fingerprint, "seconds": round(seconds, 3),
+                         "applied_at": time.time()}
+    metrics_inc("stata_mcp_bootstrap_runs_total", labels={"result": "ran"})
+    metrics_observe("stata_mcp_bootstrap_duration_seconds", seconds)
+    logging.info(f"Ran bootstrap profile {name} ({fingerprint}) on the {backend.name} backend in {seconds:.2f}s")
+    return True
+
+# Function to run the default bootstrap profile on a Stata instance that just started
+def bootstrap_new_backend(backend):
+    """Failures are logged; jobs that name the profile will try it again"""
+    if backend is None or not default_bootstrap:
+        return
+    try:
+        ensure_bootstrap(backend, default_bootstrap)
+    except BootstrapError as e:
+        logging.error(str(e))
+
+stata_scheduler = StataScheduler()
+
+# Persistent job store - job metadata, timings, return codes and compressed outputs in SQLite,
+# so finished runs can be fetched after the server restarts instead of being executed again
+job_store = None
+JOB_STORE_PRUNE_INTERVAL = 50  # prune retention every N finished jobs
+
+# Function to extract the Stata return code from a job's output
+def extract_return_code(output):
+    """Return the last r(N) code in the output, 0 for clean output, or None if the job did not produce a log"""
+    if output is None:
+        return None
+    codes = re.findall(r'\br\((\d+)\);', output)
+    if codes:
+        return int(codes[-1])
+    return None if output.startswith("Error") else 0
+
+class JobStore:
+    """SQLite-backed store of scheduler jobs and their results
+
+    Writes go through one writer thread in submission order, so the event loop never waits on SQLite.
+    Reads first wait for the writes queued before them.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            lane TEXT NOT NULL,
+            status TEXT NOT NULL,
+            description TEXT,
+            file_path TEXT,
+            content_hash TEXT,
+            submitted_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            queue_wait_seconds REAL,
+            run_seconds REAL,
+            return_code INTEGER,
+            error TEXT,
+            output BLOB,
+            output_bytes INTEGER,
+            timing TEXT,
+            tenant TEXT,
+            peak_rss_bytes INTEGER,
+            resources TEXT,
+            profile TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_file_path ON jobs (file_path, submitted_at);
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, submitted_at);
+        CREATE INDEX IF NOT EXISTS jobs_submitted_at ON jobs (submitted_at);
+        CREATE INDEX IF NOT EXISTS jobs_content_hash ON jobs (content_hash);
+    """
+    SUMMARY_COLUMNS = ("id", "kind", "lane", "status", "description", "file_path", "content_hash", "submitted_at",
+                       "started_at", "finished_at", "queue_wait_seconds", "run_seconds", "return_code", "error",
+                       "output_bytes", "tenant", "peak_rss_bytes")
+
+    def __init__(self, path, retention_days=30.0, max_jobs=1000):
+        import queue
+        import sqlite3
+        self.path = path
+        self.retention_days = retention_days
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+        self.finished_since_prune = 0
+        self.writes = queue.Queue()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(self.SCHEMA)
+            # Stores created by older versions lack the tenant, resource and profile columns
+            existing = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+            for column, column_type in (("tenant", "TEXT"), ("peak_rss_bytes", "INTEGER"), ("resources", "TEXT"),
+                                        ("profile", "TEXT")):
+                if column not in existing:
+                    self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            # Jobs still queued or running belonged to a previous server process that was killed
+            interrupted = self.conn.execute(
+                "UPDATE jobs SET status = 'interrupted' WHERE status IN ('queued', 'running')").rowcount
+        if interrupted:
+            logging.info(f"Marked {interrupted} unfinished jobs from a previous run as interrupted")
+        self.prune()
+        threading.Thread(target=self._writer, name="job-store-writer", daemon=True).start()
+
+    @staticmethod
+    def _job_fields(job):
+        """Path and content hash identifying what a job ran"""
+        import hashlib
+        if job.dedupe_key is not None:
+            return job.dedupe_key[0], job.dedupe_key[1]
+        if job.kind == "selection" and job.args:
+            return None, hashlib.sha256(str(job.args[0]).encode('utf-8')).hexdigest()
+        return (job.args[0] if job.args else None), None
+
+    def _writer(self):
+        while True:
+            sql, params, done = self.writes.get()
+            if sql is not None:
+                try:
+                    with self.lock, self.conn:
+                        self.conn.execute(sql, params)
+                except Exception as e:
+                    metrics_inc("stata_mcp_job_store_errors_total")
+                    logging.error(f"Job store write failed: {str(e)}")
+            if done is not None:
+                done.set()
+
+    def _write(self, sql, params, wait=False):
+        """Queue a write for the writer thread; with wait, return once it (and every earlier write) is done"""
+        done = threading.Event() if wait else None
+        self.writes.put((sql, params, done))
+        if done is not None:
+            done.wait()
+
+    def flush(self):
+        """Wait until every queued write is in the database"""
+        self._write(None, None, wait=True)
+
+    def record_submitted(self, job):
+        file_path, content_hash = self._job_fields(job)
+        self._write(
+            "INSERT OR REPLACE INTO jobs (id, kind, lane, status, description, file_path, content_hash, submitted_at, "
+            "tenant) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job.id, job.kind, job.lane, job.status, job.description, file_path, content_hash, job.submitted_at,
+             job.tenant.name if job.tenant is not None else None))
+
+    def record_started(self, job):
+        self._write("UPDATE jobs SET status = ?, started_at = ?, queue_wait_seconds = ? WHERE id = ?",
+                    (job.status, job.started_at, job.queue_wait_seconds, job.id))
+
+    def record_finished(self, job, output=None, error=None):
+        import zlib
+        encoded = output.encode('utf-8') if output is not None else None
+        timing = json.dumps(job.trace.to_dict()) if job.trace is not None else None
+        self._write(
+            "UPDATE jobs SET status = ?, finished_at = ?, run_seconds = ?, return_code = ?, error = ?, "
+            "output = ?, output_bytes = ?, timing = ?, peak_rss_bytes = ?, resources = ?, profile = ? WHERE id = ?",
+            (job.status, job.finished_at, job.run_seconds, extract_return_code(output), error,
+             zlib.compress(encoded, 6) if encoded is not None else None,
+             len(encoded) if encoded is not None else None, timing,
+             job.resources["peak_rss_bytes"] if job.resources else None,
+             json.dumps(job.resources) if job.resources else None,
+             json.dumps(job.profile) if job.profile is not None else None, job.id), wait=True)
+        self.finished_since_prune += 1
+        if self.finished_since_prune >= JOB_STORE_PRUNE_INTERVAL:
+            self.prune()
+
+    def prune(self):
+        """Apply the retention policy: drop jobs older than retention_days and beyond max_jobs"""
+        self.finished_since_prune = 0
+        deleted = 0
+        try:
+            with self.lock, self.conn:
+                if self.retention_days:
+                    cutoff = time.time() - self.retention_days * 86400
+                    deleted += self.conn.execute("DELETE FROM jobs WHERE submitted_at < ? AND status NOT IN "
+                                                 "('queued', 'running')", (cutoff,)).rowcount
+                if self.max_jobs:
+                    deleted += self.conn.execute(
+                        "DELETE FROM jobs WHERE id IN (SELECT id FROM jobs ORDER BY submitted_at DESC "
+                        "LIMIT -1 OFFSET ?) AND status NOT IN ('queued', 'running')", (self.max_jobs,)).rowcount
+        except Exception as e:
+            logging.error(f"Job store pruning failed: {str(e)}")
+            return 0
+        if deleted:
+            logging.debug(f"Job store retention removed {deleted} jobs")
+        return deleted
+
+    def get(self, job_id, include_output=True):
+        """Return a stored job as a dict, or None"""
+        import zlib
+        self.flush()
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {column: row[column] for column in self.SUMMARY_COLUMNS}
+        job["timing"] = json.loads(row["timing"]) if row["timing"] else None
+        job["resources"] = json.loads(row["resources"]) if row["resources"] else None
+        job["profile"] = json.loads(row["profile"]) if row["profile"] else None
+        if include_output:
+            job["output"] = zlib.decompress(row["output"]).decode('utf-8') if row["output"] is not None else None
+        return job
+
+    def find(self, file_path=None, status=None, content_hash=None, since=None, until=None, limit=50, tenant=None):
+        """List stored jobs (newest first) using the file, status, hash and time indexes"""
+        clauses, params = [], []
+        if tenant:
+            clauses.append("tenant = ?")
+            params.append(tenant)
+        if file_path:
+            clauses.append("file_path = ?")
+            params.append(file_path)
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if content_hash:
+            clauses.append("content_hash = ?")
+            params.append(content_hash)
+        if since is not None:
+            clauses.append("submitted_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("submitted_at < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        params.append(max(1, min(int(limit), 1000)))
+        self.flush()
+        with self.lock:
+            rows = self.conn.execute(f"SELECT {', '.join(self.SUMMARY_COLUMNS)} FROM jobs {where} "
+                                     f"ORDER BY submitted_at DESC LIMIT ?", params).fetchall()
+        return [dict(row) for row in rows]
+
+    def runtime_history(self, file_path, content_hash, limit=30):
+        """Finished do-file runs with the same content or path, newest first"""
+        self.flush()
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT file_path, content_hash, status, return_code, run_seconds, output_bytes, finished_at FROM jobs "
+                "WHERE (content_hash = ? OR file_path = ?) AND kind = 'file' AND status IN ('done', 'failed') "
+                "AND run_seconds IS NOT NULL ORDER BY finished_at DESC LIMIT ?",
+                (content_hash, file_path, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.conn.close()
+
 # Function to update Stata availability
 def set_stata_available(value):
     """Update the module-level stata_available variable"""
@@ -111,7 +2529,22 @@ def set_stata_available(value):
 
 # Try to initialize Stata with the given path
 def try_init_stata(stata_path):
-    """Try to initialize Stata with the given path"""
+    """Try to initialize Stata with the given path, recording init count and duration"""
+    # Already-initialized calls are a no-op and are not counted as init attempts
+    if stata_available and has_stata and stata is not None:
+        logging.debug("Stata already initialized, skipping re-initialization")
+        return True
+
+    init_start = time.perf_counter()
+    success = _try_init_stata(stata_path)
+    metrics_observe("stata_mcp_stata_init_duration_seconds", time.perf_counter() - init_start)
+    metrics_inc("stata_mcp_stata_init_total", labels={"result": "success" if success else "failure"})
+    if success:
+        bootstrap_new_backend(stata_backend)
+    return success
+
+def _try_init_stata(stata_path):
+    """Initialize Stata with the given path"""
     global stata_available, has_stata, stata, STATA_PATH, stata_banner_displayed, stata_edition
     
     # If Stata is already available, don't re-initialize
@@ -175,6 +2608,7 @@ def try_init_stata(stata_path):
                 from pystata import stata as stata_module
                 # Set module-level stata reference
                 globals()['stata'] = stata_module
+                globals()['stata_backend'] = PyStataBackend(stata_module)
                 
                 # Successfully initialized Stata
                 has_stata = True
@@ -214,6 +2648,7 @@ def try_init_stata(stata_path):
                     import sfi
                     # Set module-level stata reference for compatibility
                     globals()['stata'] = sfi
+                    globals()['stata_backend'] = PyStataBackend(sfi)
                     
                     has_stata = True
                     stata_available = True
@@ -361,13 +2796,678 @@ def check_stata_installed():
         
     return True
 
+# Function to extract the command output from a run_stata_command log
+def clean_command_log(log_content):
+    """Strip the log open/close boilerplate from a command log and return the output lines"""
+    # MUCH SIMPLER APPROACH: Just filter beginning and end of log file
+    lines = log_content.strip().split('\n')
+    
+    # Find the first actual command (first line that starts with a dot that's not log related)
+    start_index = 0
+    for i, line in enumerate(lines):
+        if line.strip().startswith('.') and 'log ' not in line and 'capture log close' not in line:
+            # Found the first actual command, so output starts right after this
+            start_index = i + 1
+            break
+    
+    # Find end of output (the "capture log close" or "end of do-file" at the end)
+    end_index = len(lines)
+    for i in range(len(lines)-1, 0, -1):
+        if 'capture log close' in lines[i] or 'end of do-file' in lines[i]:
+            end_index = i
+            break
+    
+    # Extract just the middle part (the actual output)
+    result_lines = []
+    for i in range(start_index, end_index):
+        line = lines[i].rstrip()  # Remove trailing whitespace
+        
+        # Skip empty lines at beginning or end
+        if not line.strip():
+            continue
+        
+        # Keep command lines (don't filter out lines starting with '.')
+        
+        # Remove consecutive blank lines (keep just one)
+        if (not line.strip() and result_lines and not result_lines[-1].strip()):
+            continue
+            
+        result_lines.append(line)
+    
+    return result_lines
+
+# Log banner lines Stata writes when a log is opened or closed
+LOG_BANNER_RE = re.compile(r'^\s*(?:-{20,}|name:\s.*|log:\s.*|log type:\s.*|opened on:\s.*|closed on:\s.*)$')
+
+# Function to clean up the log written by run_stata_file
+def clean_do_file_log(log_content, strip_banners=False):
+    """Remove the log header and SMCL codes from a do-file log and return the output lines
+
+    strip_banners also drops the open/close banners of logs that were closed and appended
+    to again (block-by-block runs).
+    """
+    lines = log_content.splitlines()
+    result_lines = []
+    
+    # Skip Stata header if present (search for the separator line)
+    start_index = 0
+    for i, line in enumerate(lines):
+        if '-------------' in line and i < 20:  # Look in first 20 lines
+            start_index = i + 1
+            break
+    
+    # Process the content
+    for i in range(start_index, len(lines)):
+        line = lines[i].rstrip()
+        
+        # Skip empty lines at beginning or redundant empty lines
+        if not line.strip() and (not result_lines or not result_lines[-1].strip()):
+            continue
+            
+        # Clean up SMCL formatting if present
+        if '{' in line:
+            line = re.sub(r'\{[^}]*\}', '', line)  # Remove {...} codes
+        
+        if strip_banners and LOG_BANNER_RE.match(line):
+            continue
+            
+        result_lines.append(line)
+    
+    return result_lines
+
+# Section markers ("** #", the Stata do-file editor bookmark syntax) delimit do-file blocks
+SECTION_MARKER_RE = re.compile(r'^\s*\*\*\s*#')
+
+# Function to split a do-file into blocks at top-level section markers
+def split_do_file_blocks(content):
+    """Split do-file content into blocks at "** #" section markers outside braces and comments
+
+    Returns a list of {"title", "text"} dicts. Files using #delimit are returned as a single
+    block, since their statements do not follow line boundaries.
+    """
+    if re.search(r'^\s*#d(?:elimit)?\s', content, re.MULTILINE | re.IGNORECASE):
+        return [{"title": "(whole file)", "text": content}]
+
+    blocks = []
+    title = "(preamble)"
+    current = []
+    depth = 0
+    in_comment = False
+    for line in content.splitlines():
+        if depth == 0 and not in_comment and SECTION_MARKER_RE.match(line):
+            if any(l.strip() for l in current):
+                blocks.append({"title": title, "text": "\n".join(current) + "\n"})
+                current = []
+            title = SECTION_MARKER_RE.sub('', line).strip() or f"block {len(blocks) + 1}"
+        current.append(line)
+
+        # Track brace depth on code only (strings and comments removed)
+        code = re.sub(r'"[^"]*"', '', line)
+        stripped = []
+        i = 0
+        while i < len(code):
+            if in_comment:
+                end = code.find('*/', i)
+                if end < 0:
+                    i = len(code)
+                else:
+                    in_comment = False
+                    i = end + 2
+            elif code.startswith('/*', i):
+                in_comment = True
+                i += 2
+            elif code.startswith('//', i):
+                break
+            else:
+                stripped.append(code[i])
+                i += 1
+        code = "".join(stripped)
+        if not code.lstrip().startswith('*'):
+            depth = max(0, depth + code.count('{') - code.count('}'))
+
+    if any(l.strip() for l in current) or not blocks:
+        blocks.append({"title": title, "text": "\n".join(current) + "\n"})
+    return blocks
+
+# Block checkpoints - incremental runs save the Stata state (data and global macros) after each
+# successful block. Checkpoints are keyed by a hash chain over the block texts, so a rerun resumes
+# after the last block that is unchanged and whose predecessors are unchanged too.
+checkpoint_root = None  # defaults to stata_mcp_checkpoints next to the scratch area
+
+# Function to find the checkpoint directory of a do-file
+def checkpoint_directory(file_path):
+    """Return the directory holding checkpoints for a do-file"""
+    import hashlib
+    root = checkpoint_root or os.path.join(os.path.dirname(scratch_area.root), "stata_mcp_checkpoints")
+    key = hashlib.sha256(os.path.normcase(os.path.abspath(file_path)).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(root, key)
+
+# Function to hash blocks so each hash covers the block and everything before it
+def block_chain_hashes(blocks):
+    import hashlib
+    hashes = []
+    previous = ""
+    for block in blocks:
+        previous = hashlib.sha256((previous + block["text"]).encode('utf-8')).hexdigest()
+        hashes.append(previous)
+    return hashes
+
+def load_checkpoint_manifest(directory):
+    try:
+        with open(os.path.join(directory, "manifest.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"blocks": []}
+
+def save_checkpoint_manifest(directory, manifest):
+    """Write the manifest atomically so an interrupted run never leaves it half written"""
+    path = os.path.join(directory, "manifest.json")
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+# Function to count the leading blocks that can be skipped
+def find_resume_point(manifest, hashes, directory):
+    """Return how many leading blocks have a checkpoint matching the current block texts"""
+    valid = 0
+    for index, block_hash in enumerate(hashes):
+        entries = manifest.get("blocks", [])
+        if index >= len(entries) or entries[index].get("hash") != block_hash:
+            break
+        if not os.path.exists(os.path.join(directory, entries[index]["globals"])):
+            break
+        valid = index + 1
+    return valid
+
+# Function to generate the Stata code that saves a checkpoint
+def checkpoint_save_commands(data_path, globals_path):
+    """Save the data in memory and all user globals (S_* system globals are skipped)"""
+    return "\n".join([
+        "* Checkpoint written by MCP",
+        f'capture erase "{data_path}"',
+        "if c(k) > 0 {",
+        f'    quietly save "{data_path}", replace emptyok',
+        "}",
+        "tempname mcp_fh",
+        f'quietly file open `mcp_fh\' using "{globals_path}", write text replace',
+        "local mcp_globals : all globals",
+        "foreach mcp_g of local mcp_globals {",
+        "    if substr(\"`mcp_g'\", 1, 2) != \"S_\" {",
+        "        file write `mcp_fh' `\"global `mcp_g' `\"${`mcp_g'}\"'\"' _n",
+        "    }",
+        "}",
+        "file close `mcp_fh'",
+    ]) + "\n"
+
+# Function to generate the Stata code that restores a checkpoint
+def checkpoint_restore_commands(data_path, globals_path):
+    lines = ["clear"]
+    if os.path.exists(data_path):
+        lines.append(f'quietly use "{data_path}", clear')
+    lines.append(f'quietly do "{globals_path}"')
+    return "\n".join(lines) + "\n"
+
+# Function to summarize which blocks ran and how long they took
+def format_block_report(blocks, first_block, block_timings):
+    lines = ["", "Blocks:"]
+    for index, block in enumerate(blocks):
+        if index < first_block:
+            status = "skipped (checkpoint)"
+        elif index - first_block < len(block_timings):
+            timing = block_timings[index - first_block]
+            status = f"{timing['status']} in {timing['seconds']:.2f}s"
+        else:
+            status = "not run"
+        lines.append(f"  {index + 1}. {block['title']}: {status}")
+    return "\n".join(lines)
+
+# Function to render the command history returned to run_selection callers
+def render_command_history():
+    """Build a string of all command history in chronological order (oldest to newest)"""
+    full_output = []
+    for entry in command_history:
+        full_output.append(f">>> {entry['command']}")
+        full_output.append(entry['result'])
+        # No separator lines
+    return "\n".join(full_output)
+
+# Delta output - the last output of each file or selection is kept per session, so a rerun with
+# delta=true returns only the lines that changed. Stored outputs are evicted least recently used
+# first once they exceed DELTA_MAX_BYTES in total.
+DELTA_MAX_BYTES = 64 * 1024 * 1024
+DELTA_CONTEXT_LINES = 1
+DELTA_FULL_OUTPUT_RATIO = 0.6  # send the full output when the diff is not much smaller
+previous_outputs = {}  # (session, key) -> (output, stored_at); insertion order is recency
+previous_outputs_bytes = 0
+previous_outputs_lock = threading.Lock()
+# Timestamps, durations and log open/close stamps differ on every run and are ignored when comparing
+VOLATILE_OUTPUT_RE = re.compile(r'\[\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\]|\d{1,2} \w{3} \d{4}, \d\d:\d\d(?::\d\d)?'
+                                r'|completed in [\d.]+ seconds|\d+(?:\.\d+)? ?(?:seconds|sec)\b')
+DELTA_SECTION_RE = re.compile(r'^\.\s*\*\*\s*#+\s*(.*?)\s*$')
+DELTA_ENTRY_RE = re.compile(r'^>>> (?:\[[^\]]*\]\s*)?(.*?)\s*$')
+
+# Function to build the key under which the output of a file or selection is remembered
+def delta_key(kind, value):
+    """Files are keyed by normalized path, selections by a hash of their text"""
+    import hashlib
+    if kind == "file":
+        return "file:" + os.path.normcase(os.path.abspath(value))
+    return "selection:" + hashlib.sha256(value.strip().encode('utf-8')).hexdigest()[:16]
+
+# Function to remember the latest output of a file or selection
+def remember_output(session, key, output):
+    """Store output for the next delta request and return the previous (output, stored_at), if any"""
+    global previous_outputs_bytes
+    with previous_outputs_lock:
+        previous = previous_outputs.pop((session, key), None)
+        if previous is not None:
+            previous_outputs_bytes -= len(previous[0])
+        if len(output) <= DELTA_MAX_BYTES:
+            previous_outputs[(session, key)] = (output, time.time())
+            previous_outputs_bytes += len(output)
+        while previous_outputs_bytes > DELTA_MAX_BYTES and previous_outputs:
+            oldest = next(iter(previous_outputs))
+            previous_outputs_bytes -= len(previous_outputs.pop(oldest)[0])
+        return previous
+
+# Function to label each output line with the section it belongs to
+def output_sections(lines):
+    """Return the "** #" section (or history entry) each line falls in"""
+    labels = []
+    current = "start"
+    for line in lines:
+        match = DELTA_SECTION_RE.match(line) or DELTA_ENTRY_RE.match(line)
+        if match:
+            current = match.group(1)[:60] or current
+        labels.append(current)
+    return labels
+
+# Function to turn an output into a line-level diff against the previous output of the same file or selection
+def delta_output(session, key, label, output):
+    """Return (text, mode) where mode is first, unchanged, delta or full"""
+    import difflib
+    previous = remember_output(session, key, output)
+    if previous is None:
+        metrics_inc("stata_mcp_delta_responses_total", labels={"mode": "first"})
+        return f"No previous output of {label} in this session; full output follows.\n\n{output}", "first"
+
+    old_lines, new_lines = previous[0].splitlines(), output.splitlines()
+    matcher = difflib.SequenceMatcher(None, [VOLATILE_OUTPUT_RE.sub("#", line) for line in old_lines],
+                                      [VOLATILE_OUTPUT_RE.sub("#", line) for line in new_lines])
+    age = time.time() - previous[1]
+    groups = list(matcher.get_grouped_opcodes(DELTA_CONTEXT_LINES))
+    if not groups:
+        metrics_inc("stata_mcp_delta_responses_total", labels={"mode": "unchanged"})
+        metrics_inc("stata_mcp_delta_bytes_saved_total", len(output))
+        return (f"No changes since the previous output of {label} ({age:.0f}s ago, {len(new_lines)} lines; "
+                f"timestamps and timings ignored)."), "unchanged"
+
+    old_sections, new_sections = output_sections(old_lines), output_sections(new_lines)
+    changed = {}  # section -> [added, removed], in order of appearance
+    hunks = []
+    for group in groups:
+        i1, i2, j1, j2 = group[0][1], group[-1][2], group[0][3], group[-1][4]
+        section = None
+        body = []
+        for tag, a1, a2, b1, b2 in group:
+            if tag == "equal":
+                body.extend(" " + line for line in new_lines[b1:b2])
+                continue
+            name = new_sections[b1] if b1 < b2 else old_sections[a1]
+            section = section or name
+            counts = changed.setdefault(name, [0, 0])
+            counts[0] += b2 - b1
+            counts[1] += a2 - a1
+            body.extend("-" + line for line in old_lines[a1:a2])
+            body.extend("+" + line for line in new_lines[b1:b2])
+        hunks.append(f"@@ -{i1 + 1},{i2 - i1} +{j1 + 1},{j2 - j1} @@ {section}")
+        hunks.extend(body)
+
+    added = sum(counts[0] for counts in changed.values())
+    removed = sum(counts[1] for counts in changed.values())
+    summary = ", ".join(f"{name} (+{counts[0]} -{counts[1]})" for name, counts in changed.items())
+    text = "\n".join([f"Delta against the previous output of {label} ({age:.0f}s ago): +{added} -{removed} lines, "
+                      f"{len(new_lines) - added} unchanged",
+                      f"Changed sections: {summary}", ""] + hunks)
+    if len(text) > DELTA_FULL_OUTPUT_RATIO * len(output):
+        metrics_inc("stata_mcp_delta_responses_total", labels={"mode": "full"})
+        return (f"Output of {label} changed too much for a delta (+{added} -{removed} lines); "
+                f"full output follows.\nChanged sections: {summary}\n\n{output}"), "full"
+    metrics_inc("stata_mcp_delta_responses_total", labels={"mode": "delta"})
+    metrics_inc("stata_mcp_delta_bytes_saved_total", len(output) - len(text))
+    return text, "delta"
+
+# Function to apply the delta option to the output of a tool request
+def delta_response(result, delta, session, kind, value):
+    """Remember the output of a successful run and, when delta is set, return it as a diff (text, mode)"""
+    if result.startswith("Error"):
+        return result, None
+    # Named sessions are scoped to the caller's default session so tenants never see each other's outputs
+    session = f"{default_session()}/{session}" if session else default_session()
+    key = delta_key(kind, value)
+    if not delta:
+        remember_output(session, key, result)
+        return result, None
+    return delta_output(session, key, f"file {value}" if kind == "file" else "this selection", result)
+
+# Dataset cache - a `use` of a whole .dta file in run_selection is served from a copy kept in a
+# named Stata frame while the file's size and mtime are unchanged. Frames are evicted least
+# recently used first to stay within dataset_cache_budget (file size is the memory estimate).
+dataset_cache_budget = 0  # bytes; 0 disables the cache
+dataset_cache = {}  # normalized path -> entry dict
+dataset_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+dataset_cache_lock = threading.Lock()
+# Only `use ..., clear` is cached: the cached load replaces the data in memory, which a plain `use`
+# refuses to do when the data has changed
+USE_COMMAND_RE = re.compile(r'^\s*use\s+(?:"([^"]+)"|`"([^"]+)"\'|([^\s,"]+))\s*,\s*clear\s*$', re.IGNORECASE)
+
+# Function to generate Stata code that loads a dataset through the frame cache
+def cached_use_commands(path, outcomes):
+    """Return Stata code replacing `use path, clear`, or None if the file cannot be cached
+
+    When a cached frame is found, the code writes hit (frame copied) or miss (frame lost, file
+    reloaded) to a scratch file, appended to outcomes as (key, file) and counted after the run.
+    """
+    import hashlib
+    if not os.path.isabs(path):
+        return None  # relative paths depend on Stata's working directory
+    if not os.path.splitext(path)[1]:
+        path += ".dta"
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = os.path.normcase(os.path.abspath(path))
+    lines = []
+    with dataset_cache_lock:
+        entry = dataset_cache.get(key)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            entry["last_used"] = time.time()
+            frame = entry["frame"]
+            outcome_file = scratch_area.new_file('.txt', prefix="dataset_cache")
+            outcomes.append((key, outcome_file))
+            # Copy the cached frame into the current frame; reload if Stata lost the frame (e.g. restarted)
+            return "\n".join([
+                f"capture confirm frame {frame}",
+                "local mcp_outcome = cond(_rc, \"miss\", \"hit\")",
+                "if \"`mcp_outcome'\" == \"miss\" {",
+                f'    use "{path}", clear',
+                f"    frame copy `c(frame)' {frame}, replace",
+                "}",
+                "else {",
+                "    local mcp_current = c(frame)",
+                f"    frame copy {frame} mcp_load, replace",
+                "    frame change mcp_load",
+                "    frame drop `mcp_current'",
+                "    frame rename mcp_load `mcp_current'",
+                "}",
+                "tempname mcp_fh",
+                f'quietly file open `mcp_fh\' using "{outcome_file}", write text replace',
+                "file write `mcp_fh' \"`mcp_outcome'\"",
+                "file close `mcp_fh'",
+            ]) + "\n"
+
+        dataset_cache_stats["misses"] += 1
+        metrics_inc("stata_mcp_dataset_cache_requests_total", labels={"result": "miss"})
+        if entry:
+            # The file changed on disk; its frame is stale
+            lines.append(f"capture frame drop {entry['frame']}")
+            del dataset_cache[key]
+        if stat.st_size > dataset_cache_budget:
+            lines.append(f'use "{path}", clear')
+        else:
+            # Evict least recently used frames until the new dataset fits
+            used = sum(e["size"] for e in dataset_cache.values())
+            for old_key, old in sorted(dataset_cache.items(), key=lambda item: item[1]["last_used"]):
+                if used + stat.st_size <= dataset_cache_budget:
+                    break
+                lines.append(f"capture frame drop {old['frame']}")
+                used -= old["size"]
+                del dataset_cache[old_key]
+                dataset_cache_stats["evictions"] += 1
+                metrics_inc("stata_mcp_dataset_cache_evictions_total")
+            # Frame names follow from the path so a restarted server reuses (replaces) the same frame
+            frame = "mcp_cache_" + hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+            lines += [f'use "{path}", clear', f"frame copy `c(frame)' {frame}, replace"]
+            dataset_cache[key] = {"path": path, "frame": frame, "size": stat.st_size, "mtime": stat.st_mtime,
+                                  "cached_at": time.time(), "last_used": time.time(), "hits": 0}
+        metrics_set("stata_mcp_dataset_cache_bytes", sum(e["size"] for e in dataset_cache.values()))
+    return "\n".join(lines) + "\n"
+
+# Function to route `use` lines of a command through the dataset cache
+def apply_dataset_cache(command):
+    """Replace each cacheable `use` line with a `run` of a scratch do-file holding the cache logic
+
+    Returns the command and the (path key, outcome file) of each lookup of a cached frame.
+    """
+    if not dataset_cache_budget:
+        return command, []
+    lines = []
+    outcomes = []
+    for line in command.splitlines():
+        match = USE_COMMAND_RE.match(line)
+        code = cached_use_commands(next(g for g in match.groups() if g), outcomes) if match else None
+        if code is None:
+            lines.append(line)
+            continue
+        # `run` executes the cache logic without echoing it into the output
+        cache_do_file = scratch_area.new_file('.do', prefix="dataset_cache")
+        with open(cache_do_file, 'w') as f:
+            f.write(code)
+        lines.append(f'run "{cache_do_file}"')
+    return "\n".join(lines), outcomes
+
+# Function to count the lookups of cached frames once the command that made them has run
+def count_dataset_cache_outcomes(outcomes):
+    """A lookup whose frame was gone and had to be reloaded from disk counts as a miss"""
+    for key, outcome_file in outcomes:
+        try:
+            with open(outcome_file) as f:
+                outcome = f.read().strip()
+        except OSError:
+            continue  # the command stopped before reaching the `use` line
+        if outcome not in ("hit", "miss"):
+            continue
+        with dataset_cache_lock:
+            dataset_cache_stats["hits" if outcome == "hit" else "misses"] += 1
+            entry = dataset_cache.get(key)
+            if entry and outcome == "hit":
+                entry["hits"] += 1
+        metrics_inc("stata_mcp_dataset_cache_requests_total", labels={"result": outcome})
+
+# Graph capture - graphs a do-file creates or redraws are exported after the run and published as
+# MCP resources. Exports are cached under a hash of the graph saved as .gph, which holds the data it
+# was drawn from (not the data in memory after the run) and its scheme and options, so unchanged
+# graphs are served from disk instead of being exported again.
+graph_formats = ["png"]  # empty disables capture
+graph_export_width = 1200  # pixels, PNG only
+graph_cache_dir = None  # defaults to stata_mcp_graphs in the system temp directory
+GRAPH_CACHE_MAX_FILES = 500
+MAX_GRAPH_RESOURCES = 200
+GRAPH_URI_SCHEME = "stata-graph"
+GRAPH_MIME_TYPES = {"png": "image/png", "svg": "image/svg+xml", "pdf": "application/pdf"}
+GRAPH_FILE_RE = re.compile(r'^[0-9a-f]{32}\.(png|svg|pdf)$')
+# Parts of a .gph file that differ between identical drawings: the draw time and in-memory object ids
+GRAPH_VOLATILE_RE = re.compile(rb'^\*! command_(?:date|time):[^\n]*|\bK[0-9a-f]{6,16}\b', re.MULTILINE)
+graph_resources = {}  # file name -> entry, oldest first
+graph_resources_lock = threading.Lock()
+
+# Writes the scheme, then name, redraw stamp, source dataset and command of every graph in memory,
+# one per line. r() results are held so the user's r() survives the listing.
+GRAPH_LIST_TEMPLATE = r"""
+capture _return drop mcp_graph_r
+_return hold mcp_graph_r
+local mcp_sig `"`c(scheme)'"'
+quietly graph dir, memory
+local mcp_graphs "`r(list)'"
+tempname fh
+file open `fh' using "{manifest}", write text replace
+file write `fh' "*" _tab `"`mcp_sig'"' _n
+foreach mcp_g of local mcp_graphs {{
+    quietly graph describe `mcp_g'
+    file write `fh' "`mcp_g'" _tab "`r(command_date)' `r(command_time)'" _tab `"`r(dtafile)' `r(dtafile_date)'"' _tab `"`r(command)'"' _n
+}}
+file close `fh'
+_return restore mcp_graph_r
+"""
+
+# Function to parse the manifest written by GRAPH_LIST_TEMPLATE
+def parse_graph_manifest(path):
+    """Return (scheme, {name: {"stamp", "source", "command"}})"""
+    signature = ""
+    graphs = {}
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f.read().splitlines():
+            fields = line.split("\t", 3)
+            if fields[0] == "*":
+                signature = fields[1] if len(fields) > 1 else ""
+            elif len(fields) == 4:
+                graphs[fields[0]] = {"stamp": fields[1], "source": fields[2], "command": fields[3]}
+    return signature, graphs
+
+# Function to find the graph cache directory
+def graph_directory():
+    return graph_cache_dir or os.path.join(tempfile.gettempdir(), "stata_mcp_graphs")
+
+# Function to list the graphs in memory before a run
+def graph_snapshot():
+    """Return the graphs in memory, or None if capture is off or Stata could not list them"""
+    if not graph_formats or stata_backend is None:
+        return None
+    try:
+        return stata_backend.list_graphs()[1]
+    except Exception as e:
+        logging.warning(f"Could not list graphs before the run: {str(e)}")
+        return None
+
+# Function to export the graphs a run created or redrew
+def capture_graphs(before):
+    """Export graphs that are new or redrawn since the before snapshot; returns one entry per graph and format
+
+    A graph whose .gph fingerprint cannot be taken is always exported, never served from the cache.
+    """
+    import hashlib
+    import uuid
+    _, graphs = stata_backend.list_graphs()
+    changed = [name for name, graph in graphs.items() if before.get(name) != graph]
+    fingerprints = stata_backend.graph_fingerprints(changed) if changed else {}
+    directory = graph_directory()
+    os.makedirs(directory, exist_ok=True)
+    entries, exports = [], []
+    for name in changed:
+        graph = graphs[name]
+        fingerprint = fingerprints.get(name) or uuid.uuid4().hex
+        for fmt in graph_formats:
+            width = graph_export_width if fmt == "png" else 0
+            key = hashlib.sha256("\n".join([fingerprint, fmt, str(width)]).encode('utf-8')).hexdigest()[:32]
+            file_name = f"{key}.{fmt}"
+            path = os.path.join(directory, file_name)
+            cached = os.path.exists(path)
+            if cached:
+                os.utime(path, None)  # mark as recently used for pruning
+            else:
+                exports.append((name, path, fmt))
+            entries.append({"graph": name, "format": fmt, "command": graph["command"], "file": file_name,
+                            "path": path, "uri": f"{GRAPH_URI_SCHEME}://{file_name}", "cached": cached})
+    if exports:
+        stata_backend.export_graphs(exports)
+    captured = []
+    for entry in entries:
+        if entry["cached"]:
+            metrics_inc("stata_mcp_graph_exports_total", labels={"result": "cached"})
+        elif os.path.exists(entry["path"]):
+            metrics_inc("stata_mcp_graph_exports_total", labels={"result": "rendered"})
+        else:
+            metrics_inc("stata_mcp_graph_exports_total", labels={"result": "failed"})
+            logging.warning(f"Graph {entry['graph']} could not be exported as {entry['format']}")
+            continue
+        captured.append(entry)
+    # In multi-tenant mode a graph is listed and served only to the tenants whose runs captured it
+    job = current_job()
+    owner = job.tenant.name if job is not None and job.tenant is not None else None
+    with graph_resources_lock:
+        for entry in captured:
+            previous = graph_resources.pop(entry["file"], None)
+            owners = set(previous["tenants"]) if previous is not None else set()
+            if owner is not None:
+                owners.add(owner)
+            graph_resources[entry["file"]] = dict(entry, captured_at=time.time(), tenants=sorted(owners))
+        for file_name in list(graph_resources)[:max(0, len(graph_resources) - MAX_GRAPH_RESOURCES)]:
+            del graph_resources[file_name]
+    if exports:
+        prune_graph_cache(directory)
+    return captured
+
+# Function to keep the graph cache within GRAPH_CACHE_MAX_FILES
+def prune_graph_cache(directory):
+    """Delete the least recently used exports beyond the file limit"""
+    try:
+        files = [os.path.join(directory, name) for name in os.listdir(directory) if GRAPH_FILE_RE.match(name)]
+        files.sort(key=os.path.getmtime)
+        for path in files[:max(0, len(files) - GRAPH_CACHE_MAX_FILES)]:
+            os.remove(path)
+    except OSError as e:
+        logging.debug(f"Could not prune graph cache {directory}: {str(e)}")
+
+# Function to describe captured graphs at the end of a run's output
+def format_graph_report(entries):
+    lines = ["Graphs:"]
+    for entry in entries:
+        note = " (cached)" if entry["cached"] else ""
+        lines.append(f"  {entry['graph']} ({entry['format']}): {entry['uri']}  {entry['path']}{note}")
+    return "\n".join(lines)
+
+# Function to check whether the requesting tenant may see a captured graph
+def graph_visible(file_name):
+    """Single-user mode and admin tenants see every graph, other tenants the graphs their runs captured"""
+    tenant = tenant_filter()
+    if tenant is None:
+        return True
+    with graph_resources_lock:
+        entry = graph_resources.get(file_name)
+    return entry is not None and tenant.name in entry["tenants"]
+
+# Function to publish captured graphs as MCP resources
+def register_graph_resources(mcp_server):
+    """Add resources/list and resources/read handlers serving graph_resources to a low-level MCP server"""
+    import mcp.types as types
+    from mcp.server.lowlevel.helper_types import ReadResourceContents
+
+    @mcp_server.list_resources()
+    async def list_graph_resources():
+        tenant = tenant_filter()
+        with graph_resources_lock:
+            entries = [entry for entry in graph_resources.values() if tenant is None or tenant.name in entry["tenants"]]
+        return [types.Resource(uri=entry["uri"], name=f"{entry['graph']}.{entry['format']}",
+                               description=entry["command"], mimeType=GRAPH_MIME_TYPES[entry["format"]])
+                for entry in reversed(entries)]
+
+    @mcp_server.read_resource()
+    async def read_graph_resource(uri):
+        file_name = str(uri).split("://", 1)[-1]
+        if not GRAPH_FILE_RE.match(file_name) or not graph_visible(file_name):
+            raise ValueError(f"Unknown resource: {uri}")
+        fmt = file_name.rsplit(".", 1)[1]
+        with open(os.path.join(graph_directory(), file_name), 'rb') as f:
+            content = f.read()
+        if fmt == "svg":
+            content = content.decode('utf-8')
+        return [ReadResourceContents(content=content, mime_type=GRAPH_MIME_TYPES[fmt])]
+
 # Function to run a Stata command
 def run_stata_command(command: str, clear_history=False):
+    """Run a Stata command, removing its scratch files afterwards on every path"""
+    with scratch_area.session("command"):
+        return _run_stata_command(command, clear_history)
+
+def _run_stata_command(command: str, clear_history=False):
     """Run a Stata command"""
     global stata_available, has_stata, command_history
     
     # Only log at debug level instead of info to reduce verbosity
     logging.debug(f"Running Stata command: {command}")
+    call_start = time.perf_counter()
+    stata_seconds = 0.0
     
     # Clear history if requested
     if clear_history:
@@ -407,15 +3507,21 @@ def run_stata_command(command: str, clear_history=False):
             command = f"do {file_path}"
             logging.debug(f"Reformatted 'do' command: {command}")
     
+    record_span("prepare", call_start)
+    
     # Check if pystata is available
     if has_stata and stata_available:
         # Run the command via pystata
         try:
             # Create a temp file to capture output
-            with tempfile.NamedTemporaryFile(suffix='.do', delete=False, mode='w') as f:
+            span_start = time.perf_counter()
+            do_file = scratch_area.new_file('.do')
+            scratch_area.track(f"{do_file}.log")
+            cache_outcomes = []
+            with open(do_file, 'w') as f:
                 # Write the command to the file
                 f.write(f"capture log close _all\n")
-                f.write(f"log using \"{f.name}.log\", replace text\n")
+                f.write(f"log using \"{do_file}.log\", replace text\n")
                 
                 # Special handling for 'do' commands to ensure proper quoting
                 if command.lower().startswith('do '):
@@ -423,11 +3529,12 @@ def run_stata_command(command: str, clear_history=False):
                     # The command already has the file in quotes from the code above
                     f.write(f"{command}\n")
                 else:
-                    # Normal commands don't need special treatment
-                    f.write(f"{command}\n")
+                    # Normal commands can load datasets through the frame cache
+                    cached_command, cache_outcomes = apply_dataset_cache(command)
+                    f.write(f"{cached_command}\n")
                     
                 f.write(f"capture log close\n")
-                do_file = f.name
+            record_span("temp_file_write", span_start)
             
             # Execute the do file with echo=False to completely silence Stata output to console
             try:
@@ -438,7 +3545,7 @@ def run_stata_command(command: str, clear_history=False):
                 try:
                     # Always use double quotes for the do file path for PyStata
                     run_cmd = f"do \"{do_file}\""
-                    globals()['stata'].run(run_cmd, echo=False)
+                    stata_seconds += timed_stata_run(run_cmd, "command")
                     logging.debug(f"Command executed successfully via pystata: {run_cmd}")
                 except Exception as e:
                     # If command fails, try to reinitialize Stata once
@@ -446,10 +3553,11 @@ def run_stata_command(command: str, clear_history=False):
                     
                     # Try to reinitialize Stata with the global path
                     if STATA_PATH:
+                        metrics_inc("stata_mcp_stata_reinit_total")
                         if try_init_stata(STATA_PATH):
                             # Retry the command if reinitialization succeeded
                             try:
-                                globals()['stata'].run(f"do \"{do_file}\"", echo=False)
+                                stata_seconds += timed_stata_run(f"do \"{do_file}\"", "command")
                                 logging.info(f"Command succeeded after Stata reinitialization")
                             except Exception as retry_error:
                                 logging.error(f"Command still failed after reinitializing Stata: {str(retry_error)}")
@@ -468,71 +3576,47 @@ def run_stata_command(command: str, clear_history=False):
                 error_msg = f"Error running command: {str(exec_error)}"
                 logging.error(error_msg)
                 return error_msg
+            count_dataset_cache_outcomes(cache_outcomes)
             
             # Read the log file
             log_file = f"{do_file}.log"
             logging.debug(f"Reading log file: {log_file}")
             
             # Wait for the log file to be written
+            span_start = time.perf_counter()
             max_attempts = 10
             attempts = 0
             while not os.path.exists(log_file) and attempts < max_attempts:
                 time.sleep(0.3)
                 attempts += 1
+            record_span("log_wait", span_start)
             
             if not os.path.exists(log_file):
                 logging.error(f"Log file not created: {log_file}")
                 return "Command executed but no output was captured"
             
             # Wait a moment for file writing to complete
+            span_start = time.perf_counter()
             time.sleep(0.5)
+            record_span("log_settle_sleep", span_start)
             
             try:
+                span_start = time.perf_counter()
                 with open(log_file, 'r', encoding='utf-8', errors='replace') as f:
                     log_content = f.read()
+                metrics_inc("stata_mcp_log_bytes_read_total", len(log_content.encode('utf-8')))
+                record_span("log_read", span_start)
                 
-                # MUCH SIMPLER APPROACH: Just filter beginning and end of log file
-                lines = log_content.strip().split('\n')
-                
-                # Find the first actual command (first line that starts with a dot that's not log related)
-                start_index = 0
-                for i, line in enumerate(lines):
-                    if line.strip().startswith('.') and 'log ' not in line and 'capture log close' not in line:
-                        # Found the first actual command, so output starts right after this
-                        start_index = i + 1
-                        break
-                
-                # Find end of output (the "capture log close" or "end of do-file" at the end)
-                end_index = len(lines)
-                for i in range(len(lines)-1, 0, -1):
-                    if 'capture log close' in lines[i] or 'end of do-file' in lines[i]:
-                        end_index = i
-                        break
-                
-                # Extract just the middle part (the actual output)
-                result_lines = []
-                for i in range(start_index, end_index):
-                    line = lines[i].rstrip()  # Remove trailing whitespace
-                    
-                    # Skip empty lines at beginning or end
-                    if not line.strip():
-                        continue
-                    
-                    # Keep command lines (don't filter out lines starting with '.')
-                    
-                    # Remove consecutive blank lines (keep just one)
-                    if (not line.strip() and result_lines and not result_lines[-1].strip()):
-                        continue
-                        
-                    result_lines.append(line)
+                span_start = time.perf_counter()
+                result_lines = clean_command_log(log_content)
+                record_span("log_parse", span_start)
                 
                 # Clean up temporary files
-                try:
-                    os.unlink(do_file)
-                    os.unlink(log_file)
-                except Exception as e:
-                    logging.warning(f"Could not delete temporary files: {str(e)}")
+                span_start = time.perf_counter()
+                scratch_area.cleanup()
+                record_span("cleanup", span_start)
                 
+                span_start = time.perf_counter()
                 # Add timestamp to the result
                 timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
                 command_entry = f"[{timestamp}] {command}"
@@ -550,14 +3634,12 @@ def run_stata_command(command: str, clear_history=False):
                 if len(command_history) > 50:
                     command_history = command_history[-50:]
                 
-                # Build a string of all command history in chronological order (oldest to newest)
-                full_output = []
-                for entry in command_history:
-                    full_output.append(f">>> {entry['command']}")
-                    full_output.append(entry['result'])
-                    # No separator lines
-                    
-                return "\n".join(full_output)
+                full_output = render_command_history()
+                record_span("history_render", span_start)
+                
+                metrics_observe("stata_mcp_overhead_duration_seconds",
+                                time.perf_counter() - call_start - stata_seconds, {"kind": "command"})
+                return full_output
                 
             except Exception as e:
                 error_msg = f"Error reading log file: {str(e)}"
@@ -582,112 +3664,787 @@ def run_stata_command(command: str, clear_history=False):
         command_history.append({"command": command_entry, "result": error_msg})
         return error_msg
 
+# Function to find the .do file a run_file request refers to
+def resolve_do_file_path(file_path):
+    """Resolve a possibly relative .do file path
+
+    Returns (resolved_path, None) on success or (None, error_message) if the file cannot be used.
+    """
+    original_path = file_path
+    
+    # Normalize path separators for the current OS
+    file_path = os.path.normpath(file_path)
+    
+    # On Windows, convert forward slashes to backslashes if needed
+    if platform.system() == "Windows" and '/' in file_path:
+        file_path = file_path.replace('/', '\\')
+        logging.info(f"Converted path for Windows: {file_path}")
+    
+    # Path resolution logic for relative paths
+    if not os.path.isabs(file_path):
+        # Get the current working directory
+        cwd = os.getcwd()
+        logging.info(f"File path is not absolute. Current working directory: {cwd}")
+        
+        # Try paths in this order - add more specific path resolution for Windows
+        possible_paths = [
+            file_path,  # As provided
+            os.path.join(cwd, file_path),  # Relative to CWD
+            os.path.join(cwd, os.path.basename(file_path)),  # Just filename in CWD
+        ]
+        
+        # Add Windows-specific path checks
+        if platform.system() == "Windows":
+            # Try both forward and backward slashes on Windows
+            if '/' in file_path:
+                win_path = file_path.replace('/', '\\')
+                possible_paths.append(win_path)
+                possible_paths.append(os.path.join(cwd, win_path))
+            elif '\\' in file_path:
+                unix_path = file_path.replace('\\', '/')
+                possible_paths.append(unix_path)
+                possible_paths.append(os.path.join(cwd, unix_path))
+        
+        # Check for file in subdirectories (up to 2 levels)
+        for root, dirs, files in os.walk(cwd, topdown=True, followlinks=False):
+            if os.path.basename(file_path) in files and root != cwd:
+                subdir_path = os.path.join(root, os.path.basename(file_path))
+                if subdir_path not in possible_paths:
+                    possible_paths.append(subdir_path)
+            
+            # Limit depth to 2 levels
+            if root.replace(cwd, '').count(os.sep) >= 2:
+                dirs[:] = []  # Don't go deeper
+        
+        # Try to find the file in one of the possible paths
+        found = False
+        for test_path in possible_paths:
+            # Normalize path for comparison
+            test_path = os.path.normpath(test_path)
+            if os.path.exists(test_path) and test_path.lower().endswith('.do'):
+                file_path = test_path
+                found = True
+                logging.info(f"Found file at: {file_path}")
+                break
+        
+        if not found:
+            error_msg = f"Error: File not found: {original_path}. Tried these paths: {', '.join(possible_paths)}"
+            logging.error(error_msg)
+            
+            # Add more helpful error message for Windows
+            if platform.system() == "Windows":
+                error_msg += "\n\nCommon Windows path issues:\n"
+                error_msg += "1. Make sure the file path uses correct separators (use \\ instead of /)\n"
+                error_msg += "2. Check if the file exists in the specified location\n"
+                error_msg += "3. If using relative paths, the current working directory is: " + os.getcwd()
+            
+            return None, error_msg
+    
+    # Verify file exists (final check)
+    if not os.path.exists(file_path):
+        error_msg = f"Error: File not found: {file_path}"
+        logging.error(error_msg)
+        
+        # Add more helpful error message for Windows
+        if platform.system() == "Windows":
+            error_msg += "\n\nCommon Windows path issues:\n"
+            error_msg += "1. Make sure the file path uses correct separators (use \\ instead of /)\n"
+            error_msg += "2. Check if the file exists in the specified location\n"
+            error_msg += "3. If using relative paths, the current working directory is: " + os.getcwd()
+            
+        return None, error_msg
+        
+    # Check file extension
+    if not file_path.lower().endswith('.do'):
+        error_msg = f"Error: File must be a Stata .do file with .do extension: {file_path}"
+        logging.error(error_msg)
+        return None, error_msg
+    
+    return file_path, None
+
+# Function to build the key that identifies duplicate run_file requests
+def run_file_dedupe_key(file_path, **options):
+    """Return (normalized path, content hash, options) for a do-file, or None if it cannot be read"""
+    import hashlib
+    resolved_path, error_msg = resolve_do_file_path(file_path)
+    if error_msg:
+        return None
+    try:
+        with open(resolved_path, 'rb') as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+    return (os.path.normcase(os.path.abspath(resolved_path)), content_hash, tuple(sorted(options.items())))
+
+# Pre-flight validation - do-files are checked for structural errors (unclosed comments, strings and
+# braces, loops without an opening brace, programs without end, bad #delimit, missing do/include
+# targets) before they are queued. Comment and string delimiters come from the VS Code grammar in
+# syntaxes/stata.tmLanguage.json. Results are cached by content hash; file checks always rerun.
+preflight_enabled = True
+PREFLIGHT_CACHE_SIZE = 256
+preflight_cache = {}  # sha256 of the do-file -> (problems, references); insertion order is recency
+preflight_lock = threading.Lock()
+preflight_rules = None
+PREFLIGHT_PREFIX_RE = re.compile(r'^(?:(?:cap(?:t|tu|tur|ture)?|qui(?:e|et|etl|etly)?|n(?:oi|ois|oisi|oisil|oisily)?)\b\s*:?\s*)+')
+PREFLIGHT_DELIMIT_RE = re.compile(r'^\s*#d(?:e(?:l(?:i(?:m(?:i(?:t)?)?)?)?)?)?(?=\s|$)\s*(\S*)')
+PREFLIGHT_LOOP_RE = re.compile(r'^(foreach|forv(?:a(?:l(?:u(?:e(?:s)?)?)?)?)?|while)\b')
+PREFLIGHT_BLOCK_RE = re.compile(r'^(?:(if|else)\b|(pr(?:o(?:g(?:r(?:a(?:m)?)?)?)?)?)\s+(?:(?:define|def|de)\s+)?'
+                                r'(?!(?:drop|dir|list|di|l|li)\b)(\S+))')
+PREFLIGHT_RAW_RE = re.compile(r'^(?:(mata|python)\s*:?\s*(?:,.*)?$|(inp(?:u|ut)?)\s+[^,\s])')
+PREFLIGHT_END_RE = re.compile(r'^\s*end\s*$')
+PREFLIGHT_INCLUDE_RE = re.compile(r'^(do|include|ru|run)\s+(?:`"(.*?)"\'|"([^"]*)"|([^\s,]+))')
+PREFLIGHT_CD_RE = re.compile(r'^cd\s+(?:`"(.*?)"\'|"([^"]*)"|([^\s,]+))')
+PREFLIGHT_FREE_TEXT_RE = re.compile(r'^(?:loc(?:a(?:l)?)?|gl(?:o(?:b(?:a(?:l)?)?)?)?|char|notes?|la(?:b(?:e(?:l)?)?)?|file|macro)\b')
+
+# Function to load the comment and string rules used by the pre-flight tokenizer
+def load_preflight_rules():
+    """Compile comment/string patterns from the TextMate grammar, falling back to the same rules built in"""
+    global preflight_rules
+    if preflight_rules is not None:
+        return preflight_rules
+    rules = {"star_comment": r'^\s*\*.*$', "line_comment": r'//.*$', "block_begin": r'/\*', "block_end": r'\*/',
+             "string_begin": r'"', "string_end": r'"'}
+    grammar_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "syntaxes", "stata.tmLanguage.json")
+    try:
+        with open(grammar_path, 'r', encoding='utf-8') as f:
+            grammar = json.load(f)
+        for pattern in grammar["repository"]["comments"]["patterns"]:
+            if pattern["name"].startswith("comment.line.star"):
+                rules["star_comment"] = pattern["match"]
+            elif pattern["name"].startswith("comment.line"):
+                rules["line_comment"] = pattern["match"]
+            elif pattern["name"].startswith("comment.block"):
+                rules["block_begin"], rules["block_end"] = pattern["begin"], pattern["end"]
+        # Only double quotes delimit strings in Stata; the grammar's single-quote rule is for macro closes
+        # and its backslash escapes would misread Windows paths, so neither is used here
+        for pattern in grammar["repository"]["strings"]["patterns"]:
+            if pattern["name"].startswith("string.quoted.double"):
+                rules["string_begin"], rules["string_end"] = pattern["begin"], pattern["end"]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.debug(f"Using built-in pre-flight rules, grammar not loaded: {str(e)}")
+    preflight_rules = {name: re.compile(pattern) for name, pattern in rules.items()}
+    return preflight_rules
+
+# Function to split a do-file into commands the way Stata reads them
+def preflight_tokenize(content):
+    """Return (commands, problems); each command is (line, code, text, end line) with comments removed.
+
+    code has string contents blanked, text keeps them. mata, python and input blocks are skipped
+    up to their end line and reported as ("raw", line, kind, end line) entries; #delimit lines
+    as ("delimit", line, ";" or "cr", line).
+    """
+    rules = load_preflight_rules()
+    commands, problems = [], []
+    delimit = "cr"
+    comment_depth, comment_line = 0, 0
+    string, string_line = None, 0  # None, '"' or '`"' (with nesting depth)
+    compound_depth = 0
+    code, text, start = [], [], 0
+    raw = None  # (kind, line) while skipping a mata/python/input block
+
+    def finish(end):
+        nonlocal code, text
+        joined_code, joined_text = "".join(code).strip(), "".join(text).strip()
+        code, text = [], []
+        if joined_code:
+            commands.append((start, joined_code, joined_text, end))
+            match = PREFLIGHT_RAW_RE.match(PREFLIGHT_PREFIX_RE.sub("", joined_code))
+            if match:
+                return (match.group(1) or "input", start)
+        return None
+
+    for number, line in enumerate(content.splitlines(), 1):
+        if raw is not None:
+            if PREFLIGHT_END_RE.match(line):
+                commands.append(("raw", raw[1], raw[0], number))
+                raw = None
+            continue
+        at_start = not code and comment_depth == 0 and string is None
+        if at_start:
+            match = PREFLIGHT_DELIMIT_RE.match(line)
+            if match:
+                if match.group(1) == ";":
+                    delimit = ";"
+                elif match.group(1).rstrip(";") in ("cr", ""):
+                    delimit = "cr"
+                else:
+                    problems.append((number, "error", f"#delimit needs ; or cr, not '{match.group(1)}'"))
+                    continue
+                commands.append(("delimit", number, delimit, number))
+                continue
+            if rules["star_comment"].match(line):
+                if delimit == "cr":
+                    continue
+                # In ; mode a * comment runs to the next ;
+                end = line.find(";")
+                if end < 0:
+                    string = "*"
+                    continue
+                line = " " * (end + 1) + line[end + 1:]
+        pos = 0
+        continued = False
+        while pos < len(line):
+            if comment_depth:
+                begin = rules["block_begin"].search(line, pos)
+                end = rules["block_end"].search(line, pos)
+                if end and (not begin or end.start() < begin.start()):
+                    comment_depth -= 1
+                    pos = end.end()
+                elif begin:
+                    comment_depth += 1
+                    pos = begin.end()
+                else:
+                    break
+                continue
+            if string == "*":
+                end = line.find(";", pos)
+                if end < 0:
+                    break
+                string, pos = None, end + 1
+                continue
+            if string == '"':
+                end = rules["string_end"].search(line, pos)
+                if not end:
+                    text.append(line[pos:])
+                    break
+                text.append(line[pos:end.end()])
+                code.append('"')
+                string, pos = None, end.end()
+                continue
+            if string == '`"':
+                if line.startswith('`"', pos):
+                    compound_depth += 1
+                elif line.startswith('"\'', pos):
+                    compound_depth -= 1
+                    if compound_depth == 0:
+                        text.append('"\'')
+                        code.append('"\'')
+                        string, pos = None, pos + 2
+                        continue
+                text.append(line[pos])
+                pos += 1
+                continue
+            if not code:
+                if line[pos].isspace():
+                    pos += 1
+                    continue
+                start = number
+            spaced = pos == 0 or line[pos - 1].isspace()
+            if line.startswith('///', pos) and spaced:
+                continued = True
+                break
+            if spaced and rules["line_comment"].match(line, pos):
+                break
+            match = rules["block_begin"].match(line, pos)
+            if match:
+                comment_depth, comment_line, pos = 1, number, match.end()
+                continue
+            if line.startswith('`"', pos):
+                string, string_line, compound_depth = '`"', number, 1
+                text.append('`"')
+                code.append('`"')
+                pos += 2
+                continue
+            match = rules["string_begin"].match(line, pos)
+            if match:
+                string, string_line = '"', number
+                text.append(match.group(0))
+                code.append('"')
+                pos = match.end()
+                continue
+            if delimit == ";" and line[pos] == ";":
+                raw = finish(number)
+                if raw is not None:
+                    break
+                pos += 1
+                continue
+            code.append(line[pos])
+            text.append(line[pos])
+            pos += 1
+
+        if raw is not None:
+            continue
+        if delimit == ";" or continued or comment_depth:
+            if code:
+                code.append(" ")
+                text.append(" ")
+            continue
+        if string in ('"', '`"'):
+            problems.append((string_line, "error", "Unmatched quote: string is not closed on this line"))
+            string = None
+            code, text = [], []
+            continue
+        raw = finish(number)
+
+    if raw is not None:
+        problems.append((raw[1], "error", f"{raw[0]} block is never closed with end"))
+    if comment_depth:
+        problems.append((comment_line, "error", "/* comment is never closed with */"))
+    if string in ('"', '`"'):
+        problems.append((string_line, "error", "Unmatched quote: string is never closed"))
+    if "".join(code).strip():
+        problems.append((start, "warning", "Text after the last ; is never run (#delimit ; is in effect)"))
+    return commands, problems
+
+# Function to check the structure of tokenized do-file commands
+def preflight_structure(commands):
+    """Return (problems, references) for braces, loops, programs and do/include/cd targets"""
+    problems, references = [], []
+    blocks = []  # open braces and programs: (kind, line, label)
+    for line, code, text, _ in commands:
+        if line in ("raw", "delimit"):
+            continue
+        body = PREFLIGHT_PREFIX_RE.sub("", code)
+        body_text = PREFLIGHT_PREFIX_RE.sub("", text)
+        captured = body != code and code.lstrip().startswith("cap")
+        if body.startswith("}"):
+            if body.strip() != "}":
+                problems.append((line, "error", "Code follows on the same line as close brace }"))
+            if blocks and blocks[-1][0] == "{":
+                blocks.pop()
+            else:
+                problems.append((line, "error", "Close brace } without a matching open brace"))
+            continue
+        if PREFLIGHT_END_RE.match(body):
+            if blocks and blocks[-1][0] == "program":
+                blocks.pop()
+            elif blocks:
+                _, opened, label = blocks.pop()
+                problems.append((opened, "error", f"{label} is not closed before end on line {line}"))
+                while blocks and blocks[-1][0] != "program":
+                    _, opened, label = blocks.pop()
+                    problems.append((opened, "error", f"{label} is not closed before end on line {line}"))
+                if blocks:
+                    blocks.pop()
+            else:
+                problems.append((line, "warning", "end without a program define"))
+            continue
+
+        loop = PREFLIGHT_LOOP_RE.match(body)
+        block = PREFLIGHT_BLOCK_RE.match(body)
+        if block and block.group(2):
+            blocks.append(("program", line, f"program {block.group(3)}"))
+        elif loop or (block and block.group(1)):
+            keyword = loop.group(1) if loop else block.group(1)
+            brace = body.find("{")
+            if 0 <= brace < len(body.rstrip()) - 1:
+                problems.append((line, "error", f"Code follows on the same line as the open brace of {keyword}"))
+            elif body.rstrip().endswith("{"):
+                blocks.append(("{", line, f"{keyword} block"))
+            elif loop:
+                problems.append((line, "error", f"{keyword} loop has no open brace at the end of the line"))
+        elif body.rstrip().endswith("{"):
+            blocks.append(("{", line, "{ block"))
+
+        # Brackets can be balanced through macros (global opts "vce(robust" ... $opts)), so only warn
+        if not PREFLIGHT_FREE_TEXT_RE.match(body):
+            depth = {"(": 0, "[": 0}
+            for char in body:
+                if char in "([":
+                    depth[char] += 1
+                elif char in ")]":
+                    depth["(" if char == ")" else "["] -= 1
+                    if min(depth.values()) < 0:
+                        break
+            for opener, closer in (("(", ")"), ("[", "]")):
+                if depth[opener] < 0:
+                    problems.append((line, "warning", f"Unmatched {closer}"))
+                elif depth[opener] > 0:
+                    problems.append((line, "warning", f"Unmatched {opener}"))
+
+        match = PREFLIGHT_INCLUDE_RE.match(body_text) or PREFLIGHT_CD_RE.match(body_text)
+        if match:
+            kind = match.group(0).split()[0]
+            path = next(group for group in match.groups()[-3:] if group is not None)
+            references.append((line, "cd" if kind == "cd" else "do", path, captured))
+
+    for kind, opened, label in blocks:
+        problems.append((opened, "error", f"{label} is never closed" + (" with end" if kind == "program" else " with }")))
+    return problems, references
+
+# Function to check that files run by do/include exist
+def preflight_references(references, base_dir):
+    """Return warnings for do/include/run targets that do not exist, following literal cd commands
+
+    The do-file may write a target before running it (file open ... using gen.do), so a missing file
+    is not an error.
+    """
+    problems = []
+    for line, kind, path, captured in references:
+        if "`" in path or "$" in path:
+            if kind == "cd":
+                return problems  # the directory is only known at run time
+            continue
+        path = os.path.expanduser(path)
+        if kind == "cd":
+            base_dir = os.path.normpath(os.path.join(base_dir, path))
+            continue
+        if not os.path.splitext(path)[1]:
+            path += ".do"
+        candidates = [path] if os.path.isabs(path) else [os.path.join(base_dir, path), os.path.join(os.getcwd(), path)]
+        if not captured and not any(os.path.isfile(candidate) for candidate in candidates):
+            problems.append((line, "warning", f"File not found: {path}"))
+    return problems
+
+# Function to run the pre-flight check on a do-file
+def preflight_check(file_path):
+    """Return a list of (line, severity, message) problems for a do-file; cached by content hash"""
+    import hashlib
+    with open(file_path, 'rb') as f:
+        raw = f.read()
+    key = hashlib.sha256(raw).hexdigest()
+    with preflight_lock:
+        cached = preflight_cache.pop(key, None)
+        if cached is not None:
+            preflight_cache[key] = cached
+    if cached is not None:
+        metrics_inc("stata_mcp_preflight_cache_hits_total")
+    else:
+        commands, problems = preflight_tokenize(raw.decode('utf-8', errors='replace'))
+        structure, references = preflight_structure(commands)
+        cached = (sorted(problems + structure), references)
+        with preflight_lock:
+            preflight_cache[key] = cached
+            while len(preflight_cache) > PREFLIGHT_CACHE_SIZE:
+                preflight_cache.pop(next(iter(preflight_cache)))
+    problems, references = cached
+    return sorted(problems + preflight_references(references, os.path.dirname(os.path.abspath(file_path))))
+
+# Function to format pre-flight problems for a response
+def format_preflight_problems(file_path, problems):
+    """One line per problem, errors and warnings"""
+    lines = [f"Pre-flight check of {file_path}:"]
+    lines.extend(f"  line {line}: {severity}: {message}" for line, severity, message in problems)
+    return "\n".join(lines)
+
+class PreflightError(Exception):
+    """Raised when a do-file fails the pre-flight check; problems are (line, severity, message)"""
+
+    def __init__(self, file_path, problems):
+        super().__init__(format_preflight_problems(file_path, problems))
+        self.file_path = file_path
+        self.problems = problems
+
+# Function to reject structurally broken do-files before they are queued
+def preflight_do_file(file_path):
+    """Raise PreflightError if the do-file has errors; files that cannot be resolved are left to the run"""
+    if not preflight_enabled:
+        return
+    resolved_path, error_msg = resolve_do_file_path(file_path)
+    if error_msg:
+        return
+    start = time.perf_counter()
+    try:
+        problems = preflight_check(resolved_path)
+    except OSError:
+        return
+    errors = [problem for problem in problems if problem[1] == "error"]
+    metrics_inc("stata_mcp_preflight_checks_total", labels={"result": "rejected" if errors else "passed"})
+    logging.debug(f"Pre-flight check of {resolved_path} took {(time.perf_counter() - start) * 1000:.2f} ms")
+    for line, severity, message in problems:
+        if severity == "warning":
+            logging.warning(f"Pre-flight {resolved_path} line {line}: {message}")
+    if errors:
+        raise PreflightError(resolved_path, problems)
+
+# Do-file profiling - profile=true instruments the rewritten do-file with Stata timers: one around
+# each top-level command or block, and one around each command inside loop and if bodies. After each
+# top-level unit, _mcp_prof_off (an ado-file in the scratch area) appends the timer totals and call
+# counts to a TSV file, so loop bodies of any length fit in Stata's 100 timers.
+PROFILE_TAG = "// mcp-profile"
+PROFILE_TOP_N = 20
+PROFILE_TIMER_RE = re.compile(r'\btimer\s+(?:on|off|clear)\s+(\d+)')
+PROFILE_ESCAPE_RE = re.compile(r'^(?:(?:if|else)\b.*?\s)?(?:continue|exit)\b')
+PROFILE_ELSE_RE = re.compile(r'^else\b')
+
+# Flushes the timers of one top-level unit: args are the unit's timer and line, then timer:line
+# pairs for the commands inside it. r() is held so the do-file's own results are untouched.
+PROFILE_ADO = r"""*! Do-file profiler timers, written by the Stata MCP server
+program define _mcp_prof_off
+    version 14
+    args timer line
+    timer off `timer'
+    _return hold mcp_profile_r
+    quietly timer list
+    tempname fh
+    file open `fh' using `"$MCP_PROFILE_FILE"', write append text
+    file write `fh' "`line'" _tab %18.6f (r(t`timer')) _tab %12.0f (r(nt`timer')) _n
+    timer clear `timer'
+    macro shift 2
+    while `"`1'"' != "" {
+        gettoken pair_timer pair_line : 1, parse(":")
+        local pair_line : subinstr local pair_line ":" ""
+        file write `fh' "`pair_line'" _tab %18.6f (r(t`pair_timer')) _tab %12.0f (r(nt`pair_timer')) _n
+        timer clear `pair_timer'
+        macro shift
+    }
+    file close `fh'
+    _return restore mcp_profile_r
+end
+"""
+
+# Function to group tokenized do-file commands into the units the profiler times
+def profile_units(commands):
+    """Return the top-level units as dicts (start, end, command, kind, children, escapes)
+
+    Braced blocks with their else branches, programs, mata/python/input blocks and #delimit ;
+    regions are single units; the commands inside braces are the unit's children.
+    """
+    position = 0
+
+    def parse(inside):
+        nonlocal position
+        units = []
+        while position < len(commands):
+            line, code, text, end = commands[position]
+            position += 1
+            if line == "delimit":
+                if text == ";":
+                    if inside:
+                        raise ValueError(f"#delimit ; inside a block (line {end}) is not supported")
+                    start = end
+                    while position < len(commands) and not (commands[position][0] == "delimit"
+                                                            and commands[position][2] == "cr"):
+                        position += 1
+                    closed = position < len(commands)
+                    end = commands[position][3] if closed else max(start, *(c[3] for c in commands))
+                    position += closed
+                    units.append({"start": start, "end": end, "command": "#delimit ; block", "kind": "block",
+                                  "children": [], "escapes": False, "reset_delimit": not closed})
+                continue
+            if line == "raw":
+                continue
+            body = PREFLIGHT_PREFIX_RE.sub("", code)
+            if body.startswith("}"):
+                if inside:
+                    return units, end
+                raise ValueError(f"close brace on line {line} has no matching open brace")
+            unit = {"start": line, "end": end, "command": text, "kind": "command", "children": [],
+                    "escapes": bool(PROFILE_ESCAPE_RE.match(body))}
+            block = PREFLIGHT_BLOCK_RE.match(body)
+            if block and block.group(2):
+                unit["kind"] = "program"
+                while position < len(commands):
+                    position += 1
+                    entry = commands[position - 1]
+                    if entry[0] not in ("raw", "delimit") and PREFLIGHT_END_RE.match(entry[1]):
+                        unit["end"] = entry[3]
+                        break
+                else:
+                    raise ValueError(f"program on line {line} is never closed with end")
+            elif PREFLIGHT_RAW_RE.match(body):
+                unit["kind"] = "block"
+                if position < len(commands) and commands[position][0] == "raw":
+                    unit["end"] = commands[position][3]
+                    position += 1
+            elif body.rstrip().endswith("{"):
+                unit["kind"] = "loop" if PREFLIGHT_LOOP_RE.match(body) else "block"
+                unit["children"], unit["end"] = parse(True)
+            # else branches belong to the if before them
+            while (position < len(commands) and commands[position][0] not in ("raw", "delimit")
+                   and PROFILE_ELSE_RE.match(PREFLIGHT_PREFIX_RE.sub("", commands[position][1]))):
+                _, else_code, _, unit["end"] = commands[position]
+                position += 1
+                unit["escapes"] = unit["escapes"] or bool(PROFILE_ESCAPE_RE.match(PREFLIGHT_PREFIX_RE.sub("", else_code)))
+                if else_code.rstrip().endswith("{"):
+                    children, unit["end"] = parse(True)
+                    unit["children"].extend(children)
+            # continue and exit leave the enclosing blocks up to the nearest loop without reaching
+            # their timer off, so those blocks are not timed
+            if unit["kind"] != "loop" and any(child["escapes"] for child in unit["children"]):
+                unit["escapes"] = True
+            units.append(unit)
+        if inside:
+            raise ValueError("a block is never closed with }")
+        return units, None
+
+    return parse(False)[0]
+
+# Function to pick the Stata timers the profiler may use
+def profile_timers(content):
+    """Return the timer numbers (1-100) the do-file does not use itself"""
+    used = {int(number) for number in PROFILE_TIMER_RE.findall(content)}
+    free = [number for number in range(1, 101) if number not in used]
+    if len(free) < 2:
+        raise ValueError("the do-file uses all of Stata's timers")
+    return free
+
+# Function to instrument do-file content with profiling timers
+def instrument_do_file(content, timers, first_line=1):
+    """Return (instrumented content, {line: {"command", "kind", "depth"}} for every timed unit)
+
+    first_line is the file line number of the content's first line. The highest free timer times
+    top-level units; the others time the commands inside them, in order, until they run out.
+    Raises ValueError when the do-file's structure cannot be instrumented.
+    """
+    commands, problems = preflight_tokenize(content)
+    errors = [f"line {line + first_line - 1}: {message}" for line, severity, message in problems if severity == "error"]
+    if errors:
+        raise ValueError(errors[0])
+    outer, inner = timers[-1], timers[:-1]
+    before, after = {}, {}
+    profiled = {}
+
+    def visit(units, depth, available, pairs):
+        for unit in units:
+            if unit["escapes"] or not available:
+                continue
+            timer = available.pop(0)
+            line = unit["start"] + first_line - 1
+            before.setdefault(unit["start"], []).append(f"timer on {timer} {PROFILE_TAG}")
+            visit(unit["children"], depth + 1, available, pairs)
+            after.setdefault(unit["end"], []).append(f"timer off {timer} {PROFILE_TAG}")
+            pairs.append(f"{timer}:{line}")
+            profiled[line] = {"command": unit["command"], "kind": unit["kind"], "depth": depth}
+
+    for unit in profile_units(commands):
+        if unit["escapes"]:
+            continue
+        line = unit["start"] + first_line - 1
+        pairs = []
+        before.setdefault(unit["start"], []).append(f"timer on {outer} {PROFILE_TAG}")
+        visit(unit["children"], 1, list(inner), pairs)
+        if unit.get("reset_delimit"):
+            after.setdefault(unit["end"], []).append("#delimit cr")
+        after.setdefault(unit["end"], []).append(
+            f"_mcp_prof_off {outer} {line}{''.join(' ' + pair for pair in pairs)} {PROFILE_TAG}")
+        profiled[line] = {"command": unit["command"], "kind": unit["kind"], "depth": 0}
+
+    # Inserted lines take the indentation of the line they are attached to, so the log stays readable
+    lines = []
+    for number, text in enumerate(content.splitlines(), start=1):
+        indent = text[:len(text) - len(text.lstrip())]
+        lines.extend(indent + inserted for inserted in before.get(number, []))
+        lines.append(text)
+        lines.extend(indent + inserted for inserted in after.get(number, []))
+    return "\n".join(lines) + "\n", profiled
+
+# Function to prepare Stata for a profiled run
+def profile_setup_commands(profile_file, timers):
+    """Stata code that puts _mcp_prof_off on the adopath and points it at profile_file"""
+    ado_dir = os.path.join(scratch_area.directory, "profiler")
+    os.makedirs(ado_dir, exist_ok=True)
+    ado_file = os.path.join(ado_dir, "_mcp_prof_off.ado")
+    if not os.path.exists(ado_file):
+        with open(ado_file, 'w') as f:
+            f.write(PROFILE_ADO)
+    lines = [f'quietly adopath ++ "{ado_dir}"', f'global MCP_PROFILE_FILE "{profile_file}"']
+    # Timers left running by a failed earlier run would add to this run's times
+    lines.extend(f"capture timer off {timer}\ncapture timer clear {timer}" for timer in timers)
+    return "\n".join(lines) + "\n"
+
+# Function to undo profile_setup_commands
+def profile_teardown_commands(timers):
+    ado_dir = os.path.join(scratch_area.directory, "profiler")
+    lines = [f'capture adopath - "{ado_dir}"', "macro drop MCP_PROFILE_FILE"]
+    lines.extend(f"capture timer off {timer}\ncapture timer clear {timer}" for timer in timers)
+    return "\n".join(lines) + "\n"
+
+# Function to drop the profiler's instrumentation from log lines
+def strip_profile_lines(lines):
+    """Remove echoed timer lines, including _mcp_prof_off calls the log wrapped over "> " lines"""
+    kept = []
+    wrapped = False
+    for line in lines:
+        if wrapped and line.startswith(">"):
+            wrapped = not line.rstrip().endswith(PROFILE_TAG)
+            continue
+        wrapped = "_mcp_prof_off" in line and not line.rstrip().endswith(PROFILE_TAG)
+        if not wrapped and not line.rstrip().endswith(PROFILE_TAG):
+            kept.append(line)
+    return kept
+
+# Function to rank the profiled commands of a run
+def read_profile(profile_file, profiled):
+    """Return rows (line, command, kind, depth, calls, seconds, mean_seconds, percent), slowest first"""
+    totals = {}
+    try:
+        with open(profile_file, 'r', encoding='utf-8', errors='replace') as f:
+            for row in f:
+                fields = row.strip().split("\t")
+                if len(fields) != 3:
+                    continue
+                try:
+                    line = int(fields[0])
+                    seconds = float(fields[1])
+                    calls = int(float(fields[2]))
+                except ValueError:
+                    continue  # missing (.) for a timer that never ran
+                entry = totals.setdefault(line, [0.0, 0])
+                entry[0] += seconds
+                entry[1] += calls
+    except FileNotFoundError:
+        return []
+    total = sum(seconds for line, (seconds, _) in totals.items() if profiled.get(line, {}).get("depth") == 0)
+    rows = []
+    for line, (seconds, calls) in totals.items():
+        if line not in profiled or not calls:
+            continue
+        rows.append({"line": line, "command": profiled[line]["command"], "kind": profiled[line]["kind"],
+                     "depth": profiled[line]["depth"], "calls": calls, "seconds": round(seconds, 3),
+                     "mean_seconds": round(seconds / calls, 4),
+                     "percent": round(100.0 * seconds / total, 1) if total > 0 else 0.0})
+    rows.sort(key=lambda row: (-row["seconds"], row["line"]))
+    return rows
+
+# Function to format the profile table appended to a run's output
+def format_profile(rows, limit=PROFILE_TOP_N):
+    total = sum(row["seconds"] for row in rows if row["depth"] == 0)
+    lines = ["", f"Profile ({total:.2f}s measured; times include the commands nested inside):",
+             f"  {'line':>6} {'calls':>7} {'total s':>9} {'mean s':>9} {'%':>6}  command"]
+    for row in rows[:limit]:
+        command = ("  " * row["depth"]) + " ".join(row["command"].split())
+        if len(command) > 70:
+            command = command[:67] + "..."
+        lines.append(f"  {row['line']:>6} {row['calls']:>7} {row['seconds']:>9.3f} {row['mean_seconds']:>9.4f} "
+                     f"{row['percent']:>5.1f}%  {command}")
+    if len(rows) > limit:
+        lines.append(f"  ... {len(rows) - limit} more (see the job's profile)")
+    return "\n".join(lines)
+
 def run_stata_selection(selection):
     """Run selected Stata code"""
     return run_stata_command(selection)
 
-def run_stata_file(file_path: str, timeout=600):
+def run_stata_file(file_path: str, timeout=600, preemptible=False, incremental=False, profile=False):
     """Run a Stata .do file with improved handling for long-running processes
     
     Args:
         file_path: The path to the .do file to run
         timeout: Timeout in seconds (default: 600 seconds / 10 minutes)
+        preemptible: Run the file block by block (split at "** #" section markers) and let
+            higher-priority jobs run between blocks. Local macros do not carry across blocks.
+        incremental: Run the file block by block, checkpoint data and globals after each
+            block, and resume after the last block whose text (and predecessors) are unchanged.
+        profile: Time every command with Stata timers and append a table of the slowest
+            commands (line, calls, total and mean seconds) to the output.
     """
+    with scratch_area.session("dofile"):
+        before = graph_snapshot()
+        result = _run_stata_file(file_path, timeout, preemptible, incremental, profile)
+        if before is not None and not result.startswith("Error"):
+            try:
+                graphs = capture_graphs(before)
+            except Exception as e:
+                logging.warning(f"Graph capture failed: {str(e)}")
+                graphs = []
+            if graphs:
+                result += "\n\n" + format_graph_report(graphs)
+        return result
+
+def _run_stata_file(file_path: str, timeout=600, preemptible=False, incremental=False, profile=False):
+    """Run a Stata .do file (see run_stata_file)"""
     # Set timeout from parameter instead of hardcoding
     MAX_TIMEOUT = timeout
+    call_start = time.perf_counter()
     
     try:
-        original_path = file_path
-        
-        # Normalize path separators for the current OS
-        file_path = os.path.normpath(file_path)
-        
-        # On Windows, convert forward slashes to backslashes if needed
-        if platform.system() == "Windows" and '/' in file_path:
-            file_path = file_path.replace('/', '\\')
-            logging.info(f"Converted path for Windows: {file_path}")
-        
-        # Path resolution logic for relative paths
-        if not os.path.isabs(file_path):
-            # Get the current working directory
-            cwd = os.getcwd()
-            logging.info(f"File path is not absolute. Current working directory: {cwd}")
-            
-            # Try paths in this order - add more specific path resolution for Windows
-            possible_paths = [
-                file_path,  # As provided
-                os.path.join(cwd, file_path),  # Relative to CWD
-                os.path.join(cwd, os.path.basename(file_path)),  # Just filename in CWD
-            ]
-            
-            # Add Windows-specific path checks
-            if platform.system() == "Windows":
-                # Try both forward and backward slashes on Windows
-                if '/' in file_path:
-                    win_path = file_path.replace('/', '\\')
-                    possible_paths.append(win_path)
-                    possible_paths.append(os.path.join(cwd, win_path))
-                elif '\\' in file_path:
-                    unix_path = file_path.replace('\\', '/')
-                    possible_paths.append(unix_path)
-                    possible_paths.append(os.path.join(cwd, unix_path))
-            
-            # Check for file in subdirectories (up to 2 levels)
-            for root, dirs, files in os.walk(cwd, topdown=True, followlinks=False):
-                if os.path.basename(file_path) in files and root != cwd:
-                    subdir_path = os.path.join(root, os.path.basename(file_path))
-                    if subdir_path not in possible_paths:
-                        possible_paths.append(subdir_path)
-                
-                # Limit depth to 2 levels
-                if root.replace(cwd, '').count(os.sep) >= 2:
-                    dirs[:] = []  # Don't go deeper
-            
-            # Try to find the file in one of the possible paths
-            found = False
-            for test_path in possible_paths:
-                # Normalize path for comparison
-                test_path = os.path.normpath(test_path)
-                if os.path.exists(test_path) and test_path.lower().endswith('.do'):
-                    file_path = test_path
-                    found = True
-                    logging.info(f"Found file at: {file_path}")
-                    break
-            
-            if not found:
-                error_msg = f"Error: File not found: {original_path}. Tried these paths: {', '.join(possible_paths)}"
-                logging.error(error_msg)
-                
-                # Add more helpful error message for Windows
-                if platform.system() == "Windows":
-                    error_msg += "\n\nCommon Windows path issues:\n"
-                    error_msg += "1. Make sure the file path uses correct separators (use \\ instead of /)\n"
-                    error_msg += "2. Check if the file exists in the specified location\n"
-                    error_msg += "3. If using relative paths, the current working directory is: " + os.getcwd()
-                
-                return error_msg
-        
-        # Verify file exists (final check)
-        if not os.path.exists(file_path):
-            error_msg = f"Error: File not found: {file_path}"
-            logging.error(error_msg)
-            
-            # Add more helpful error message for Windows
-            if platform.system() == "Windows":
-                error_msg += "\n\nCommon Windows path issues:\n"
-                error_msg += "1. Make sure the file path uses correct separators (use \\ instead of /)\n"
-                error_msg += "2. Check if the file exists in the specified location\n"
-                error_msg += "3. If using relative paths, the current working directory is: " + os.getcwd()
-                
-            return error_msg
-            
-        # Check file extension
-        if not file_path.lower().endswith('.do'):
-            error_msg = f"Error: File must be a Stata .do file with .do extension: {file_path}"
-            logging.error(error_msg)
+        file_path, error_msg = resolve_do_file_path(file_path)
+        if error_msg:
             return error_msg
 
         logging.info(f"Running Stata do file: {file_path}")
+        record_span("path_resolve", call_start)
         
         # Get the directory and filename for later use
         do_file_dir = os.path.dirname(file_path)
@@ -699,6 +4456,7 @@ def run_stata_file(file_path: str, timeout=600):
         logging.info(f"Will save log to: {custom_log_file}")
         
         # Read the do file content
+        span_start = time.perf_counter()
         do_file_content = ""
         try:
             with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
@@ -719,17 +4477,72 @@ def run_stata_file(file_path: str, timeout=600):
             
             logging.info(f"Found and commented out {log_commands_found} log commands in the do file")
             
-            # Save the modified content to a temporary file
-            with tempfile.NamedTemporaryFile(suffix='.do', delete=False, mode='w') as temp_do:
-                # First close any existing log files
-                temp_do.write(f"capture log close _all\n")
-                # Then add our own log command
-                temp_do.write(f"log using \"{custom_log_file}\", replace text\n")
-                temp_do.write(modified_content)
-                temp_do.write(f"\ncapture log close _all\n")  # Ensure all logs are closed at the end
-                modified_do_file = temp_do.name
+            # Split into blocks when preemption points or checkpoints are requested; each block gets its own do file
+            if preemptible or incremental:
+                blocks = split_do_file_blocks(modified_content)
+            else:
+                blocks = [{"title": "", "text": modified_content}]
+            
+            # Profiling instruments each block on its own; rows keep the line numbers of the original file
+            profiled = {}
+            profile_note = ""
+            if profile:
+                try:
+                    profile_timer_numbers = profile_timers(modified_content)
+                    instrumented = []
+                    first_line = 1
+                    for block in blocks:
+                        text, units = instrument_do_file(block["text"], profile_timer_numbers, first_line)
+                        instrumented.append(text)
+                        profiled.update(units)
+                        first_line += block["text"].count("\n")
+                    for block, text in zip(blocks, instrumented):
+                        block["profiled"] = text
+                    logging.info(f"Profiling {len(profiled)} commands")
+                except ValueError as e:
+                    profiled = {}
+                    profile_note = f"\nProfiling skipped: {str(e)}\n"
+                    logging.warning(f"Profiling skipped for {file_path}: {str(e)}")
+            
+            # Incremental runs skip the leading blocks that still have a valid checkpoint. If nothing
+            # changed, the last block is run again from the previous checkpoint so there is fresh output.
+            first_block = 0
+            if incremental:
+                checkpoint_dir = checkpoint_directory(file_path)
+                os.makedirs(checkpoint_dir, exist_ok=True)
+                block_hashes = block_chain_hashes(blocks)
+                manifest = load_checkpoint_manifest(checkpoint_dir)
+                first_block = min(find_resume_point(manifest, block_hashes, checkpoint_dir), len(blocks) - 1)
+                manifest = {"file_path": file_path, "blocks": manifest.get("blocks", [])[:first_block]}
+                save_checkpoint_manifest(checkpoint_dir, manifest)
+                logging.info(f"Incremental run: {len(blocks)} blocks, resuming at block {first_block + 1}")
+            
+            block_do_files = []
+            for index, block in enumerate(blocks[first_block:], start=first_block):
+                # Save the modified content to a scratch file (removed when the run ends)
+                block_do_file = scratch_area.new_file('.do')
+                with open(block_do_file, 'w') as temp_do:
+                    # Restore the state saved after the previous block before resuming
+                    if incremental and index == first_block and first_block > 0:
+                        previous = manifest["blocks"][first_block - 1]
+                        temp_do.write(checkpoint_restore_commands(os.path.join(checkpoint_dir, previous["data"]),
+                                                                  os.path.join(checkpoint_dir, previous["globals"])))
+                    # First close any existing log files
+                    temp_do.write(f"capture log close _all\n")
+                    # Then add our own log command (later blocks append to the same log)
+                    temp_do.write(f"log using \"{custom_log_file}\", {'replace' if index == first_block else 'append'} text\n")
+                    temp_do.write(block.get("profiled", block["text"]))
+                    temp_do.write(f"\ncapture log close _all\n")  # Ensure all logs are closed at the end
+                    # Checkpoint after the log is closed so it does not show up in the output
+                    if incremental:
+                        temp_do.write(checkpoint_save_commands(os.path.join(checkpoint_dir, f"block_{index + 1}.dta"),
+                                                               os.path.join(checkpoint_dir, f"block_{index + 1}_globals.do")))
+                    block_do_files.append(block_do_file)
+            modified_do_file = block_do_files[0]
                 
-            logging.info(f"Created modified do file at {modified_do_file}")
+            logging.info(f"Created modified do file at {modified_do_file}" +
+                         (f" ({len(block_do_files)} blocks)" if len(block_do_files) > 1 else ""))
+            record_span("do_file_rewrite", span_start)
                 
         except Exception as e:
             error_msg = f"Error processing do file: {str(e)}"
@@ -777,22 +4590,62 @@ def run_stata_file(file_path: str, timeout=600):
                 # Execute command via PyStata in separate thread to allow polling
                 stata_thread = None
                 stata_error = None
+                stata_seconds = 0.0
+                preempted_seconds = 0.0
+                preempted_since = None  # set while other jobs hold Stata at a preemption point
+                block_timings = []
+                trace = current_trace()
+                job = current_job()
+                profile_file = None
+                if profiled:
+                    profile_file = scratch_area.new_file('.tsv', prefix="profile")
+                    profile_setup = scratch_area.new_file('.do', prefix="profile")
+                    with open(profile_setup, 'w') as f:
+                        f.write(profile_setup_commands(profile_file, profile_timer_numbers))
+                    stata_backend.run(f'run "{profile_setup}"', echo=False)
                 
                 def run_stata_thread():
+                    nonlocal stata_error, stata_seconds, preempted_seconds, preempted_since
                     try:
-                        # Make sure to properly quote the path - this is the key fix
-                        if platform.system() == "Windows":
-                            # Make sure Windows paths are properly escaped
-                            globals()['stata'].run(do_command, echo=False)
-                        else:
-                            # On macOS/Linux, double-check the quoting - adding extra safety
-                            if not (do_command.startswith('do "') or do_command.startswith("do '")):
-                                do_command_fixed = f'do "{stata_path}"'
-                                globals()['stata'].run(do_command_fixed, echo=False)
+                        for index, block_do_file in enumerate(block_do_files):
+                            if index == 0:
+                                block_command = do_command
                             else:
-                                globals()['stata'].run(do_command, echo=False)
+                                if preemptible and job is not None:
+                                    # Let higher-priority jobs run between blocks; the watchdog pauses meanwhile.
+                                    # preempted_seconds is updated before preempted_since is cleared, so the
+                                    # watchdog (which reads them in the opposite order) never misses the pause
+                                    preempted_since = time.time()
+                                    try:
+                                        stata_scheduler.preemption_point(job)
+                                    finally:
+                                        preempted_seconds += time.time() - preempted_since
+                                        preempted_since = None
+                                block_command = f'do "{block_do_file}"'
+                            # Make sure to properly quote the path - this is the key fix
+                            if platform.system() != "Windows" and not (block_command.startswith('do "') or block_command.startswith("do '")):
+                                # On macOS/Linux, double-check the quoting - adding extra safety
+                                block_command = f'do "{block_do_file}"'
+                            block_start = time.perf_counter()
+                            try:
+                                stata_seconds += timed_stata_run(block_command, "file", trace)
+                            except Exception:
+                                block_timings.append({"status": "failed", "seconds": time.perf_counter() - block_start})
+                                raise
+                            block_timings.append({"status": "done", "seconds": time.perf_counter() - block_start})
+                            if incremental:
+                                # The checkpoint files were written by the block's do file; record them
+                                block_number = first_block + index + 1
+                                manifest["blocks"].append({
+                                    "title": blocks[block_number - 1]["title"],
+                                    "hash": block_hashes[block_number - 1],
+                                    "data": f"block_{block_number}.dta",
+                                    "globals": f"block_{block_number}_globals.do",
+                                    "seconds": round(block_timings[-1]["seconds"], 3),
+                                    "finished_at": time.time(),
+                                })
+                                save_checkpoint_manifest(checkpoint_dir, manifest)
                     except Exception as e:
-                        nonlocal stata_error
                         stata_error = str(e)
                 
                 import threading
@@ -801,14 +4654,25 @@ def run_stata_file(file_path: str, timeout=600):
                 stata_thread.start()
                 
                 # Poll for progress while command is running
+                poll_start = time.perf_counter()
                 while stata_thread.is_alive():
                     # Check for timeout
                     current_time = time.time()
-                    elapsed_time = current_time - start_time
+                    # Time spent running other jobs at preemption points does not count towards the timeout,
+                    # and no break is sent while one of them holds Stata
+                    paused_since = preempted_since
+                    elapsed_time = current_time - start_time - preempted_seconds
+                    if paused_since is not None:
+                        elapsed_time -= current_time - paused_since
                     
-                    if elapsed_time > MAX_TIMEOUT:
+                    if elapsed_time > MAX_TIMEOUT and paused_since is None:
                         logging.warning(f"Execution timed out after {MAX_TIMEOUT} seconds")
+                        metrics_inc("stata_mcp_timeouts_total")
                         result += f"\n*** TIMEOUT: Execution exceeded {MAX_TIMEOUT} seconds ({MAX_TIMEOUT/60:.1f} minutes) ***\n"
+                        if job is not None and job.prediction is not None:
+                            result += (f"Earlier runs of this file took {job.prediction['seconds']:.0f}s typically and "
+                                       f"{job.prediction['max_seconds']:.0f}s at most; suggested timeout: "
+                                       f"{job.prediction['suggested_timeout']} seconds\n")
                         
                         # Force terminate Stata operation with increasing severity
                         termination_successful = False
@@ -816,8 +4680,9 @@ def run_stata_file(file_path: str, timeout=600):
                         try:
                             # ATTEMPT 1: Send Stata break command
                             logging.warning(f"TIMEOUT - Attempt 1: Sending Stata break command")
+                            metrics_inc("stata_mcp_kills_total", labels={"method": "break"})
                             try:
-                                globals()['stata'].run("break", echo=False)
+                                stata_backend.cancel()
                                 time.sleep(0.5)  # Give it a moment
                                 if not stata_thread.is_alive():
                                     termination_successful = True
@@ -828,6 +4693,7 @@ def run_stata_file(file_path: str, timeout=600):
                             # ATTEMPT 2: Try to forcibly raise an exception in the thread
                             if not termination_successful and hasattr(stata_thread, "_stop"):
                                 logging.warning(f"TIMEOUT - Attempt 2: Forcing thread stop")
+                                metrics_inc("stata_mcp_kills_total", labels={"method": "thread_stop"})
                                 try:
                                     # This is a more aggressive approach
                                     # The _stop method is not officially supported but often works
@@ -842,19 +4708,9 @@ def run_stata_file(file_path: str, timeout=600):
                             # ATTEMPT 3: Try to find and kill the Stata process (last resort)
                             if not termination_successful:
                                 logging.warning(f"TIMEOUT - Attempt 3: Looking for Stata process to terminate")
+                                metrics_inc("stata_mcp_kills_total", labels={"method": "process_kill"})
                                 try:
-                                    # Find any Stata processes
-                                    if platform.system() == "Windows":
-                                        # Windows approach
-                                        subprocess.run(["taskkill", "/F", "/IM", "stata*.exe"], 
-                                                      stdout=subprocess.DEVNULL, 
-                                                      stderr=subprocess.DEVNULL)
-                                    else:
-                                        # macOS/Linux approach
-                                        subprocess.run(["pkill", "-f", "stata"], 
-                                                      stdout=subprocess.DEVNULL, 
-                                                      stderr=subprocess.DEVNULL)
-                                    
+                                    stata_backend.cancel(force=True)
                                     logging.warning("Sent kill signal to Stata processes")
                                 except Exception as e:
                                     logging.error(f"Process kill failed: {str(e)}")
@@ -877,9 +4733,11 @@ def run_stata_file(file_path: str, timeout=600):
                             
                             # If log has grown, report progress
                             if current_log_size > last_log_size:
+                                span_start = time.perf_counter()
                                 try:
                                     with open(custom_log_file, 'r', encoding='utf-8', errors='replace') as log:
                                         log_content = log.read()
+                                        metrics_inc("stata_mcp_log_bytes_read_total", len(log_content.encode('utf-8')))
                                         lines = log_content.splitlines()
                                         
                                         # Report only new lines since last update
@@ -887,17 +4745,23 @@ def run_stata_file(file_path: str, timeout=600):
                                             new_lines = lines[last_reported_lines:]
                                             
                                             # Only report meaningful lines (skip empty lines and headers)
-                                            meaningful_lines = [line for line in new_lines if line.strip() and not line.startswith('-')]
+                                            meaningful_lines = [line for line in strip_profile_lines(new_lines)
+                                                                if line.strip() and not line.startswith('-')]
                                             
                                             # If we have meaningful content, add it to result
                                             if meaningful_lines:
                                                 progress_update = f"\n*** Progress update ({elapsed_time:.0f} seconds) ***\n"
                                                 progress_update += "\n".join(meaningful_lines[-10:])  # Show last 10 lines
+                                                if job is not None and job.resource_monitor is not None:
+                                                    progress_update += "\n" + job.resource_monitor.progress_line()
+                                                if job is not None and job.prediction is not None:
+                                                    progress_update += "\n" + runtime_eta_line(job)
                                                 result += progress_update
                                             
                                             last_reported_lines = len(lines)
                                 except Exception as e:
                                     logging.warning(f"Error reading log for progress update: {str(e)}")
+                                record_span("progress_read", span_start)
                             
                             last_log_size = current_log_size
                         
@@ -913,12 +4777,32 @@ def run_stata_file(file_path: str, timeout=600):
                     
                     # Sleep briefly to avoid consuming too much CPU
                     time.sleep(0.5)
+                record_span("poll_wait", poll_start)
+                
+                profile_report = ""
+                if profile_file is not None:
+                    if not stata_thread.is_alive():
+                        profile_teardown = scratch_area.new_file('.do', prefix="profile")
+                        with open(profile_teardown, 'w') as f:
+                            f.write(profile_teardown_commands(profile_timer_numbers))
+                        try:
+                            stata_backend.run(f'run "{profile_teardown}"', echo=False)
+                        except Exception as e:
+                            logging.warning(f"Profiler cleanup failed: {str(e)}")
+                    profile_rows = read_profile(profile_file, profiled)
+                    if job is not None:
+                        job.profile = profile_rows
+                    if profile_rows:
+                        profile_report = format_profile(profile_rows) + "\n"
                 
                 # Thread completed or timed out
                 if stata_error:
                     error_msg = f"Error executing Stata command: {stata_error}"
                     logging.error(error_msg)
                     result += f"\n*** ERROR: {stata_error} ***\n"
+                    if incremental:
+                        result += format_block_report(blocks, first_block, block_timings) + "\n"
+                    result += profile_report
                     
                     # Add command to history and return
                     command_history.append({"command": command_entry, "result": result})
@@ -927,36 +4811,27 @@ def run_stata_file(file_path: str, timeout=600):
                 # Read final log output
                 if os.path.exists(custom_log_file):
                     try:
+                        span_start = time.perf_counter()
                         with open(custom_log_file, 'r', encoding='utf-8', errors='replace') as log:
                             log_content = log.read()
+                            metrics_inc("stata_mcp_log_bytes_read_total", len(log_content.encode('utf-8')))
+                            record_span("final_log_read", span_start)
+                            span_start = time.perf_counter()
                             
                             # Clean up log content - remove headers and Stata startup info
-                            lines = log_content.splitlines()
-                            result_lines = []
-                            
-                            # Skip Stata header if present (search for the separator line)
-                            start_index = 0
-                            for i, line in enumerate(lines):
-                                if '-------------' in line and i < 20:  # Look in first 20 lines
-                                    start_index = i + 1
-                                    break
-                            
-                            # Process the content
-                            for i in range(start_index, len(lines)):
-                                line = lines[i].rstrip()
-                                
-                                # Skip empty lines at beginning or redundant empty lines
-                                if not line.strip() and (not result_lines or not result_lines[-1].strip()):
-                                    continue
-                                    
-                                # Clean up SMCL formatting if present
-                                if '{' in line:
-                                    line = re.sub(r'\{[^}]*\}', '', line)  # Remove {...} codes
-                                    
-                                result_lines.append(line)
+                            result_lines = clean_do_file_log(log_content, strip_banners=len(blocks) > 1)
+                            if profile:
+                                result_lines = strip_profile_lines(result_lines)
                             
                             # Add completion message with final log content
                             completion_msg = f"\n*** Execution completed in {time.time() - start_time:.1f} seconds ***\n"
+                            if incremental:
+                                if first_block:
+                                    completion_msg += (f"Resumed from the checkpoint after block {first_block} of {len(blocks)} "
+                                                       f"({blocks[first_block - 1]['title']})\n")
+                                completion_msg += format_block_report(blocks, first_block, block_timings) + "\n\n"
+                            if profile:
+                                completion_msg += (profile_report or profile_note) + "\n"
                             completion_msg += "Final output:\n"
                             completion_msg += "\n".join(result_lines)
                             
@@ -965,6 +4840,10 @@ def run_stata_file(file_path: str, timeout=600):
                             
                             # Log the final file location
                             result += f"\n\nLog file saved to: {custom_log_file}"
+                            record_span("log_parse", span_start)
+                            
+                            metrics_observe("stata_mcp_overhead_duration_seconds",
+                                            time.perf_counter() - call_start - stata_seconds, {"kind": "file"})
                     except Exception as e:
                         logging.error(f"Error reading final log: {str(e)}")
                         result += f"\n*** WARNING: Error reading final log: {str(e)} ***\n"
@@ -997,6 +4876,777 @@ def run_stata_file(file_path: str, timeout=600):
         logging.error(error_msg)
         return error_msg
 
+# Parameter sweeps - a do-file is run once per combination of arguments on a pool of Stata worker
+# processes (Stata hosts on consecutive local ports). Each run's e() and r() scalars are collected
+# into one table. Workers stay up between sweeps, like the main Stata host.
+SWEEP_WORKER_BASE_PORT = 4101
+sweep_worker_count = 2
+sweep_worker_pool = None
+sweeps = {}  # sweep id -> Sweep
+sweeps_lock = threading.Lock()
+MAX_SWEEP_HISTORY = 20
+
+# Stata code run after each sweep run; writes "name<TAB>value" lines for e(cmd) and every e()/r() scalar
+SWEEP_COLLECT_TEMPLATE = """local mcp_escalars : e(scalars)
+local mcp_rscalars : r(scalars)
+local mcp_i = 0
+foreach mcp_s of local mcp_rscalars {
+    local ++mcp_i
+    local mcp_r`mcp_i' = r(`mcp_s')
+}
+tempname mcp_fh
+quietly file open `mcp_fh' using "RESULTS_PATH", write text replace
+file write `mcp_fh' "e(cmd)" _tab `"`e(cmd)'"' _n
+foreach mcp_s of local mcp_escalars {
+    file write `mcp_fh' "e(`mcp_s')" _tab %21.0g (e(`mcp_s')) _n
+}
+local mcp_i = 0
+foreach mcp_s of local mcp_rscalars {
+    local ++mcp_i
+    file write `mcp_fh' "r(`mcp_s')" _tab %21.0g (`mcp_r`mcp_i'') _n
+}
+file close `mcp_fh'
+"""
+
+class StataWorkerPool:
+    """Stata host processes used for sweeps, handed out one run at a time"""
+
+    def __init__(self, size, base_port=SWEEP_WORKER_BASE_PORT):
+        self.addresses = [f"127.0.0.1:{base_port + i}" for i in range(size)]
+        self.idle = []
+        self.available = threading.Condition()
+        self.started = False
+        self.lock = threading.Lock()
+
+    def _connect(self, address):
+        port = address.rsplit(':', 1)[1]
+        log_dir = stata_host_log_dir or tempfile.gettempdir()
+        connected = connect_stata_host(address, os.path.join(log_dir, f"stata_mcp_worker_{port}.token"),
+                                       stata_host_args, os.path.join(log_dir, f"stata_mcp_worker_{port}.log"))
+        if connected is None:
+            raise RuntimeError(f"Stata worker on {address} did not start")
+        bootstrap_new_backend(connected[0])
+        return connected[0]
+
+    def start(self):
+        """Connect to (or start) every worker; workers are started in parallel"""
+        import concurrent.futures
+        with self.lock:
+            if self.started:
+                return
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.addresses)) as executor:
+                backends = list(executor.map(self._connect, self.addresses))
+            with self.available:
+                self.idle.extend(backends)
+                self.available.notify_all()
+            self.started = True
+            logging.info(f"Sweep worker pool ready: {', '.join(self.addresses)}")
+
+    @contextmanager
+    def worker(self, bootstrap=None):
+        """Hand out an idle worker, preferring one that already ran the bootstrap profile"""
+        with self.available:
+            while not self.idle:
+                self.available.wait()
+            backend = next((worker for worker in self.idle
+                            if bootstrap and worker.bootstrap and worker.bootstrap["name"] == bootstrap), self.idle[0])
+            self.idle.remove(backend)
+        try:
+            yield backend
+        finally:
+            with self.available:
+                self.idle.append(backend)
+                self.available.notify()
+
+    def restart(self, backend):
+        """Replace a worker that stopped responding (its host is started again if it died)"""
+        address = f"{backend.address[0]}:{backend.address[1]}"
+        fresh = self._connect(address)
+        backend.token = fresh.token
+        backend.bootstrap = fresh.bootstrap  # a restarted host has lost the previous setup
+        return backend
+
+# Function to expand a sweep grid into argument lists
+def expand_sweep_grid(grid, args_list):
+    """Return (parameter names, list of argument lists) from a grid dict and/or explicit argument lists"""
+    import itertools
+    names = list(grid.keys())
+    runs = [list(values) for values in itertools.product(*[grid[name] for name in names])] if names else []
+    if args_list:
+        width = max(len(args) for args in args_list)
+        if not names:
+            names = [f"arg{i + 1}" for i in range(width)]
+        runs += [list(args) for args in args_list]
+    return names, runs
+
+# Function to quote a do-file argument for Stata's args command
+def stata_do_argument(value):
+    text = str(value)
+    if re.search(r'[\s"]', text) or text == "":
+        return f'`"{text}"\''
+    return text
+
+class Sweep:
+    """A parameter sweep: every run, its status and collected results"""
+
+    def __init__(self, file_path, names, runs, concurrency, retries, timeout, output_path, output_format,
+                 bootstrap=None):
+        import uuid
+        self.id = uuid.uuid4().hex[:12]
+        self.file_path = file_path
+        self.names = names
+        self.runs = [{"index": i + 1, "args": args, "status": "pending", "attempts": 0, "seconds": None,
+                      "return_code": None, "error": None, "results": {}} for i, args in enumerate(runs)]
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+        self.output_path = output_path
+        self.output_format = output_format
+        self.bootstrap = bootstrap
+        self.tenant = None  # owning tenant in multi-tenant mode
+        self.status = "queued"
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.lock = threading.Lock()
+
+    def progress(self):
+        with self.lock:
+            counts = {}
+            for run in self.runs:
+                counts[run["status"]] = counts.get(run["status"], 0) + 1
+        elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else 0.0
+        completed = counts.get("done", 0) + counts.get("failed", 0)
+        return {
+            "id": self.id,
+            "file_path": self.file_path,
+            "status": self.status,
+            "total": len(self.runs),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "running": counts.get("running", 0),
+            "pending": counts.get("pending", 0),
+            "elapsed_seconds": round(elapsed, 1),
+            # Simple ETA from the average pace so far
+            "eta_seconds": round(elapsed / completed * (len(self.runs) - completed), 1) if completed else None,
+            "output_path": self.output_path,
+            "error": self.error,
+        }
+
+    def table(self):
+        """Rows of the result table: arguments, run status, then e()/r() results in first-seen order"""
+        result_columns = []
+        for run in self.runs:
+            for name in run["results"]:
+                if name not in result_columns:
+                    result_columns.append(name)
+        columns = ["run"] + self.names + ["status", "attempts", "seconds", "return_code", "error"] + result_columns
+        rows = []
+        for run in self.runs:
+            row = {"run": run["index"], "status": run["status"], "attempts": run["attempts"],
+                   "seconds": run["seconds"], "return_code": run["return_code"], "error": run["error"]}
+            row.update({name: (run["args"][i] if i < len(run["args"]) else None) for i, name in enumerate(self.names)})
+            row.update({name: run["results"].get(name) for name in result_columns})
+            rows.append(row)
+        return columns, rows
+
+    def write_table(self):
+        columns, rows = self.table()
+        if self.output_format == "parquet":
+            if not has_pandas:
+                raise RuntimeError("pandas is required for Parquet output")
+            try:
+                pd.DataFrame(rows, columns=columns).to_parquet(self.output_path, index=False)
+            except ImportError as e:
+                raise RuntimeError(f"Parquet output needs pyarrow or fastparquet: {str(e)}")
+        else:
+            import csv
+            with open(self.output_path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=columns)
+                writer.writeheader()
+                writer.writerows(rows)
+
+# Function to parse the results file written by SWEEP_COLLECT_TEMPLATE
+def parse_sweep_results(path):
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            name, _, value = line.rstrip('\n').partition('\t')
+            match = re.match(r'^([er])\((\w+)\)$', name)
+            if not match:
+                continue
+            value = value.strip()
+            column = f"{match.group(1)}_{match.group(2)}"
+            if column == "e_cmd":
+                results[column] = value or None
+                continue
+            try:
+                results[column] = float(value)
+            except ValueError:
+                results[column] = None  # Stata missing values
+    return results
+
+# Function to execute one sweep run on a worker, with retries
+def run_sweep_item(sweep, run):
+    command = f'do "{sweep.file_path}"' + "".join(f" {stata_do_argument(arg)}" for arg in run["args"])
+    for attempt in range(1, sweep.retries + 2):
+        with sweep.lock:
+            run["status"] = "running"
+            run["attempts"] = attempt
+        started = time.perf_counter()
+        with sweep_worker_pool.worker(sweep.bootstrap) as backend, scratch_area.session("sweep"):
+            holder = f"sweep:{backend.address[1]}"
+            cpu_share = acquire_cpu_share(holder, backend)
+            results_path = scratch_area.new_file('.txt')
+            collect_do = scratch_area.new_file('.do')
+            with open(collect_do, 'w') as f:
+                f.write(SWEEP_COLLECT_TEMPLATE.replace("RESULTS_PATH", results_path))
+            # Interrupt the run with a break if it exceeds the per-run timeout
+            timer = threading.Timer(sweep.timeout, lambda: backend.cancel())
+            timer.start()
+            try:
+                if sweep.bootstrap:
+                    ensure_bootstrap(backend, sweep.bootstrap)
+                backend.run("clear all", echo=False)
+                backend.run(command, echo=False)
+                backend.run(f'do "{collect_do}"', echo=False)
+                results = parse_sweep_results(results_path)
+                error = None
+            except OSError as e:
+                # The worker process went away; start it again before retrying
+                error = f"Worker unavailable: {str(e)}"
+                try:
+                    sweep_worker_pool.restart(backend)
+                except Exception as restart_error:
+                    logging.error(f"Could not restart sweep worker: {str(restart_error)}")
+            except Exception as e:
+                error = str(e)
+            finally:
+                timer.cancel()
+                if cpu_share:
+                    cpu_allocator.release(holder)
+        seconds = time.perf_counter() - started
+        with sweep.lock:
+            run["seconds"] = round(seconds, 3)
+            if error is None:
+                run.update(status="done", return_code=0, error=None, results=results)
+                break
+            match = re.search(r'r\((\d+)\);', error)
+            run.update(status="failed", error=error, return_code=int(match.group(1)) if match else None)
+        logging.info(f"Sweep {sweep.id} run {run['index']} attempt {attempt} failed: {error}")
+    metrics_inc("stata_mcp_sweep_runs_total", labels={"status": run["status"]})
+
+# Function to run a whole sweep
+def execute_sweep(sweep):
+    """Run every item of the sweep on the worker pool and write the result table"""
+    import concurrent.futures
+    sweep.status = "running"
+    sweep.started_at = time.time()
+    try:
+        sweep_worker_pool.start()
+        last_report = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=sweep.concurrency,
+                                                   thread_name_prefix=f"sweep-{sweep.id}") as executor:
+            futures = [executor.submit(run_sweep_item, sweep, run) for run in sweep.runs]
+            for _ in concurrent.futures.as_completed(futures):
+                # Aggregate progress in the server log, at most every 10 seconds
+                if time.time() - last_report >= 10:
+                    progress = sweep.progress()
+                    logging.info(f"Sweep {sweep.id}: {progress['done']} done, {progress['failed']} failed, "
+                                 f"{progress['running']} running of {progress['total']}")
+                    last_report = time.time()
+        sweep.write_table()
+        sweep.status = "done"
+    except Exception as e:
+        sweep.status = "failed"
+        sweep.error = str(e)
+        logging.error(f"Sweep {sweep.id} failed: {str(e)}")
+    finally:
+        sweep.finished_at = time.time()
+    progress = sweep.progress()
+    logging.info(f"Sweep {sweep.id} finished: {progress['done']} done, {progress['failed']} failed "
+                 f"in {progress['elapsed_seconds']}s, results in {sweep.output_path}")
+    return progress
+
+# Function to create and start a sweep
+def start_sweep(file_path, grid=None, args_list=None, concurrency=None, retries=1, timeout=600,
+                output_path="", output_format="csv", bootstrap=None):
+    """Validate a sweep request and start it on a background thread; returns (sweep, future) or raises ValueError"""
+    import concurrent.futures
+    global sweep_worker_pool
+    resolved_path, error_msg = resolve_do_file_path(file_path)
+    if error_msg:
+        raise ValueError(error_msg)
+    output_format = (output_format or "csv").lower()
+    if output_format not in ("csv", "parquet"):
+        raise ValueError(f"Unknown output format: {output_format} (use csv or parquet)")
+    if bootstrap:
+        load_bootstrap(bootstrap)
+    names, runs = expand_sweep_grid(grid or {}, args_list or [])
+    if not runs:
+        raise ValueError("The sweep has no runs; pass a grid of argument values or a list of argument lists")
+    if sweep_worker_pool is None:
+        sweep_worker_pool = StataWorkerPool(sweep_worker_count)
+    concurrency = max(1, min(int(concurrency or sweep_worker_count), sweep_worker_count))
+    if not output_path:
+        base = os.path.splitext(resolved_path)[0]
+        output_path = f"{base}_sweep_{time.strftime('%Y%m%d_%H%M%S')}.{output_format}"
+    # Sweeps count against the tenant's limits like jobs; the runs' Stata time is charged when it ends
+    placeholder = stata_scheduler.admit_external("sweep", "batch", resolved_path,
+                                                 len(runs) * estimate_job_seconds("file") / concurrency)
+    sweep = Sweep(resolved_path, names, runs, concurrency, max(0, int(retries)), timeout,
+                  os.path.abspath(output_path), output_format, bootstrap)
+    sweep.tenant = current_tenant()
+    with sweeps_lock:
+        sweeps[sweep.id] = sweep
+        # Forget the oldest finished sweeps
+        finished = [s for s in sweeps.values() if s.finished_at]
+        for old in sorted(finished, key=lambda s: s.finished_at)[:max(0, len(sweeps) - MAX_SWEEP_HISTORY)]:
+            del sweeps[old.id]
+    logging.info(f"Starting sweep {sweep.id}: {len(runs)} runs of {resolved_path} on {concurrency} workers")
+    future = concurrent.futures.Future()
+    def run():
+        try:
+            future.set_result(execute_sweep(sweep))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            stata_scheduler.finish_external(placeholder, failed=sweep.status != "done",
+                                            seconds=sum(run["seconds"] or 0.0 for run in sweep.runs))
+    threading.Thread(target=run, name=f"sweep-{sweep.id}", daemon=True).start()
+    return sweep, future
+
+# Worker agents - a server started with --coordinator-url registers with a coordinator (a server
+# started with --coordinator) and reports its load in heartbeats. The coordinator forwards run_file
+# and run_selection: selections (and runs with a session) stick to one worker, other runs go to the
+# least loaded worker. Workers that miss heartbeats or drop a request are marked lost and their
+# sessions move to another worker.
+cluster_coordinator = False
+cluster_worker = False  # set with --coordinator-url; requests must then carry the cluster token
+cluster_token = None
+CLUSTER_OPEN_PATHS = ("/health", "/metrics")  # reachable on a worker without the cluster token
+cluster_tenants = {}  # tenant name -> Tenant without limits, for requests a coordinator forwards to this worker
+CLUSTER_HEARTBEAT_INTERVAL = 2.0
+CLUSTER_WORKER_TIMEOUT = 3 * CLUSTER_HEARTBEAT_INTERVAL
+CLUSTER_FORWARD_HEADERS = ("X-Stata-Job-Id", "X-Stata-Queue-Wait", "X-Stata-Coalesced", "Server-Timing", "Retry-After")
+cluster_workers = {}  # worker id -> ClusterWorker
+cluster_sessions = {}  # session -> (worker id, worker started_at)
+cluster_lock = threading.Lock()
+
+class ClusterWorker:
+    """A worker server registered with this coordinator"""
+
+    def __init__(self, worker_id, url, info):
+        self.id = worker_id
+        self.url = url.rstrip('/')
+        self.info = info
+        self.registered_at = time.time()
+        self.last_seen = time.time()
+        self.alive = True
+        self.load = {}
+        self.outstanding = 0  # requests forwarded and not answered yet
+        self.routed = 0
+        self.lost_reason = None
+
+    def pending_jobs(self):
+        """Jobs queued or running on the worker, counting requests sent since its last heartbeat"""
+        reported = self.load.get("queue_length", 0) + self.load.get("running", 0)
+        return max(reported, self.outstanding)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "url": self.url,
+            "alive": self.alive,
+            "lost_reason": self.lost_reason,
+            "last_seen_seconds_ago": round(time.time() - self.last_seen, 1),
+            "pending_jobs": self.pending_jobs(),
+            "load": self.load,
+            "routed": self.routed,
+            "sessions": sum(1 for worker_id, _ in cluster_sessions.values() if worker_id == self.id),
+            "info": self.info,
+        }
+
+# Function to update the worker gauges
+def cluster_update_metrics():
+    alive = sum(1 for worker in cluster_workers.values() if worker.alive)
+    metrics_set("stata_mcp_cluster_workers", alive, {"state": "alive"})
+    metrics_set("stata_mcp_cluster_workers", len(cluster_workers) - alive, {"state": "lost"})
+
+# Function to check a worker's cluster token
+def cluster_authorized(token):
+    import hmac
+    return bool(cluster_token) and hmac.compare_digest(cluster_token, token or "")
+
+# Function to mark a worker lost
+def cluster_mark_lost(worker, reason):
+    """Stop routing to a worker; its sessions move to another worker on their next request"""
+    with cluster_lock:
+        if not worker.alive:
+            return
+        worker.alive = False
+        worker.lost_reason = reason
+        sessions = sum(1 for worker_id, _ in cluster_sessions.values() if worker_id == worker.id)
+        cluster_update_metrics()
+    metrics_inc("stata_mcp_cluster_worker_losses_total")
+    logging.warning(f"Lost worker {worker.id} ({reason}); {sessions} sessions will move to other workers")
+
+# Function to choose the worker for a request
+def cluster_pick_worker(session, exclude, bootstrap=None):
+    """Return (worker, moved) and count the request as outstanding, or (None, False) without live workers
+
+    A session stays on its worker while that worker is alive and has not restarted; moved is true
+    when the session had to leave its worker (and the Stata state it had built up there). Among
+    equally loaded workers, one that already ran the requested bootstrap profile is preferred.
+    """
+    now = time.time()
+    for worker in list(cluster_workers.values()):
+        if worker.alive and now - worker.last_seen > CLUSTER_WORKER_TIMEOUT:
+            cluster_mark_lost(worker, "missed heartbeats")
+    with cluster_lock:
+        live = [worker for worker in cluster_workers.values()
+                if worker.alive and worker.id not in exclude and worker.load.get("stata_available", True)]
+        bound = cluster_sessions.get(session) if session is not None else None
+        worker = None
+        if bound is not None:
+            candidate = cluster_workers.get(bound[0])
+            if candidate in live and candidate.info.get("started_at") == bound[1]:
+                worker = candidate
+        if worker is None:
+            if not live:
+                return None, False
+            worker = min(live, key=lambda w: (w.pending_jobs(), bool(bootstrap) and (w.load.get("bootstrap") or {}).get("name") != bootstrap,
+                                              w.load.get("queued_work_seconds", 0.0), w.routed))
+            if session is not None:
+                cluster_sessions[session] = (worker.id, worker.info.get("started_at"))
+        worker.outstanding += 1
+        worker.routed += 1
+        return worker, bound is not None and bound != (worker.id, worker.info.get("started_at"))
+
+# Function to send a tool request to a worker, moving to another worker if it is lost
+async def cluster_forward(kind, path, session, params=None, json_body=None, timeout=600, bootstrap=None,
+                          lane="normal"):
+    """Return the worker's answer as a Response, or None if no worker is available
+
+    The tenant's limits are applied here (QueueFullError as for local jobs) and the request counts
+    against them until the worker answers. The tenant is passed on in X-Stata-Tenant, so the worker
+    keeps its frame, history and delta outputs apart from other tenants'.
+    """
+    placeholder = stata_scheduler.admit_external(kind, lane, path)
+    response = None
+    try:
+        response = await _cluster_forward(kind, path, session, params, json_body, timeout, bootstrap)
+        return response
+    finally:
+        stata_scheduler.finish_external(placeholder, failed=response is not None and response.status_code >= 400,
+                                         ran=response is not None)
+
+# Function to send a request to workers until one answers
+async def _cluster_forward(kind, path, session, params, json_body, timeout, bootstrap):
+    import httpx
+    tried = set()
+    moved = False
+    headers = {"X-Stata-Cluster-Token": cluster_token or ""}
+    tenant = current_tenant()
+    if tenant is not None:
+        headers["X-Stata-Tenant"] = tenant.name
+    while True:
+        worker, worker_moved = cluster_pick_worker(session, tried, bootstrap)
+        if worker is None:
+            return None
+        moved = moved or worker_moved
+        try:
+            async with httpx.AsyncClient(timeout=httpx.Timeout(timeout + 60, connect=5.0)) as client:
+                response = await client.post(worker.url + path, params=params, json=json_body, headers=headers)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError, httpx.ReadError) as e:
+            # The worker is down or died mid-request: drop it and run the request elsewhere
+            tried.add(worker.id)
+            cluster_mark_lost(worker, f"{type(e).__name__}: {str(e)}")
+            moved = moved or session is not None
+            continue
+        except httpx.HTTPError as e:
+            return JSONResponse(status_code=504, headers={"X-Stata-Worker": worker.id},
+                                content={"status": "error", "message": f"Worker {worker.id} did not answer: {str(e)}"})
+        finally:
+            with cluster_lock:
+                worker.outstanding -= 1
+        metrics_inc("stata_mcp_cluster_routed_total", labels={"worker": worker.id, "kind": kind})
+        headers = {name: response.headers[name] for name in CLUSTER_FORWARD_HEADERS if name in response.headers}
+        headers["X-Stata-Worker"] = worker.id
+        content = response.content
+        media_type = response.headers.get("content-type", "text/plain")
+        if moved:
+            headers["X-Stata-Worker-Changed"] = "true"
+            if media_type.startswith("text/plain"):
+                content = (f"Note: this session moved to worker {worker.id}; data and settings from earlier "
+                           f"commands are not available there.\n\n").encode('utf-8') + content
+        return Response(content=content, status_code=response.status_code, media_type=media_type, headers=headers)
+
+# Function to describe this server's load for heartbeats
+def worker_load():
+    with stata_scheduler.condition:
+        queued = sum(len(stata_scheduler.lanes[lane]) for lane in SCHEDULER_LANES)
+        return {"queue_length": queued, "running": len(stata_scheduler.running),
+                "queued_work_seconds": round(stata_scheduler._queued_work(), 3), "stata_available": stata_available,
+                "bootstrap": stata_backend.bootstrap if stata_backend is not None else None}
+
+# Function to register this server with a coordinator and keep sending heartbeats
+def run_worker_agent(coordinator_url, worker_id, advertise_url, local_url):
+    """Runs on a daemon thread; re-registers whenever the coordinator forgets this worker"""
+    import atexit
+    import urllib.request
+
+    def post(path, payload):
+        request = urllib.request.Request(coordinator_url.rstrip('/') + path, data=json.dumps(payload).encode('utf-8'),
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return json.loads(response.read() or b"{}")
+
+    # Offer this server only once it answers requests
+    while True:
+        try:
+            with urllib.request.urlopen(local_url + "/health", timeout=2):
+                break
+        except Exception:
+            time.sleep(0.5)
+    info = {"pid": os.getpid(), "started_at": time.time(), "hostname": socket.gethostname(),
+            "backend": stata_backend.name if stata_backend is not None else None, "edition": stata_edition}
+    atexit.register(lambda: post("/cluster/deregister", {"worker_id": worker_id, "token": cluster_token}))
+    registered = False
+    while True:
+        try:
+            if not registered:
+                post("/cluster/register", {"worker_id": worker_id, "url": advertise_url, "token": cluster_token,
+                                           "info": dict(info, stata_available=stata_available), "load": worker_load()})
+                registered = True
+                logging.info(f"Registered as worker {worker_id} ({advertise_url}) with coordinator {coordinator_url}")
+            else:
+                post("/cluster/heartbeat", {"worker_id": worker_id, "token": cluster_token, "load": worker_load()})
+        except Exception as e:
+            if registered:
+                logging.warning(f"Lost contact with coordinator {coordinator_url}: {str(e)}")
+            else:
+                logging.debug(f"Could not register with coordinator {coordinator_url}: {str(e)}")
+            registered = False
+        time.sleep(CLUSTER_HEARTBEAT_INTERVAL)
+
+# Parquet loading - Arrow record batches are converted column by column and appended to the dataset
+PARQUET_BATCH_ROWS = 65536
+PARQUET_FILTER_OPS = ("==", "=", "!=", "<", "<=", ">", ">=", "in", "not in")
+STATA_MAX_STR_WIDTH = 2045
+# Stata dates count from 1960-01-01, Arrow's from 1970-01-01
+STATA_EPOCH_DAYS = 3653
+STATA_EPOCH_MS = STATA_EPOCH_DAYS * 86400000
+
+# Function to turn a column name into a unique, valid Stata variable name
+def stata_variable_name(name, used):
+    """Replace invalid characters, avoid leading digits and cap at 32 characters; used is updated"""
+    base = re.sub(r'[^A-Za-z0-9_]', '_', str(name)) or "var"
+    if not re.match(r'[A-Za-z_]', base):
+        base = "_" + base
+    base = base[:32]
+    candidate = base
+    suffix = 1
+    while candidate.lower() in used:
+        suffix += 1
+        candidate = f"{base[:32 - len(str(suffix)) - 1]}_{suffix}"
+    used.add(candidate.lower())
+    return candidate
+
+# Function to map an Arrow type to a Stata variable
+def stata_variable_spec(arrow_type):
+    """Return (storage type, display format, converter) for an Arrow type, or None if it has no Stata equivalent
+
+    The converter turns an Arrow array into a list of Python values with None for missing.
+    Integer types go to the smallest Stata type whose range holds every value of the Arrow type;
+    Stata's byte/int/long reserve their top values for missing codes.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    types = pa.types
+    if types.is_dictionary(arrow_type):
+        spec = stata_variable_spec(arrow_type.value_type)
+        if spec is None:
+            return None
+        storage, fmt, convert = spec
+        return storage, fmt, lambda array: convert(array.dictionary_decode())
+    if types.is_boolean(arrow_type):
+        return "byte", None, lambda array: array.cast(pa.int8()).to_pylist()
+    if types.is_int8(arrow_type) or types.is_uint8(arrow_type):
+        return "int", None, lambda array: array.to_pylist()
+    if types.is_int16(arrow_type) or types.is_uint16(arrow_type):
+        return "long", None, lambda array: array.to_pylist()
+    if types.is_integer(arrow_type):
+        return "double", None, lambda array: array.cast(pa.float64()).to_pylist()
+    if types.is_float16(arrow_type) or types.is_float32(arrow_type):
+        return "float", None, lambda array: array.cast(pa.float32()).to_pylist()
+    if types.is_floating(arrow_type) or types.is_decimal(arrow_type):
+        return "double", None, lambda array: array.cast(pa.float64()).to_pylist()
+    if types.is_date(arrow_type):
+        return "long", "%td", lambda array: pc.add(array.cast(pa.date32()).cast(pa.int32()), STATA_EPOCH_DAYS).to_pylist()
+    if types.is_timestamp(arrow_type):
+        # Time zone aware timestamps are stored as UTC clock times; %tc has millisecond resolution,
+        # so finer units are truncated (an unsafe cast) rather than rejected
+        return "double", "%tc", lambda array: pc.add(
+            pc.cast(array, pa.timestamp("ms", tz=arrow_type.tz), safe=False).cast(pa.int64()),
+            STATA_EPOCH_MS).cast(pa.float64()).to_pylist()
+    if types.is_string(arrow_type) or types.is_large_string(arrow_type):
+        return "str1", None, lambda array: array.to_pylist()
+    return None
+
+# Function to build the row filter expression of a Parquet load
+def parquet_filter_expression(filters, names):
+    """Combine [column, op, value] triples with AND into a pyarrow.dataset expression"""
+    import pyarrow.dataset as ds
+    expression = None
+    for item in filters:
+        if not isinstance(item, (list, tuple)) or len(item) != 3:
+            raise ValueError(f"Filters must be [column, op, value] triples, got: {item!r}")
+        column, op, value = item
+        op = str(op).lower()
+        if column not in names:
+            raise ValueError(f"Unknown filter column: {column}")
+        if op not in PARQUET_FILTER_OPS:
+            raise ValueError(f"Unknown filter operator: {op} (use {', '.join(PARQUET_FILTER_OPS)})")
+        field = ds.field(column)
+        if op in ("in", "not in"):
+            if not isinstance(value, (list, tuple)):
+                raise ValueError(f"The value of an {op!r} filter must be a list")
+            condition = field.isin(list(value))
+            if op == "not in":
+                condition = ~condition
+        else:
+            condition = {"==": field == value, "=": field == value, "!=": field != value, "<": field < value,
+                         "<=": field <= value, ">": field > value, ">=": field >= value}[op]
+        expression = condition if expression is None else expression & condition
+    return expression
+
+# Function to stream a Parquet file into the Stata dataset
+def load_parquet_file(file_path, columns=None, row_groups=None, filters=None, batch_size=PARQUET_BATCH_ROWS,
+                      clear=False):
+    """Replace the data in memory with (a projection of) a Parquet file; returns a summary dict
+
+    Only the requested columns and row groups are read; filters also skip row groups whose statistics
+    rule them out. At most batch_size rows are held in Python at a time.
+    Raises ValueError for bad requests.
+    """
+    if not has_pyarrow:
+        raise ValueError("pyarrow is required to load Parquet files: pip install pyarrow")
+    if not stata_available or stata_backend is None:
+        raise ValueError("Stata is not available")
+    import itertools
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+
+    path = os.path.abspath(os.path.expanduser(file_path))
+    if not os.path.isfile(path):
+        raise ValueError(f"File not found: {path}")
+    start = time.perf_counter()
+    try:
+        parquet_file = pq.ParquetFile(path)
+    except Exception as e:
+        raise ValueError(f"Cannot read {path} as Parquet: {str(e)}")
+    schema = parquet_file.schema_arrow
+    selected = list(columns) if columns else list(schema.names)
+    missing = [name for name in selected if name not in schema.names]
+    if missing:
+        raise ValueError(f"Unknown columns: {', '.join(missing)}")
+    total_groups = parquet_file.metadata.num_row_groups
+    if row_groups:
+        bad = [g for g in row_groups if not 0 <= int(g) < total_groups]
+        if bad:
+            raise ValueError(f"Row groups out of range (file has {total_groups}): {bad}")
+        row_groups = [int(g) for g in row_groups]
+    else:
+        # An empty list means all row groups, as for columns
+        row_groups = None
+    batch_size = max(1, int(batch_size or PARQUET_BATCH_ROWS))
+
+    variables, converters, skipped, used = [], [], [], set()
+    for name in selected:
+        spec = stata_variable_spec(schema.field(name).type)
+        if spec is None:
+            skipped.append({"column": name, "type": str(schema.field(name).type)})
+            continue
+        storage, fmt, convert = spec
+        variables.append({"name": stata_variable_name(name, used), "source": name, "type": storage, "format": fmt})
+        converters.append(convert)
+    if not variables:
+        raise ValueError("None of the selected columns has a Stata equivalent type")
+    read_columns = [var["source"] for var in variables]
+
+    def converted_batches(batches):
+        for batch in batches:
+            if batch.num_rows:
+                yield batch, [convert(batch.column(index)) for index, convert in enumerate(converters)]
+
+    # Read and convert the first batch before the data in memory is replaced, so a file that cannot be
+    # read, filtered or converted leaves the dataset as it was
+    try:
+        if filters:
+            expression = parquet_filter_expression(filters, schema.names)
+            fragment = next(iter(ds.dataset(path, format="parquet").get_fragments()))
+            if row_groups:
+                fragment = fragment.subset(row_group_ids=row_groups)
+            batches = fragment.to_batches(columns=read_columns, filter=expression, batch_size=batch_size)
+        else:
+            batches = parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=read_columns)
+        converted = converted_batches(batches)
+        first = next(converted, None)
+    except pa.ArrowException as e:
+        raise ValueError(f"Cannot load {path} into Stata: {str(e)}")
+
+    if not clear:
+        try:
+            stata_backend.run("if c(changed) error 4", echo=False)
+        except Exception:
+            raise ValueError("The dataset in memory has changed since it was last saved; pass clear=true to replace it")
+
+    stata_backend.begin_dataset([{k: var[k] for k in ("name", "type", "format")} for var in variables])
+    widths = {}
+    rows = 0
+    batch_count = 0
+    for batch, values in itertools.chain([first] if first is not None else [], converted):
+        for var, column in zip(variables, values):
+            if var["type"].startswith("str"):
+                width = max((len(v.encode('utf-8')) for v in column if v), default=1)
+                if width > widths.get(var["name"], 1) and var["type"] != "strL":
+                    widths[var["name"]] = width
+                    stata_backend.widen_string(var["name"], width)
+                    if width > STATA_MAX_STR_WIDTH:
+                        var["type"] = "strL"
+        stata_backend.append_observations([{k: var[k] for k in ("name", "type")} for var in variables], values)
+        rows += batch.num_rows
+        batch_count += 1
+    for var in variables:
+        if var["type"].startswith("str") and var["type"] != "strL":
+            var["type"] = f"str{widths.get(var['name'], 1)}"
+
+    seconds = time.perf_counter() - start
+    if skipped:
+        logging.warning(f"Parquet columns without a Stata type were skipped: {skipped}")
+    logging.info(f"Loaded {rows} rows x {len(variables)} variables from {path} in {seconds:.2f}s")
+    return {
+        "status": "success",
+        "file": path,
+        "rows": rows,
+        "variables": variables,
+        "skipped_columns": skipped,
+        "row_groups_read": len(row_groups) if row_groups else total_groups,
+        "row_groups_total": total_groups,
+        "batches": batch_count,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds) if seconds > 0 else None,
+    }
+
+# Function to run a Parquet load as a scheduler job
+def run_load_parquet(file_path, **options):
+    """Job wrapper around load_parquet_file; the summary is returned as JSON text for the job store"""
+    return json.dumps(load_parquet_file(file_path, **options))
+
 # Function to kill any process using the specified port
 def kill_process_on_port(port):
     """Kill any process that is currently using the specified port"""
@@ -1097,6 +5747,37 @@ class RunFileParams(BaseModel):
     file_path: str = Field(..., description="The full path to the .do file")
     timeout: int = Field(600, description="Timeout in seconds (default: 600 seconds / 10 minutes)")
 
+class SweepRequest(BaseModel):
+    file_path: str = Field(..., description="The full path to the .do file; it reads its arguments with `args`")
+    grid: Dict[str, List[Any]] = Field(default_factory=dict,
+                                       description="Argument values to combine, e.g. {\"depvar\": [\"price\", \"mpg\"], \"reps\": [50, 100]}; "
+                                                   "every combination is one run and values are passed in key order")
+    args: List[List[Any]] = Field(default_factory=list, description="Explicit argument lists, one per run (in addition to grid)")
+    concurrency: Optional[int] = Field(None, description="Runs at the same time (default and maximum: the number of workers)")
+    retries: int = Field(1, description="Extra attempts for a failed run")
+    timeout: int = Field(600, description="Timeout in seconds per run")
+    output_path: str = Field("", description="Where to write the result table (default: <do-file>_sweep_<time>.<format>)")
+    output_format: str = Field("csv", description="csv or parquet")
+    wait: bool = Field(True, description="Wait for the sweep to finish (otherwise poll stata_sweep_status)")
+    bootstrap: Optional[str] = Field(None, description="Bootstrap profile the runs need; workers that already ran it are preferred")
+
+class LoadParquetRequest(BaseModel):
+    file_path: str = Field(..., description="The full path to the .parquet file")
+    columns: List[str] = Field(default_factory=list, description="Columns to load (default: all)")
+    row_groups: List[int] = Field(default_factory=list, description="Row groups to read (default: all)")
+    filters: List[List[Any]] = Field(default_factory=list,
+                                     description="Row filters ANDed together as [column, op, value], e.g. [\"year\", \">=\", 2010] "
+                                                 "or [\"state\", \"in\", [\"CA\", \"NY\"]]; ops: ==, !=, <, <=, >, >=, in, not in")
+    batch_size: int = Field(PARQUET_BATCH_ROWS, description="Rows converted per batch; bounds the memory used while loading")
+    clear: bool = Field(False, description="Replace the data in memory even if it has unsaved changes")
+
+class ClusterMessage(BaseModel):
+    worker_id: str
+    token: str = ""
+    url: str = ""
+    info: Dict[str, Any] = Field(default_factory=dict)
+    load: Dict[str, Any] = Field(default_factory=dict)
+
 # Define Legacy VS Code Extension Support
 class ToolRequest(BaseModel):
     tool: str
@@ -1106,6 +5787,87 @@ class ToolResponse(BaseModel):
     status: str
     result: Optional[str] = None
     message: Optional[str] = None
+    timing: Optional[Dict[str, Any]] = None
+    job: Optional[Dict[str, Any]] = None
+
+# Function to validate a requested scheduler lane
+def normalize_lane(lane, default):
+    """Return lane if it is a known scheduler lane, otherwise the default"""
+    if lane is None or lane == "":
+        return default
+    lane = str(lane).lower()
+    if lane not in SCHEDULER_LANES:
+        logging.warning(f"Unknown priority lane: {lane}, using {default}")
+        return default
+    return lane
+
+# Function to read a boolean /v1/tools parameter the way query parameters are parsed
+def parameter_flag(value, default=False):
+    """Return value as a bool; strings such as "false", "0" and "no" are false, as in query parameters"""
+    if value is None or value == "":
+        return default
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in ("1", "true", "t", "yes", "y", "on"):
+            return True
+        if value in ("0", "false", "f", "no", "n", "off"):
+            return False
+        logging.warning(f"Unknown boolean parameter value: {value}, using {default}")
+        return default
+    return bool(value)
+
+# Function to queue a do-file run, attaching to an identical in-flight run if there is one
+async def submit_run_file(file_path, timeout, preemptible, lane, trace, incremental=False, profile=False,
+                          bootstrap=None):
+    """Submit run_stata_file to the scheduler, coalescing duplicates by path, content, lane and options"""
+    # Resolving a relative path can walk the workspace, so it is done once and the checks and the job
+    # below reuse the absolute path; unresolvable paths are left to the run to report
+    resolved_path, error_msg = await asyncio.to_thread(resolve_do_file_path, file_path)
+    if not error_msg:
+        file_path = os.path.abspath(resolved_path)
+    # Structurally broken do-files are rejected here, before they take a place in the queue
+    await asyncio.to_thread(preflight_do_file, file_path)
+    if bootstrap:
+        await asyncio.to_thread(load_bootstrap, bootstrap)
+    # Resolving the path and hashing the file touches the disk, so keep it off the event loop
+    dedupe_key = await asyncio.to_thread(run_file_dedupe_key, file_path, timeout=timeout, preemptible=preemptible,
+                                         incremental=incremental, profile=profile, bootstrap=bootstrap, lane=lane)
+    prediction = None
+    if dedupe_key is not None and job_store is not None:
+        prediction = await asyncio.to_thread(predict_runtime, dedupe_key[0], dedupe_key[1])
+        if prediction is not None and prediction["max_seconds"] > timeout:
+            logging.warning(f"Earlier runs of {file_path} took up to {prediction['max_seconds']:.0f}s, more than the "
+                            f"timeout of {timeout}s (suggested: {prediction['suggested_timeout']}s)")
+    return stata_scheduler.submit("file", run_stata_file, file_path, timeout=timeout, preemptible=preemptible,
+                                  incremental=incremental, profile=profile, lane=lane, description=file_path, trace=trace,
+                                  dedupe_key=dedupe_key, bootstrap=bootstrap, prediction=prediction)
+
+# Function to describe a job in a tool response
+def job_info(job, trace):
+    """Job details for a response; coalesced is true when this request attached to another request's job"""
+    info = job.to_dict()
+    info["coalesced"] = job.trace is not trace
+    return info
+
+# Function to build response headers describing a finished job
+def job_response_headers(job, trace, include_timing):
+    """Expose job id and queue wait (and optionally per-phase timings) as response headers"""
+    headers = {
+        "X-Stata-Job-Id": job.id,
+        "X-Stata-Queue-Wait": f"{job.queue_wait_seconds:.3f}",
+    }
+    if job.trace is not trace:
+        headers["X-Stata-Coalesced"] = "true"
+    if job.resources:
+        headers["X-Stata-Resources"] = (f"peak_rss_bytes={job.resources['peak_rss_bytes']}; "
+                                        f"process_cpu_seconds={job.resources['process_cpu_seconds']}; "
+                                        f"read_bytes={job.resources['read_bytes']}; "
+                                        f"write_bytes={job.resources['write_bytes']}")
+    if job.prediction is not None:
+        headers["X-Stata-Suggested-Timeout"] = str(job.prediction["suggested_timeout"])
+    if include_timing:
+        headers["Server-Timing"] = trace.server_timing_header()
+    return headers
 
 # Create the FastAPI app
 app = FastAPI(
@@ -1114,24 +5876,117 @@ app = FastAPI(
     description="Stata MCP Server - Exposes Stata functionality to AI models via MCP protocol"
 )
 
+# Admission control rejections become 429 responses with a Retry-After hint.
+# The body keeps the ToolResponse shape for /v1/tools clients; MCP clients receive it as the tool error text.
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    return JSONResponse(
+        status_code=429,
+        headers={"Retry-After": str(exc.retry_after)},
+        content={
+            "status": "error",
+            "error": "queue_full",
+            "reason": exc.reason,
+            "message": f"{str(exc)}. Retry after {exc.retry_after} seconds.",
+            "retry_after": exc.retry_after,
+        }
+    )
+
+# Do-files that fail the pre-flight check become 422 responses listing each problem
+@app.exception_handler(PreflightError)
+async def preflight_error_handler(request: Request, exc: PreflightError):
+    return JSONResponse(
+        status_code=422,
+        content={
+            "status": "error",
+            "error": "preflight_failed",
+            "message": str(exc),
+            "problems": [{"line": line, "severity": severity, "message": message}
+                         for line, severity, message in exc.problems],
+        }
+    )
+
+# Unknown bootstrap profiles become 400 responses
+@app.exception_handler(BootstrapError)
+async def bootstrap_error_handler(request: Request, exc: BootstrapError):
+    return JSONResponse(status_code=400, content={"status": "error", "error": "bootstrap", "message": str(exc)})
+
 # Define regular FastAPI routes for Stata functions
 @app.post("/run_selection", operation_id="stata_run_selection", response_class=Response)
-async def stata_run_selection_endpoint(selection: str) -> Response:
-    """Run selected Stata code and return the output"""
+async def stata_run_selection_endpoint(selection: str, include_timing: bool = False,
+                                      session: Optional[str] = None, delta: bool = False,
+                                      bootstrap: Optional[str] = None) -> Response:
+    """Run selected Stata code and return the output
+
+    Args:
+        selection: The Stata code to execute
+        include_timing: Return per-phase timings in a Server-Timing header
+        session: Name of a Stata session; on a coordinator, commands of one session run on the same worker
+        delta: Return only the lines that changed since the previous output of the same selection in this session
+        bootstrap: Bootstrap profile the code needs (run first if this Stata has not run it yet)
+    """
     logging.info(f"Running selection: {selection}")
-    result = run_stata_selection(selection)
+    if cluster_coordinator:
+        params = {"selection": selection, "include_timing": include_timing, "delta": delta}
+        if session:
+            params["session"] = session
+        if bootstrap:
+            params["bootstrap"] = bootstrap
+        forwarded = await cluster_forward("selection", "/run_selection", session or default_session(), params=params,
+                                          bootstrap=bootstrap, lane="interactive")
+        if forwarded is not None:
+            return forwarded
+    if bootstrap:
+        load_bootstrap(bootstrap)
+    with track_tool_request("stata_run_selection") as outcome, request_trace("stata_run_selection") as trace:
+        # Selections go to the interactive lane so they jump ahead of queued do-files
+        job = stata_scheduler.submit("selection", run_stata_selection, selection,
+                                     lane="interactive", description=selection[:80], trace=trace, bootstrap=bootstrap)
+        result = await asyncio.wrap_future(job.future)
+        if result.startswith("Error"):
+            outcome["status"] = "error"
     # Format output for better display - replace escaped newlines with actual newlines
-    formatted_result = result.replace("\\n", "\n")
-    return Response(content=formatted_result, media_type="text/plain")
+    formatted_result, delta_mode = delta_response(result.replace("\\n", "\n"), delta, session, "selection", selection)
+    headers = job_response_headers(job, trace, include_timing)
+    if delta_mode:
+        headers["X-Stata-Delta"] = delta_mode
+    return Response(content=formatted_result, media_type="text/plain", headers=headers)
 
 @app.post("/run_file", operation_id="stata_run_file", response_class=Response)
-async def stata_run_file_endpoint(file_path: str, timeout: int = 600) -> Response:
+async def stata_run_file_endpoint(file_path: str, timeout: int = 600, include_timing: bool = False,
+                                  priority: str = "normal", preemptible: Optional[bool] = None,
+                                  incremental: bool = False, session: Optional[str] = None,
+                                  delta: bool = False, profile: bool = False,
+                                  bootstrap: Optional[str] = None) -> Response:
     """Run a Stata .do file and return the output
     
     Args:
         file_path: Path to the .do file
         timeout: Timeout in seconds (default: 600 seconds / 10 minutes)
+        include_timing: Return per-phase timings in a Server-Timing header
+        priority: Scheduler lane - interactive, normal (default) or batch
+        preemptible: Let interactive work run between "** #" sections of the file
+        incremental: Checkpoint after each "** #" section and resume after the last unchanged one
+        session: Name of a Stata session; on a coordinator, the file runs on that session's worker
+            (without a session it goes to the least loaded worker)
+        delta: Return only the lines that changed since the previous output of this file in this session
+        profile: Time every command and append a table of the slowest ones (line, calls, total time)
+        bootstrap: Bootstrap profile the file needs (run first if this Stata has not run it yet)
     """
+    if cluster_coordinator:
+        params = {"file_path": file_path, "timeout": timeout, "include_timing": include_timing, "priority": priority,
+                  "incremental": incremental, "delta": delta, "profile": profile}
+        if preemptible is not None:
+            params["preemptible"] = preemptible
+        if session:
+            params["session"] = session
+        if bootstrap:
+            params["bootstrap"] = bootstrap
+        forwarded = await cluster_forward("file", "/run_file", session, params=params,
+                                          timeout=int(timeout) if str(timeout).isdigit() else 600, bootstrap=bootstrap,
+                                          lane=normalize_lane(priority, "normal"))
+        if forwarded is not None:
+            return forwarded
     # Ensure timeout is a valid integer
     try:
         timeout = int(timeout)
@@ -1142,8 +5997,16 @@ async def stata_run_file_endpoint(file_path: str, timeout: int = 600) -> Respons
         logging.warning(f"Non-integer timeout value: {timeout}, using default 600")
         timeout = 600
     
+    lane = normalize_lane(priority, "normal")
+    if preemptible is None:
+        preemptible = default_preemptible
+    
     logging.info(f"Running file: {file_path} with timeout {timeout} seconds ({timeout/60:.1f} minutes)")
-    result = run_stata_file(file_path, timeout=timeout)
+    with track_tool_request("stata_run_file") as outcome, request_trace("stata_run_file") as trace:
+        job = await submit_run_file(file_path, timeout, preemptible, lane, trace, incremental, profile, bootstrap)
+        result = await asyncio.wrap_future(job.future)
+        if result.startswith("Error"):
+            outcome["status"] = "error"
     
     # Format output for better display - replace escaped newlines with actual newlines
     formatted_result = result.replace("\\n", "\n")
@@ -1151,7 +6014,11 @@ async def stata_run_file_endpoint(file_path: str, timeout: int = 600) -> Respons
     # Log the output (truncated) for debugging
     logging.debug(f"Run file output (first 100 chars): {formatted_result[:100]}...")
     
-    return Response(content=formatted_result, media_type="text/plain")
+    formatted_result, delta_mode = delta_response(formatted_result, delta, session, "file", file_path)
+    headers = job_response_headers(job, trace, include_timing)
+    if delta_mode:
+        headers["X-Stata-Delta"] = delta_mode
+    return Response(content=formatted_result, media_type="text/plain", headers=headers)
 
 # MCP server will be initialized in main() after args are parsed
 
@@ -1178,6 +6045,32 @@ async def call_tool(request: ToolRequest) -> ToolResponse:
                 message=f"Unknown tool: {request.tool}"
             )
         
+        # Get timeout parameter if provided, otherwise use default (10 minutes)
+        timeout = request.parameters.get("timeout", 600)
+        try:
+            timeout = int(timeout)  # Ensure it's an integer
+            if timeout <= 0:
+                logging.warning(f"Invalid timeout value: {timeout}, using default 600")
+                timeout = 600
+        except (ValueError, TypeError):
+            logging.warning(f"Non-integer timeout value: {timeout}, using default 600")
+            timeout = 600
+        
+        # On a coordinator, the whole request goes to a worker
+        if cluster_coordinator:
+            session = request.parameters.get("session")
+            if mcp_tool_name == "stata_run_selection":
+                session = session or default_session()
+            forwarded = await cluster_forward("selection" if mcp_tool_name == "stata_run_selection" else "file",
+                                              "/v1/tools", session, json_body=request.model_dump(),
+                                              timeout=timeout,
+                                              bootstrap=request.parameters.get("bootstrap"),
+                                              lane=normalize_lane(request.parameters.get("priority"),
+                                                                  "interactive" if mcp_tool_name == "stata_run_selection"
+                                                                  else "normal"))
+            if forwarded is not None:
+                return forwarded
+        
         # Execute the appropriate function
         if mcp_tool_name == "stata_run_selection":
             if "selection" not in request.parameters:
@@ -1185,9 +6078,21 @@ async def call_tool(request: ToolRequest) -> ToolResponse:
                     status="error",
                     message="Missing required parameter: selection"
                 )
-            result = run_stata_selection(request.parameters["selection"])
+            selection = request.parameters["selection"]
+            lane = normalize_lane(request.parameters.get("priority"), "interactive")
+            bootstrap = request.parameters.get("bootstrap") or None
+            if bootstrap:
+                load_bootstrap(bootstrap)
+            with track_tool_request(mcp_tool_name) as outcome, request_trace(mcp_tool_name) as trace:
+                job = stata_scheduler.submit("selection", run_stata_selection, selection,
+                                             lane=lane, description=selection[:80], trace=trace, bootstrap=bootstrap)
+                result = await asyncio.wrap_future(job.future)
+                if result.startswith("Error"):
+                    outcome["status"] = "error"
             # Format output for better display
-            result = result.replace("\\n", "\n")
+            delta = parameter_flag(request.parameters.get("delta"))
+            result, _ = delta_response(result.replace("\\n", "\n"), delta, request.parameters.get("session"),
+                                       "selection", selection)
             
         elif mcp_tool_name == "stata_run_file":
             if "file_path" not in request.parameters:
@@ -1199,17 +6104,6 @@ async def call_tool(request: ToolRequest) -> ToolResponse:
             # Get the file path from the parameters
             file_path = request.parameters["file_path"]
             
-            # Get timeout parameter if provided, otherwise use default (10 minutes)
-            timeout = request.parameters.get("timeout", 600)
-            try:
-                timeout = int(timeout)  # Ensure it's an integer
-                if timeout <= 0:
-                    logging.warning(f"Invalid timeout value: {timeout}, using default 600")
-                    timeout = 600
-            except (ValueError, TypeError):
-                logging.warning(f"Non-integer timeout value: {timeout}, using default 600")
-                timeout = 600
-                
             logging.info(f"MCP run_file request for: {file_path} with timeout {timeout} seconds ({timeout/60:.1f} minutes)")
             
             # Normalize the path for cross-platform compatibility
@@ -1219,8 +6113,19 @@ async def call_tool(request: ToolRequest) -> ToolResponse:
             if platform.system() == "Windows" and '/' in file_path:
                 file_path = file_path.replace('/', '\\')
             
+            lane = normalize_lane(request.parameters.get("priority"), "normal")
+            preemptible = parameter_flag(request.parameters.get("preemptible"), default_preemptible)
+            incremental = parameter_flag(request.parameters.get("incremental"))
+            profile = parameter_flag(request.parameters.get("profile"))
+            bootstrap = request.parameters.get("bootstrap") or None
+            
             # Run the file through the run_stata_file function with timeout
-            result = run_stata_file(file_path, timeout=timeout)
+            with track_tool_request(mcp_tool_name) as outcome, request_trace(mcp_tool_name) as trace:
+                job = await submit_run_file(file_path, timeout, preemptible, lane, trace, incremental, profile,
+                                            bootstrap)
+                result = await asyncio.wrap_future(job.future)
+                if result.startswith("Error"):
+                    outcome["status"] = "error"
             
             # Format output for better display
             result = result.replace("\\n", "\n")
@@ -1240,13 +6145,26 @@ async def call_tool(request: ToolRequest) -> ToolResponse:
                     result += "1. Make sure the file path uses correct separators (use \\ instead of /)\n"
                     result += "2. Check if the file exists in the specified location\n"
                     result += "3. If using relative paths, the current working directory is: " + os.getcwd()
+            
+            result, _ = delta_response(result, parameter_flag(request.parameters.get("delta")),
+                                       request.parameters.get("session"), "file", file_path)
         
-        # Return successful response
+        # Return successful response, with per-phase timings if requested
         return ToolResponse(
             status="success",
-            result=result
+            result=result,
+            timing=trace.to_dict() if parameter_flag(request.parameters.get("include_timing")) else None,
+            job=job_info(job, trace)
         )
         
+    except QueueFullError:
+        # Answered with 429 by the queue_full_handler
+        raise
+    except (PreflightError, BootstrapError) as e:
+        return ToolResponse(
+            status="error",
+            message=str(e)
+        )
     except Exception as e:
         logging.error(f"Error handling tool request: {str(e)}")
         return ToolResponse(
@@ -1254,6 +6172,123 @@ async def call_tool(request: ToolRequest) -> ToolResponse:
             message=f"Server error: {str(e)}"
         )
 
+# Function to name the session of a request that did not give one
+def default_session():
+    """Each tenant (or the single user) has one default session"""
+    tenant = current_tenant()
+    return f"tenant:{tenant.name}" if tenant is not None else "default"
+
+# Cluster endpoints - worker registration and heartbeats (cluster token), and the worker list
+@app.post("/cluster/register")
+async def cluster_register(message: ClusterMessage):
+    if not cluster_coordinator or not cluster_authorized(message.token):
+        return JSONResponse(status_code=403, content={"status": "error", "message": "Not a coordinator or bad cluster token"})
+    if not message.url:
+        return JSONResponse(status_code=400, content={"status": "error", "message": "Missing worker url"})
+    with cluster_lock:
+        worker = ClusterWorker(message.worker_id, message.url, message.info)
+        worker.load = message.load
+        cluster_workers[message.worker_id] = worker
+        cluster_update_metrics()
+    logging.info(f"Worker {message.worker_id} registered from {message.url} (backend {message.info.get('backend')})")
+    return {"status": "ok", "heartbeat_interval": CLUSTER_HEARTBEAT_INTERVAL}
+
+@app.post("/cluster/heartbeat")
+async def cluster_heartbeat(message: ClusterMessage):
+    if not cluster_coordinator or not cluster_authorized(message.token):
+        return JSONResponse(status_code=403, content={"status": "error", "message": "Not a coordinator or bad cluster token"})
+    with cluster_lock:
+        worker = cluster_workers.get(message.worker_id)
+        if worker is None or not worker.alive:
+            # Unknown or dropped workers register again
+            return JSONResponse(status_code=404, content={"status": "error", "message": "Unknown worker"})
+        worker.last_seen = time.time()
+        worker.load = message.load
+    return {"status": "ok"}
+
+@app.post("/cluster/deregister")
+async def cluster_deregister(message: ClusterMessage):
+    if not cluster_coordinator or not cluster_authorized(message.token):
+        return JSONResponse(status_code=403, content={"status": "error", "message": "Not a coordinator or bad cluster token"})
+    worker = cluster_workers.get(message.worker_id)
+    if worker is not None:
+        cluster_mark_lost(worker, "deregistered")
+    return {"status": "ok"}
+
+@app.get("/cluster/workers")
+async def cluster_worker_list():
+    with cluster_lock:
+        return {"coordinator": cluster_coordinator,
+                "workers": [worker.to_dict() for worker in cluster_workers.values()]}
+
+# Function to find the tenant whose jobs a request may see
+def tenant_filter():
+    """Return the requesting tenant, or None when it may see every job (single-user mode or an admin tenant)"""
+    tenant = current_tenant()
+    return None if tenant is None or tenant.admin else tenant
+
+# Tenant identification - in multi-tenant mode requests must present a tenant token as a bearer token
+# (MCP clients: an Authorization header) or in X-Stata-Token
+@app.middleware("http")
+async def identify_tenant(request: Request, call_next):
+    if not tenants or request.url.path in TENANT_OPEN_PATHS:
+        return await call_next(request)
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+    else:
+        token = request.headers.get("x-stata-token", "").strip()
+    tenant = tenant_for_token(token) if token else None
+    if tenant is None:
+        return JSONResponse(status_code=401, headers={"WWW-Authenticate": "Bearer"},
+                            content={"status": "error", "message": "A valid tenant token is required"})
+    context_token = _tenant_context.set(tenant)
+    try:
+        return await call_next(request)
+    finally:
+        _tenant_context.reset(context_token)
+
+# Worker authentication - a worker agent only serves the coordinator, which sends the cluster token
+# in X-Stata-Cluster-Token; anything else could bypass the coordinator's tenant checks
+@app.middleware("http")
+async def check_cluster_token(request: Request, call_next):
+    if not cluster_worker or request.url.path in CLUSTER_OPEN_PATHS:
+        return await call_next(request)
+    if not cluster_authorized(request.headers.get("x-stata-cluster-token")):
+        return JSONResponse(status_code=403, content={"status": "error",
+                                                      "message": "This server is a cluster worker; send requests to its coordinator"})
+    name = request.headers.get("x-stata-tenant")
+    if not name:
+        return await call_next(request)
+    # The coordinator checked the tenant's token and limits; here it only keeps tenants' state apart
+    with cluster_lock:
+        tenant = cluster_tenants.setdefault(name, Tenant(name, None))
+    context_token = _tenant_context.set(tenant)
+    try:
+        return await call_next(request)
+    finally:
+        _tenant_context.reset(context_token)
+
+# Tenant usage endpoint - limits and consumption of the calling tenant (every tenant for admins)
+@app.get("/tenants/usage", operation_id="stata_usage")
+async def tenant_usage():
+    """Show your tenant's limits and usage: CPU-seconds in the last hour and in total, jobs queued,
+    running, finished and rejected. Admin tenants see every tenant.
+    """
+    tenant = current_tenant()
+    if tenant is None:
+        return JSONResponse(status_code=404, content={"status": "error", "message": "Multi-tenant mode is off"})
+    visible = list(tenants.values()) if tenant.admin else [tenant]
+    with stata_scheduler.condition:
+        usage = []
+        for entry in visible:
+            jobs = stata_scheduler.tenant_jobs(entry)
+            usage.append(dict(entry.to_dict(), jobs_running=sum(job.status == "running" for job in jobs),
+                              jobs_queued=sum(job.status == "queued" for job in jobs),
+                              queued_work_seconds=round(sum(max(0.0, job.estimated_seconds - job.run_seconds)
+                                                            for job in jobs), 3)))
+    return {"tenants": usage}
+
 # Simplified health check endpoint - only report server status without executing Stata commands
 @app.get("/health")
 async def health_check():
@@ -1264,6 +6299,290 @@ async def health_check():
         "stata_available": stata_available
     }
 
+# Scheduler queue endpoint - running and queued jobs with their queue wait times
+@app.get("/jobs/queue")
+async def job_queue():
+    snapshot = stata_scheduler.snapshot(tenant_filter())
+    if cpu_allocator is not None:
+        snapshot["cpu"] = cpu_allocator.snapshot()
+    return snapshot
+
+# Job history endpoints - finished jobs are read from the persistent job store, so results
+# survive server restarts and agents can fetch earlier runs instead of executing them again
+@app.get("/jobs", operation_id="stata_list_jobs")
+async def list_jobs(file_path: Optional[str] = None, status: Optional[str] = None, content_hash: Optional[str] = None,
+                    since: Optional[float] = None, until: Optional[float] = None, limit: int = 50):
+    """List recent Stata jobs (newest first) with their status, timings and return codes
+
+    Args:
+        file_path: Only jobs that ran this .do file
+        status: Only jobs with this status (queued, running, done, failed, interrupted)
+        content_hash: Only jobs whose code had this sha256 hash
+        since: Only jobs submitted at or after this Unix timestamp
+        until: Only jobs submitted before this Unix timestamp
+        limit: Maximum number of jobs to return (default 50)
+    """
+    if job_store is None:
+        return JSONResponse(status_code=404, content={"status": "error", "message": "Job store is disabled"})
+    if file_path:
+        resolved_path, _ = await asyncio.to_thread(resolve_do_file_path, file_path)
+        file_path = os.path.normcase(os.path.abspath(resolved_path or file_path))
+    tenant = tenant_filter()
+    jobs = await asyncio.to_thread(job_store.find, file_path, status, content_hash, since, until, limit,
+                                   tenant.name if tenant is not None else None)
+    return {"jobs": jobs}
+
+@app.get("/jobs/estimate", operation_id="stata_estimate_runtime")
+async def estimate_runtime(file_path: str, history: int = 10):
+    """Predict how long a .do file will run from its earlier runs, with a suggested timeout
+
+    Based on the median of recent clean runs of the same file content, or of the same path when the
+    content changed since. Returns no prediction for files that have not run yet.
+
+    Args:
+        file_path: The .do file to estimate
+        history: How many recent runs of the file to include (default 10)
+    """
+    if job_store is None:
+        return JSONResponse(status_code=404, content={"status": "error", "message": "Job store is disabled"})
+    key = await asyncio.to_thread(run_file_dedupe_key, file_path)
+    if key is None:
+        return JSONResponse(status_code=404, content={"status": "error", "message": f"Cannot read .do file: {file_path}"})
+    prediction = await asyncio.to_thread(predict_runtime, key[0], key[1])
+    tenant = tenant_filter()
+    runs = await asyncio.to_thread(job_store.find, key[0], None, None, None, None, max(0, history),
+                                   tenant.name if tenant is not None else None)
+    return {"file_path": key[0], "content_hash": key[1], "prediction": prediction,
+            "runs": [run for run in runs if run["kind"] == "file"]}
+
+@app.get("/jobs/{job_id}", operation_id="stata_get_job")
+async def get_job(job_id: str, include_output: bool = True):
+    """Fetch a Stata job by id, including its output once it has finished
+
+    Args:
+        job_id: The job id returned by run_selection or run_file (X-Stata-Job-Id)
+        include_output: Include the job's output (default: true)
+    """
+    job = await asyncio.to_thread(job_store.get, job_id, include_output) if job_store is not None else None
+    tenant = tenant_filter()
+    if job is not None and tenant is not None and job["tenant"] != tenant.name:
+        job = None  # other tenants' jobs do not exist as far as this tenant can tell
+    if job is None:
+        return JSONResponse(status_code=404, content={"status": "error", "message": f"Unknown job: {job_id}"})
+    return job
+
+@app.post("/load_parquet", operation_id="stata_load_parquet")
+async def load_parquet(request: LoadParquetRequest):
+    """Load a Parquet file into Stata's memory, reading only the requested columns and rows
+
+    Streams Arrow record batches straight into the dataset without a CSV round trip. Integers, floats,
+    booleans, strings, dates (%td) and timestamps (%tc) are mapped to Stata types; other columns are
+    skipped and listed in the response.
+    """
+    with track_tool_request("stata_load_parquet") as outcome, request_trace("stata_load_parquet") as trace:
+        job = stata_scheduler.submit("parquet", run_load_parquet, request.file_path, columns=request.columns,
+                                     row_groups=request.row_groups, filters=request.filters,
+                                     batch_size=request.batch_size, clear=request.clear,
+                                     lane="normal", description=request.file_path, trace=trace)
+        try:
+            result = json.loads(await asyncio.wrap_future(job.future))
+        except ValueError as e:
+            outcome["status"] = "error"
+            return JSONResponse(status_code=400, content={"status": "error", "message": str(e)})
+        except Exception as e:
+            outcome["status"] = "error"
+            return JSONResponse(status_code=500, content={"status": "error", "message": f"Error loading Parquet file: {str(e)}"})
+    return dict(result, job=job_info(job, trace))
+
+@app.post("/check_do_file", operation_id="stata_check_do_file", response_class=Response)
+async def check_do_file(file_path: str) -> Response:
+    """Check a Stata .do file for structural errors without running it
+
+    Reports unclosed comments, strings and braces, loops without an open brace, programs without end,
+    bad #delimit lines and do/include files that do not exist, with line numbers. run_file applies the
+    same check and refuses files with errors.
+
+    Args:
+        file_path: Path to the .do file
+    """
+    # Resolving a relative path can walk the workspace, so keep it off the event loop
+    resolved_path, error_msg = await asyncio.to_thread(resolve_do_file_path, file_path)
+    if error_msg:
+        return Response(content=error_msg, media_type="text/plain")
+    start = time.perf_counter()
+    try:
+        problems = await asyncio.to_thread(preflight_check, resolved_path)
+    except OSError as e:
+        return Response(content=f"Error: could not read {resolved_path}: {str(e)}", media_type="text/plain")
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if not problems:
+        return Response(content=f"No problems found in {resolved_path} ({elapsed_ms:.1f} ms)", media_type="text/plain")
+    return Response(content=f"{format_preflight_problems(resolved_path, problems)}\n({elapsed_ms:.1f} ms)",
+                    media_type="text/plain")
+
+# Dataset cache endpoint - cached frames with their hit counts and the overall hit/miss statistics
+@app.get("/datasets/cache")
+async def dataset_cache_status():
+    with dataset_cache_lock:
+        entries = [dict(entry) for entry in dataset_cache.values()]
+        stats = dict(dataset_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    return dict(stats, hit_rate=round(stats["hits"] / lookups, 3) if lookups else None,
+                budget_bytes=dataset_cache_budget, used_bytes=sum(e["size"] for e in entries),
+                entries=sorted(entries, key=lambda e: e["last_used"], reverse=True))
+
+# Graph endpoint - serves a captured graph export by the file name listed in run_file output
+@app.get("/graphs/{file_name}")
+async def graph_file(file_name: str):
+    from fastapi.responses import FileResponse
+    path = os.path.join(graph_directory(), file_name)
+    if not GRAPH_FILE_RE.match(file_name) or not os.path.isfile(path) or not graph_visible(file_name):
+        return JSONResponse(status_code=404, content={"status": "error", "message": f"Unknown graph: {file_name}"})
+    return FileResponse(path, media_type=GRAPH_MIME_TYPES[file_name.rsplit(".", 1)[1]])
+
+# Parameter sweep endpoints - runs go to the sweep worker processes, not the scheduler's Stata
+@app.post("/sweep", operation_id="stata_run_sweep")
+async def run_sweep(request: SweepRequest):
+    """Run a do-file once per combination of arguments on parallel Stata workers
+
+    Collects e(cmd) and every e()/r() scalar of each run into one CSV or Parquet table. Failed runs
+    are retried. Returns aggregate progress and, once finished, the path of the table and its first rows.
+    """
+    try:
+        sweep, future = await asyncio.to_thread(
+            start_sweep, request.file_path, request.grid, request.args, request.concurrency, request.retries,
+            request.timeout, request.output_path, request.output_format, request.bootstrap)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"status": "error", "message": str(e)})
+    if not request.wait:
+        return sweep.progress()
+    progress = await asyncio.wrap_future(future)
+    columns, rows = sweep.table()
+    return dict(progress, columns=columns, rows=rows[:20])
+
+@app.get("/sweep/{sweep_id}", operation_id="stata_sweep_status")
+async def sweep_status(sweep_id: str):
+    """Report the progress of a parameter sweep (runs done, failed, running, pending and an ETA)
+
+    Args:
+        sweep_id: The id returned by stata_run_sweep
+    """
+    sweep = sweeps.get(sweep_id)
+    tenant = tenant_filter()
+    if sweep is None or (tenant is not None and sweep.tenant is not tenant):
+        return JSONResponse(status_code=404, content={"status": "error", "message": f"Unknown sweep: {sweep_id}"})
+    return sweep.progress()
+
+# Sampling profiler - /debug/profile samples the Python stacks of every server thread for a few
+# seconds and returns them as collapsed stacks ("thread;frame;frame count" per line), the input
+# format of flamegraph.pl, inferno and speedscope. Sampling only reads sys._current_frames(), so it
+# is safe while Stata jobs run; time inside Stata shows up under the backend's run().
+PROFILER_MAX_SECONDS = 60
+PROFILER_MAX_DEPTH = 128
+# Leaf frames of threads that are waiting for work; left out unless idle stacks are asked for
+PROFILER_IDLE_FRAMES = {("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"),
+                        ("selectors.py", "select"), ("queue.py", "get"), ("thread.py", "_worker"),
+                        ("socket.py", "accept")}
+profiler_lock = threading.Lock()
+
+# Function to sample the stacks of the server's threads
+def sample_thread_stacks(seconds, interval, include_idle=False):
+    """Return (collapsed stack -> samples, samples taken, thread name -> samples) over the given seconds"""
+    import collections
+    own = threading.get_ident()
+    stacks = collections.Counter()
+    threads = collections.Counter()
+    labels = {}  # code object -> frame label, so each function is formatted once
+    samples = 0
+    deadline = time.perf_counter() + seconds
+    while True:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            if not include_idle and (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in PROFILER_IDLE_FRAMES:
+                continue
+            frames = []
+            while frame is not None and len(frames) < PROFILER_MAX_DEPTH:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                frames.append(label)
+                frame = frame.f_back
+            name = names.get(ident, f"thread-{ident}")
+            frames.append(name)
+            stacks[";".join(reversed(frames))] += 1
+            threads[name] += 1
+        frame = None  # do not keep the last thread's frames alive while sleeping
+        samples += 1
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
+        time.sleep(min(interval, remaining))
+    return stacks, samples, threads
+
+# Function to summarize collapsed stacks by function
+def profile_functions(stacks, limit=30):
+    """Return the functions with the most samples: self (at the top of the stack) and total"""
+    import collections
+    own, total = collections.Counter(), collections.Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")[1:]  # the first entry is the thread name
+        if frames:
+            own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    return [{"function": function, "self": own[function], "total": count}
+            for function, count in total.most_common(limit)]
+
+# Bootstrap profile endpoint - configured profiles and the profile each Stata instance has run
+@app.get("/bootstrap", operation_id="stata_bootstrap_profiles")
+async def bootstrap_profiles():
+    """List the bootstrap profiles jobs can request (bootstrap parameter of run_file, run_selection
+    and sweeps), with their fingerprints and the profile each Stata instance has already run
+    """
+    profiles = await asyncio.to_thread(list_bootstraps)
+    instances = {"main": stata_backend.bootstrap if stata_backend is not None else None}
+    if sweep_worker_pool is not None and sweep_worker_pool.started:
+        with sweep_worker_pool.available:
+            for backend in sweep_worker_pool.idle:
+                instances[f"sweep:{backend.address[1]}"] = backend.bootstrap
+    return {"directory": bootstrap_dir, "default": default_bootstrap, "profiles": profiles, "instances": instances}
+
+# Server profiling endpoint - admin tenants only in multi-tenant mode
+@app.get("/debug/profile", response_class=Response)
+async def debug_profile(seconds: float = 10.0, interval_ms: float = 10.0, format: str = "collapsed",
+                        include_idle: bool = False):
+    tenant = current_tenant()
+    if tenant is not None and not tenant.admin:
+        return JSONResponse(status_code=403, content={"status": "error", "message": "Profiling needs an admin tenant"})
+    if format not in ("collapsed", "json"):
+        return JSONResponse(status_code=400, content={"status": "error", "message": "format must be collapsed or json"})
+    seconds = min(max(float(seconds), 0.1), PROFILER_MAX_SECONDS)
+    interval = max(float(interval_ms), 1.0) / 1000.0
+    if not profiler_lock.acquire(blocking=False):
+        return JSONResponse(status_code=409, content={"status": "error", "message": "A profile is already being taken"})
+    try:
+        logging.info(f"Sampling server threads for {seconds:.1f} seconds every {interval * 1000:.0f} ms")
+        # The sampler runs on a worker thread so the event loop (which is sampled too) keeps serving
+        stacks, samples, threads = await asyncio.to_thread(sample_thread_stacks, seconds, interval, include_idle)
+    finally:
+        profiler_lock.release()
+    metrics_inc("stata_mcp_server_profiles_total")
+    if format == "json":
+        return JSONResponse(content={"seconds": seconds, "interval_ms": interval * 1000, "samples": samples,
+                                     "threads": dict(threads.most_common()), "functions": profile_functions(stacks),
+                                     "stacks": dict(stacks.most_common())})
+    content = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    return Response(content=content, media_type="text/plain",
+                    headers={"X-Profile-Samples": str(samples), "X-Profile-Seconds": f"{seconds:.1f}"})
+
+# Prometheus-style metrics endpoint - rendered from in-process counters, no Stata calls
+@app.get("/metrics", response_class=Response)
+async def metrics_endpoint() -> Response:
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4")
+
 def main():
     """Main function to set up and run the server"""
     try:
@@ -1282,6 +6601,83 @@ def main():
                           help='Location for .do file logs (extension, workspace, custom) - default: extension')
         parser.add_argument('--custom-log-directory', type=str, default='',
                           help='Custom directory for .do file logs (when location is custom)')
+        parser.add_argument('--backend', type=str, choices=['pystata', 'fake', 'remote'], default='pystata',
+                          help='Stata backend: pystata (real Stata), fake (no Stata needed, for testing and benchmarks) '
+                               'or remote (a long-lived Stata host process, started if not running)')
+        parser.add_argument('--host-backend', type=str, choices=['pystata', 'fake'], default='pystata',
+                          help='Backend used by a Stata host started by --backend remote')
+        parser.add_argument('--stata-host', action='store_true',
+                          help='Run as the Stata host process instead of the API server')
+        parser.add_argument('--stata-host-address', type=str, default=DEFAULT_STATA_HOST_ADDRESS,
+                          help=f'Local address of the Stata host (default: {DEFAULT_STATA_HOST_ADDRESS})')
+        parser.add_argument('--stata-host-token-file', type=str, default='',
+                          help='File holding the Stata host token (default: stata_mcp_host.token next to the log file)')
+        parser.add_argument('--fake-backend-options', type=str, default='',
+                          help='Options for the fake backend, e.g. "latency=0.2,output_lines=20,failure_rate=0.05,failure_mode=stata_error"')
+        parser.add_argument('--lane-weights', type=str, default='',
+                          help='Scheduler lane weights, e.g. "interactive=8,normal=2,batch=1"')
+        parser.add_argument('--preemption-points', action='store_true',
+                          help='Run do-files block by block at "** #" section markers so interactive work can run in between')
+        parser.add_argument('--no-preflight', action='store_true',
+                          help='Do not check do-files for structural errors before queueing them')
+        parser.add_argument('--resource-sample-interval', type=float, default=1.0,
+                          help='Seconds between samples of the Stata process RSS, CPU and I/O during jobs (0 disables, Linux only)')
+        parser.add_argument('--max-job-memory-mb', type=float, default=0,
+                          help='Cancel a job when the Stata process RSS grows by more than this many MB during the job (default: 0, no limit)')
+        parser.add_argument('--max-job-cpu-seconds', type=float, default=0,
+                          help='Cancel a job after this many CPU-seconds of the Stata process (default: 0, no limit)')
+        parser.add_argument('--no-cpu-partitioning', action='store_true',
+                          help='Let every Stata process use all CPUs instead of splitting them among concurrent jobs')
+        parser.add_argument('--max-queue-length', type=int, default=0,
+                          help='Reject new jobs with 429 when this many jobs are waiting (0 = unlimited)')
+        parser.add_argument('--max-queued-work', type=float, default=0,
+                          help='Reject new jobs with 429 when estimated queued work exceeds this many seconds (0 = unlimited)')
+        parser.add_argument('--file-work-estimate', type=float, default=60,
+                          help='Estimated seconds of work per do-file, used by --max-queued-work (default: 60)')
+        parser.add_argument('--shortest-job-first', action='store_true',
+                          help='Run queued jobs with the shortest predicted run time first within each lane')
+        parser.add_argument('--job-store', type=str, default='',
+                          help='SQLite file for job history and results (default: stata_mcp_jobs.db next to the log file, "none" to disable)')
+        parser.add_argument('--job-retention-days', type=float, default=30,
+                          help='Delete stored jobs older than this many days (0 keeps them)')
+        parser.add_argument('--job-retention-count', type=int, default=1000,
+                          help='Keep at most this many stored jobs (0 for no limit)')
+        parser.add_argument('--dataset-cache-mb', type=float, default=0,
+                          help='Keep datasets loaded with `use` in Stata frames up to this many MB and serve unchanged files from them (default: 0, off)')
+        parser.add_argument('--graph-formats', type=str, default='png',
+                          help='Export graphs created by do-files in these formats (comma-separated png, svg, pdf; "none" disables capture)')
+        parser.add_argument('--graph-dir', type=str, default='',
+                          help='Directory for the graph export cache (default: stata_mcp_graphs next to the log file)')
+        parser.add_argument('--graph-width', type=int, default=1200,
+                          help='Width in pixels of PNG graph exports (default: 1200)')
+        parser.add_argument('--tenants-file', type=str, default='',
+                          help='JSON file of tenants (name, token, weight and limits); enables multi-tenant mode with token authentication')
+        parser.add_argument('--coordinator', action='store_true',
+                          help='Forward run_file and run_selection to worker servers that register with this server')
+        parser.add_argument('--coordinator-url', type=str, default='',
+                          help='Run as a worker agent: register with the coordinator at this URL (e.g. http://10.0.0.5:4000)')
+        parser.add_argument('--worker-id', type=str, default='',
+                          help='Name of this worker at the coordinator (default: <hostname>-<port>)')
+        parser.add_argument('--advertise-url', type=str, default='',
+                          help='URL the coordinator uses to reach this worker (default: derived from --host and --port)')
+        parser.add_argument('--cluster-token-file', type=str, default='',
+                          help='File holding the token shared by a coordinator and its workers (default: stata_mcp_cluster.token next to the log file)')
+        parser.add_argument('--sweep-workers', type=int, default=2,
+                          help='Stata worker processes for parameter sweeps (each is a separate Stata instance)')
+        parser.add_argument('--sweep-worker-base-port', type=int, default=SWEEP_WORKER_BASE_PORT,
+                          help=f'First local port used by sweep workers (default: {SWEEP_WORKER_BASE_PORT})')
+        parser.add_argument('--checkpoint-dir', type=str, default='',
+                          help='Directory for incremental run checkpoints (default: stata_mcp_checkpoints next to the scratch directory)')
+        parser.add_argument('--bootstrap-dir', type=str, default='',
+                          help='Directory of bootstrap profiles (<name>.do) that jobs can request by name')
+        parser.add_argument('--bootstrap', type=str, default='',
+                          help='Bootstrap profile to run on every Stata instance when it starts')
+        parser.add_argument('--scratch-dir', type=str, default='',
+                          help='Directory for temporary .do/.log files (default: /dev/shm/stata_mcp_scratch on Linux, else the system temp directory)')
+        parser.add_argument('--scratch-max-mb', type=float, default=DEFAULT_SCRATCH_MAX_BYTES / (1024 * 1024),
+                          help='Refuse new runs while temporary files use more than this many MB (0 for no limit)')
+        parser.add_argument('--trace-file', type=str, default='',
+                          help='Append per-phase timing spans of every tool call to this JSONL file (Chrome trace events)')
         
         # Special handling when running as a module
         if is_running_as_module:
@@ -1413,10 +6809,97 @@ def main():
         logging.getLogger().setLevel(log_level)
         
         # Set Stata edition
-        global stata_edition, log_file_location, custom_log_directory, extension_path
+        global stata_edition, log_file_location, custom_log_directory, extension_path, trace_file_path
         stata_edition = args.stata_edition.lower()
         log_file_location = args.log_file_location
         custom_log_directory = args.custom_log_directory
+        if args.trace_file:
+            trace_file_path = os.path.abspath(args.trace_file)
+            logging.info(f"Writing timing traces to: {trace_file_path}")
+        
+        # Configure the job scheduler
+        global default_preemptible, stata_scheduler, file_work_estimate, preflight_enabled
+        default_preemptible = args.preemption_points
+        preflight_enabled = not args.no_preflight
+        global resource_sample_interval, max_job_rss_bytes, max_job_cpu_seconds
+        resource_sample_interval = max(0.0, args.resource_sample_interval)
+        max_job_rss_bytes = int(args.max_job_memory_mb * 1024 * 1024)
+        max_job_cpu_seconds = args.max_job_cpu_seconds
+        if (max_job_rss_bytes or max_job_cpu_seconds) and (not has_proc or not resource_sample_interval):
+            logging.warning("Job memory/CPU limits need resource sampling from /proc (Linux) and are not enforced")
+        global cpu_allocator
+        if not args.no_cpu_partitioning and not args.stata_host and hasattr(os, "sched_setaffinity") and has_proc:
+            cpu_allocator = CpuAllocator()
+            logging.info(f"CPU partitioning over {len(cpu_allocator.cpus)} CPUs ({len(cpu_allocator.cores)} cores)")
+        file_work_estimate = args.file_work_estimate
+        global shortest_job_first
+        shortest_job_first = args.shortest_job_first
+        lane_weights = dict(DEFAULT_LANE_WEIGHTS)
+        if args.lane_weights:
+            for item in args.lane_weights.split(','):
+                if '=' in item:
+                    lane, weight = item.split('=', 1)
+                    if lane.strip() in SCHEDULER_LANES:
+                        lane_weights[lane.strip()] = max(1, int(weight))
+        stata_scheduler = StataScheduler(lane_weights, max_queue_length=args.max_queue_length,
+                                         max_queued_work=args.max_queued_work)
+        logging.info(f"Scheduler lane weights: {lane_weights}, max queue length: {args.max_queue_length or 'unlimited'}, "
+                     f"max queued work: {args.max_queued_work or 'unlimited'}")
+        
+        # Set up the scratch area for temporary files and remove files left by dead servers
+        global scratch_area
+        if not args.stata_host:
+            scratch_area = ScratchArea(args.scratch_dir or None, max_bytes=int(args.scratch_max_mb * 1024 * 1024))
+            scratch_area.reap_orphans()
+            logging.info(f"Scratch directory: {scratch_area.directory} (limit {args.scratch_max_mb or 'unlimited'} MB)")
+        global dataset_cache_budget
+        dataset_cache_budget = int(args.dataset_cache_mb * 1024 * 1024)
+        global tenants
+        if args.tenants_file and not args.stata_host:
+            try:
+                tenants = load_tenants(os.path.abspath(args.tenants_file))
+                logging.info(f"Multi-tenant mode: {len(tenants)} tenants from {args.tenants_file}")
+            except (OSError, ValueError) as e:
+                logging.error(f"Cannot load tenants file {args.tenants_file}: {str(e)}")
+                sys.exit(1)
+        global graph_formats, graph_cache_dir, graph_export_width
+        graph_formats = []
+        for fmt in args.graph_formats.lower().split(','):
+            fmt = fmt.strip()
+            if fmt in GRAPH_MIME_TYPES and fmt not in graph_formats:
+                graph_formats.append(fmt)
+            elif fmt and fmt != 'none':
+                logging.warning(f"Ignoring unknown graph format: {fmt}")
+        graph_cache_dir = os.path.abspath(args.graph_dir or os.path.join(os.path.dirname(os.path.abspath(log_file)),
+                                                                         'stata_mcp_graphs'))
+        graph_export_width = max(1, args.graph_width)
+        global sweep_worker_count, sweep_worker_pool
+        sweep_worker_count = max(1, args.sweep_workers)
+        sweep_worker_pool = StataWorkerPool(sweep_worker_count, args.sweep_worker_base_port)
+        global checkpoint_root
+        if args.checkpoint_dir:
+            checkpoint_root = os.path.abspath(args.checkpoint_dir)
+        global bootstrap_dir, default_bootstrap
+        if args.bootstrap_dir and not args.stata_host:
+            bootstrap_dir = os.path.abspath(args.bootstrap_dir)
+            default_bootstrap = args.bootstrap or None
+            logging.info(f"Bootstrap profiles: {', '.join(p['name'] for p in list_bootstraps()) or 'none'} in {bootstrap_dir}"
+                         + (f" (default {default_bootstrap})" if default_bootstrap else ""))
+        elif args.bootstrap and not args.stata_host:
+            logging.warning("--bootstrap needs --bootstrap-dir; no bootstrap profile will run")
+        
+        # Open the persistent job store
+        global job_store
+        if args.job_store.lower() != 'none' and not args.stata_host:
+            job_store_path = args.job_store or os.path.join(os.path.dirname(os.path.abspath(log_file)), 'stata_mcp_jobs.db')
+            try:
+                job_store = JobStore(os.path.abspath(job_store_path), retention_days=args.job_retention_days,
+                                     max_jobs=args.job_retention_count)
+                logging.info(f"Job store: {job_store.path} (retention {args.job_retention_days or 'unlimited'} days, "
+                             f"{args.job_retention_count or 'unlimited'} jobs)")
+            except Exception as e:
+                logging.error(f"Failed to open job store {job_store_path}: {str(e)}")
+                job_store = None
         
         # Try to determine extension path from the log file path
         if args.log_file:
@@ -1471,11 +6954,34 @@ def main():
                     STATA_PATH = '/usr/local/stata'
                     
         logging.info(f"Using Stata path: {STATA_PATH}")
-        if not os.path.exists(STATA_PATH):
+        stata_runtime = args.host_backend if args.backend == 'remote' else args.backend
+        if stata_runtime != 'fake' and not os.path.exists(STATA_PATH):
             logging.error(f"Stata path does not exist: {STATA_PATH}")
             print(f"ERROR: Stata path does not exist: {STATA_PATH}")
             sys.exit(1)
         
+        # Run as the long-lived Stata host instead of the API server
+        log_dir = os.path.dirname(os.path.abspath(log_file))
+        host_token_file = args.stata_host_token_file or os.path.join(log_dir, 'stata_mcp_host.token')
+        # Host processes started by this server (the remote backend, sweep workers) use the same Stata runtime
+        global stata_host_args, stata_host_log_dir
+        stata_host_log_dir = log_dir
+        stata_host_args = ['--backend', stata_runtime, '--stata-edition', stata_edition, '--log-level', args.log_level]
+        if STATA_PATH:
+            stata_host_args += ['--stata-path', STATA_PATH]
+        if args.fake_backend_options:
+            stata_host_args += ['--fake-backend-options', args.fake_backend_options]
+        if args.stata_host:
+            if args.backend == 'remote':
+                print("ERROR: --stata-host needs a local backend (pystata or fake)")
+                sys.exit(1)
+            if args.backend == 'fake':
+                init_fake_backend(args.fake_backend_options)
+            else:
+                try_init_stata(STATA_PATH)
+            serve_stata_host(args.stata_host_address, host_token_file)
+            return
+        
         # Check if the requested port is available
         port = args.port
         
@@ -1498,16 +7004,48 @@ def main():
                         logging.info(f"Attempting to kill process using port {port}")
                         kill_process_on_port(port)
         
-        # Try to initialize Stata
-        try_init_stata(STATA_PATH)
+        # Try to initialize Stata (or install the fake backend); try_init_stata runs the bootstrap itself
+        if args.backend == 'fake':
+            bootstrap_new_backend(init_fake_backend(args.fake_backend_options))
+        elif args.backend == 'remote':
+            bootstrap_new_backend(init_remote_backend(args.stata_host_address, host_token_file, stata_host_args,
+                                                      os.path.join(log_dir, 'stata_mcp_host.log')))
+        else:
+            try_init_stata(STATA_PATH)
+        
+        # Coordinator and worker agent roles share a token file
+        global cluster_coordinator, cluster_worker, cluster_token
+        if args.coordinator or args.coordinator_url:
+            cluster_token_file = args.cluster_token_file or os.path.join(log_dir, 'stata_mcp_cluster.token')
+            cluster_token = load_host_token(cluster_token_file, create=args.coordinator)
+            if cluster_token is None:
+                print(f"ERROR: cluster token file {cluster_token_file} not found; copy it from the coordinator")
+                sys.exit(1)
+            cluster_coordinator = args.coordinator
+            cluster_worker = bool(args.coordinator_url)
+        if args.coordinator_url:
+            if args.host in ('0.0.0.0', '::'):
+                advertised_host = socket.gethostname()
+            else:
+                advertised_host = '127.0.0.1' if args.host == 'localhost' else args.host
+            worker_id = args.worker_id or f"{socket.gethostname()}-{port}"
+            advertise_url = args.advertise_url or f"http://{advertised_host}:{port}"
+            threading.Thread(target=run_worker_agent, name="worker-agent", daemon=True,
+                             args=(args.coordinator_url, worker_id, advertise_url, f"http://127.0.0.1:{port}")).start()
         
         # Create and mount the MCP server
         mcp = FastApiMCP(
             app,
             name=SERVER_NAME,
             description="This server provides tools for running Stata commands and scripts.",
-            exclude_operations=["call_tool_v1_tools_post", "health_check_health_get"]  # Exclude these operations from MCP tools
+            exclude_operations=["call_tool_v1_tools_post", "health_check_health_get", "metrics_endpoint_metrics_get", "job_queue_jobs_queue_get",
+                               "dataset_cache_status_datasets_cache_get", "graph_file_graphs__file_name__get",
+                               "cluster_register_cluster_register_post", "cluster_heartbeat_cluster_heartbeat_post",
+                               "cluster_deregister_cluster_deregister_post", "cluster_worker_list_cluster_workers_get",
+                               "debug_profile_debug_profile_get"]  # Exclude these operations from MCP tools
         )
+        # Captured graphs are MCP resources rather than tools
+        register_graph_resources(mcp.server)
 
         # Mount the MCP server to the FastAPI app
         mcp.mount()
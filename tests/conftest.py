@@ -0,0 +1,63 @@
+"""
+Shared fixtures: the server module on the fake Stata backend, with fresh scheduler, tenant,
+job store and cache state for every test
+"""
+
+import os
+import sys
+from contextlib import contextmanager
+
+import pytest
+
+# Make the server module importable from the repository checkout
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import stata_mcp_server as server  # noqa: E402
+
+
+@pytest.fixture
+def stata(monkeypatch):
+    """The server module with a new fake backend and an idle scheduler"""
+    server.init_fake_backend("")
+    monkeypatch.setattr(server, "stata_scheduler", server.StataScheduler())
+    monkeypatch.setattr(server, "job_store", None)
+    monkeypatch.setattr(server, "tenants", {})
+    monkeypatch.setattr(server, "command_history", [])
+    monkeypatch.setattr(server, "log_file_location", "workspace")
+    monkeypatch.setattr(server, "graph_formats", [])
+    monkeypatch.setattr(server, "previous_outputs", {})
+    monkeypatch.setattr(server, "previous_outputs_bytes", 0)
+    monkeypatch.setattr(server, "preflight_cache", {})
+    return server
+
+
+@pytest.fixture
+def job_store(stata, monkeypatch, tmp_path):
+    """A job store in a temporary directory, installed as the server's store"""
+    store = stata.JobStore(str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(stata, "job_store", store)
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def as_tenant(stata):
+    """Context manager that makes tenant the caller, as the tenant middleware does for a request"""
+    @contextmanager
+    def use(tenant):
+        token = stata._tenant_context.set(tenant)
+        try:
+            yield tenant
+        finally:
+            stata._tenant_context.reset(token)
+    return use
+
+
+@pytest.fixture
+def do_file(tmp_path):
+    """Write a do-file into the test's directory and return its path"""
+    def write(text, name="test.do"):
+        path = tmp_path / name
+        path.write_text(text)
+        return str(path)
+    return write
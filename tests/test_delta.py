@@ -0,0 +1,41 @@
+"""Delta output against the previous output of a file or selection"""
+
+
+def log_lines(changed=None, stamp="10:00:00"):
+    lines = [f"[2024-01-01 {stamp}] summarize"] + [f"    var{i}  |  {i * 1.5:.2f}" for i in range(60)]
+    if changed is not None:
+        lines[changed] = "    changed  |  0.00"
+    return "\n".join(lines)
+
+
+def test_first_and_unchanged_output(stata):
+    text, mode = stata.delta_response(log_lines(), True, None, "file", "/work/a.do")
+    assert mode == "first" and text.endswith(log_lines())
+    # Timestamps differ between runs and are ignored
+    text, mode = stata.delta_response(log_lines(stamp="11:30:00"), True, None, "file", "/work/a.do")
+    assert mode == "unchanged" and text.startswith("No changes")
+
+
+def test_changed_lines_are_returned_as_a_diff(stata):
+    stata.delta_response(log_lines(), True, None, "file", "/work/a.do")
+    text, mode = stata.delta_response(log_lines(changed=30), True, None, "file", "/work/a.do")
+    assert mode == "delta"
+    assert "+1 -1 lines" in text
+    assert "+    changed  |  0.00" in text
+    assert "-    var29  |  43.50" in text
+    assert "var5 " not in text
+
+
+def test_output_is_remembered_without_delta(stata):
+    text, mode = stata.delta_response(log_lines(), False, None, "file", "/work/a.do")
+    assert mode is None and text == log_lines()
+    _, mode = stata.delta_response(log_lines(), True, None, "file", "/work/a.do")
+    assert mode == "unchanged"
+
+
+def test_sessions_and_errors_are_kept_apart(stata):
+    stata.delta_response(log_lines(), True, "one", "file", "/work/a.do")
+    _, mode = stata.delta_response(log_lines(), True, "two", "file", "/work/a.do")
+    assert mode == "first"
+    text, mode = stata.delta_response("Error: no Stata", True, "two", "file", "/work/a.do")
+    assert mode is None and text == "Error: no Stata"
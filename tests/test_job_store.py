@@ -0,0 +1,87 @@
+"""Job store round trips, runtime prediction and the runtime regression alert"""
+
+import time
+
+
+def finished_file_job(stata, path, content_hash, seconds, output="done\n", preempted=0.0):
+    """A do-file job that ran for seconds (plus preempted seconds spent on other jobs)"""
+    job = stata.StataJob("file", None, (path,), {}, "normal", path)
+    job.dedupe_key = (path, content_hash, ())
+    job.started_at = time.time() - seconds - preempted
+    job.finished_at = time.time()
+    job.preempted_seconds = preempted
+    job.status = "done"
+    stata.job_store.record_submitted(job)
+    stata.job_store.record_started(job)
+    stata.job_store.record_finished(job, output=output)
+    return job
+
+
+def test_finished_job_round_trip(stata, job_store):
+    job = stata.stata_scheduler.submit("selection", stata.run_stata_selection, "display 42")
+    result = job.future.result(timeout=10)
+    # The record is written before the future resolves
+    stored = job_store.get(job.id)
+    assert stored["status"] == "done"
+    assert stored["output"] == result
+    assert stored["return_code"] == 0
+    assert stored["run_seconds"] >= 0
+    assert [row["id"] for row in job_store.find(status="done")] == [job.id]
+
+
+def test_failed_job_is_stored_with_its_error(stata, job_store):
+    def fail():
+        raise RuntimeError("boom")
+    job = stata.stata_scheduler.submit("selection", fail)
+    try:
+        job.future.result(timeout=10)
+    except RuntimeError:
+        pass
+    stored = job_store.get(job.id, include_output=False)
+    assert stored["status"] == "failed" and stored["error"] == "boom"
+
+
+def test_run_file_is_found_by_path(stata, job_store, do_file):
+    path = do_file("display 1\n")
+    key = stata.run_file_dedupe_key(path, timeout=60)
+    job = stata.stata_scheduler.submit("file", stata.run_stata_file, path, timeout=60, dedupe_key=key)
+    job.future.result(timeout=10)
+    rows = job_store.find(file_path=key[0])
+    assert [row["id"] for row in rows] == [job.id]
+    assert rows[0]["content_hash"] == key[1]
+
+
+def test_prediction_is_the_median_of_clean_runs(stata, job_store):
+    for seconds in (10.0, 12.0, 30.0):
+        finished_file_job(stata, "/work/a.do", "hash1", seconds)
+    finished_file_job(stata, "/work/a.do", "hash1", 99.0, output="r(198);\n")
+    prediction = stata.predict_runtime("/work/a.do", "hash1")
+    assert prediction["basis"] == "content"
+    assert prediction["runs"] == 3 and prediction["failures"] == 1
+    assert abs(prediction["seconds"] - 12.0) < 0.1
+    assert prediction["suggested_timeout"] == 120
+
+
+def test_prediction_falls_back_to_the_path(stata, job_store):
+    finished_file_job(stata, "/work/a.do", "hash1", 20.0)
+    prediction = stata.predict_runtime("/work/a.do", "hash2")
+    assert prediction["basis"] == "path"
+    assert stata.predict_runtime("/work/b.do", "hash3") is None
+
+
+def test_preempted_time_is_not_stored_as_run_time(stata, job_store):
+    job = finished_file_job(stata, "/work/a.do", "hash1", 5.0, preempted=40.0)
+    assert abs(job_store.get(job.id)["run_seconds"] - 5.0) < 0.1
+
+
+def test_runtime_regression_alert(stata, job_store):
+    for seconds in (10.0, 11.0, 12.0):
+        finished_file_job(stata, "/work/a.do", "hash1", seconds)
+    prediction = stata.predict_runtime("/work/a.do", "hash1")
+    slow = finished_file_job(stata, "/work/a.do", "hash1", 60.0)
+    slow.prediction = prediction
+    assert stata.runtime_regression(slow).startswith("SLOWER THAN USUAL")
+    # Time spent on preempting jobs does not make a run look slow
+    preempted = finished_file_job(stata, "/work/a.do", "hash1", 12.0, preempted=60.0)
+    preempted.prediction = prediction
+    assert stata.runtime_regression(preempted) is None
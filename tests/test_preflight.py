@@ -0,0 +1,58 @@
+"""Pre-flight checks of do-files before they are queued"""
+
+import pytest
+
+
+def severities(stata, path):
+    return [(line, severity) for line, severity, _ in stata.preflight_check(path)]
+
+
+def test_clean_file(stata, do_file):
+    path = do_file('sysuse auto, clear\nforeach v in price mpg {\n    summarize `v\'\n}\n'
+                   'program define hello\n    display "hi"\nend\n/* comment */\n')
+    assert stata.preflight_check(path) == []
+    stata.preflight_do_file(path)
+
+
+@pytest.mark.parametrize("text, line", [
+    ("foreach v in a b {\n    display 1\n", 1),
+    ("display 1\n}\n", 2),
+    ("/* never closed\ndisplay 1\n", 1),
+    ('display "open\n', 1),
+    ("program define p\n    display 1\n", 1),
+    ("forvalues i = 1/3\n    display `i'\n", 1),
+    ("#delimit x\n", 1),
+])
+def test_structural_errors_reject_the_file(stata, do_file, text, line):
+    path = do_file(text)
+    assert (line, "error") in severities(stata, path)
+    with pytest.raises(stata.PreflightError):
+        stata.preflight_do_file(path)
+
+
+def test_brackets_balanced_through_a_macro_are_a_warning(stata, do_file):
+    path = do_file('global opts "vce(robust"\nregress y x, $opts)\n')
+    assert severities(stata, path) == [(2, "warning")]
+    stata.preflight_do_file(path)
+
+
+def test_do_target_written_by_the_file_is_a_warning(stata, do_file):
+    path = do_file('tempname fh\nfile open `fh\' using gen.do, write replace\nfile write `fh\' "display 1" _n\n'
+                   'file close `fh\'\ndo gen.do\n')
+    problems = stata.preflight_check(path)
+    assert [(line, severity) for line, severity, _ in problems] == [(5, "warning")]
+    assert "gen.do" in problems[0][2]
+    stata.preflight_do_file(path)
+
+
+def test_existing_and_captured_targets_are_not_reported(stata, do_file, tmp_path):
+    do_file("display 1\n", name="child.do")
+    path = do_file(f'cd "{tmp_path}"\ndo child.do\ncapture do missing.do\ndo "`dir\'/other.do"\n')
+    assert stata.preflight_check(path) == []
+
+
+def test_results_are_cached_by_content(stata, do_file):
+    path = do_file("foreach v in a {\n")
+    first = stata.preflight_check(path)
+    assert stata.preflight_check(path) == first
+    assert len(stata.preflight_cache) == 1
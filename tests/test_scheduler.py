@@ -0,0 +1,95 @@
+"""Scheduler lanes, weighted round robin and preemption points"""
+
+import threading
+
+PREEMPTIBLE_DO_FILE = """** # first
+sleep 400
+** # second
+display 2
+** # third
+display 3
+"""
+
+
+def blocker(stata, lane="batch"):
+    """Occupy the scheduler's worker until the returned event is set"""
+    release = threading.Event()
+    started = threading.Event()
+
+    def hold():
+        started.set()
+        release.wait(10)
+        return "released"
+
+    job = stata.stata_scheduler.submit("selection", hold, lane=lane)
+    assert started.wait(5)
+    return job, release
+
+
+def test_interactive_lane_runs_first(stata):
+    job, release = blocker(stata)
+    order = []
+    jobs = [stata.stata_scheduler.submit("selection", order.append, lane, lane=lane)
+            for lane in ("batch", "normal", "interactive")]
+    release.set()
+    for queued in [job] + jobs:
+        queued.future.result(timeout=10)
+    assert order == ["interactive", "normal", "batch"]
+
+
+def test_weighted_round_robin_does_not_starve_batch(stata, monkeypatch):
+    monkeypatch.setattr(stata, "stata_scheduler", stata.StataScheduler(lane_weights={"interactive": 2, "batch": 1}))
+    # The blocker uses one of the two interactive credits
+    job, release = blocker(stata, lane="interactive")
+    order = []
+    jobs = [stata.stata_scheduler.submit("selection", order.append, f"{lane}{i}", lane=lane)
+            for i, lane in enumerate(("interactive", "interactive", "interactive", "batch"))]
+    release.set()
+    for queued in [job] + jobs:
+        queued.future.result(timeout=10)
+    assert order == ["interactive0", "batch3", "interactive1", "interactive2"]
+
+
+def test_queue_length_limit(stata, monkeypatch):
+    monkeypatch.setattr(stata, "stata_scheduler", stata.StataScheduler(max_queue_length=1))
+    job, release = blocker(stata)
+    try:
+        stata.stata_scheduler.submit("selection", lambda: "ok")
+        try:
+            stata.stata_scheduler.submit("selection", lambda: "ok")
+        except stata.QueueFullError as e:
+            assert e.reason == "queue_length"
+        else:
+            raise AssertionError("the second queued job was admitted")
+    finally:
+        release.set()
+    job.future.result(timeout=10)
+
+
+def test_identical_file_runs_are_coalesced(stata, do_file):
+    path = do_file("display 1\n")
+    key = stata.run_file_dedupe_key(path, timeout=60, lane="normal")
+    job, release = blocker(stata)
+    first = stata.stata_scheduler.submit("file", stata.run_stata_file, path, timeout=60, dedupe_key=key)
+    second = stata.stata_scheduler.submit("file", stata.run_stata_file, path, timeout=60, dedupe_key=key)
+    release.set()
+    assert first is second and first.attached == 1
+    assert "Execution completed" in first.future.result(timeout=10)
+
+
+def test_preemption_point_runs_interactive_work_between_blocks(stata, do_file):
+    path = do_file(PREEMPTIBLE_DO_FILE)
+    finished = []
+    file_job = stata.stata_scheduler.submit("file", stata.run_stata_file, path, timeout=60, preemptible=True)
+    file_job.future.add_done_callback(lambda _: finished.append("file"))
+    # Queued while the first block sleeps, so it runs at the first preemption point
+    threading.Event().wait(0.2)
+    selection = stata.stata_scheduler.submit("selection", stata.run_stata_selection, "display 9", lane="interactive")
+    selection.future.add_done_callback(lambda _: finished.append("selection"))
+    output = file_job.future.result(timeout=30)
+    assert "--Break--" not in output
+    assert finished == ["selection", "file"]
+    # The preempting job's time is not the do-file's own run time
+    assert file_job.preempted_seconds > 0
+    total = file_job.finished_at - file_job.started_at
+    assert abs(file_job.run_seconds - (total - file_job.preempted_seconds)) < 0.01
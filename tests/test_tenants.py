@@ -0,0 +1,85 @@
+"""Tenant admission limits and per-tenant Stata frames"""
+
+import threading
+
+from .test_scheduler import PREEMPTIBLE_DO_FILE
+
+
+def record_frame_changes(stata):
+    """Wrap the fake backend's run and return the list of `frame change` commands it receives"""
+    changes = []
+    run = stata.stata_backend.run
+
+    def spy(command, echo=False):
+        if command.startswith("frame change"):
+            changes.append(command.split()[-1])
+        return run(command, echo=echo)
+
+    stata.stata_backend.run = spy
+    return changes
+
+
+def test_tenant_job_limit(stata, as_tenant):
+    tenant = stata.Tenant("a", "token-a", max_jobs=1)
+    other = stata.Tenant("b", "token-b", max_jobs=1)
+    stata.tenants.update({tenant.token: tenant, other.token: other})
+    release = threading.Event()
+    with as_tenant(tenant):
+        job = stata.stata_scheduler.submit("selection", release.wait, 10)
+        try:
+            stata.stata_scheduler.submit("selection", lambda: "ok")
+        except stata.QueueFullError as e:
+            assert e.reason == "tenant_jobs" and e.retry_after >= 1
+        else:
+            raise AssertionError("the tenant's second job was admitted")
+    # The limit is per tenant
+    with as_tenant(other):
+        queued = stata.stata_scheduler.submit("selection", lambda: "ok")
+    release.set()
+    job.future.result(timeout=10)
+    assert queued.future.result(timeout=10) == "ok"
+    assert tenant.jobs_rejected == 1 and other.jobs_rejected == 0
+
+
+def test_external_work_counts_towards_the_tenant(stata, as_tenant):
+    tenant = stata.Tenant("a", "token-a", max_jobs=1)
+    stata.tenants[tenant.token] = tenant
+    with as_tenant(tenant):
+        placeholder = stata.stata_scheduler.admit_external("sweep", "batch", "sweep.do", 30.0)
+        try:
+            stata.stata_scheduler.submit("selection", lambda: "ok")
+        except stata.QueueFullError as e:
+            assert e.reason == "tenant_jobs"
+        else:
+            raise AssertionError("a job was admitted next to the tenant's running sweep")
+    stata.stata_scheduler.finish_external(placeholder, seconds=2.0)
+    assert tenant.cpu_seconds_total >= 2.0
+
+
+def test_jobs_run_in_their_tenant_frame(stata, as_tenant):
+    tenant = stata.Tenant("a", "token-a")
+    stata.tenants[tenant.token] = tenant
+    changes = record_frame_changes(stata)
+    with as_tenant(tenant):
+        job = stata.stata_scheduler.submit("selection", stata.run_stata_selection, "display 1")
+    job.future.result(timeout=10)
+    assert changes == [tenant.frame]
+    assert tenant.command_history and not stata.command_history
+
+
+def test_preempted_tenant_frame_is_restored(stata, as_tenant, do_file):
+    first = stata.Tenant("a", "token-a")
+    second = stata.Tenant("b", "token-b")
+    stata.tenants.update({first.token: first, second.token: second})
+    changes = record_frame_changes(stata)
+    path = do_file(PREEMPTIBLE_DO_FILE)
+    with as_tenant(first):
+        file_job = stata.stata_scheduler.submit("file", stata.run_stata_file, path, timeout=60, preemptible=True)
+    threading.Event().wait(0.2)
+    with as_tenant(second):
+        selection = stata.stata_scheduler.submit("selection", stata.run_stata_selection, "display 9",
+                                                 lane="interactive")
+    selection.future.result(timeout=30)
+    file_job.future.result(timeout=30)
+    # The rest of the do-file runs in its own tenant's frame again
+    assert changes == [first.frame, second.frame, first.frame]